@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""
+header_filter_benchmark.py
+
+Measure the headers per second we can filter, with the original filters
+(decode every header, then run a list of lambdas through all([...])) and
+with a HeaderFilter (see header_filter.py).
+
+The headers are a mix like an aggregator sees: --hosts hosts, each with
+--log-paths log files, JSON headers from some producers and binary headers
+(with their string tables) from the rest. Each filter is run twice:
+
+    selective   the host regexp passes one host in ten
+    broad       every header passes
+
+usage:
+    PYTHONPATH=. python benchmarks/header_filter_benchmark.py
+"""
+import argparse
+import json
+import re
+import sys
+import time
+import uuid
+
+from old_log_inn.header_filter import HeaderFilter
+from old_log_inn.log_header import HeaderDecoder, \
+    encode_binary_header, \
+    encode_string_table
+
+def _parse_commandline():
+    parser = argparse.ArgumentParser(description="header_filter_benchmark")
+    parser.add_argument("--headers", dest="headers", type=int,
+                        default=200000)
+    parser.add_argument("--hosts", dest="hosts", type=int, default=50)
+    parser.add_argument("--log-paths", dest="log_paths", type=int,
+                        default=10)
+    parser.add_argument("--binary-percent", dest="binary_percent", type=int,
+                        default=50)
+    return parser.parse_args()
+
+def _create_raw_headers(args):
+    producers = list()
+    for host in range(args.hosts):
+        for log_path in range(args.log_paths):
+            producers.append(("host{0:03}".format(host),
+                              "node{0:02}".format(host % 7),
+                              "/var/log/service{0:02}.log".format(log_path),
+                              uuid.uuid4().bytes, ))
+
+    binary_count = len(producers) * args.binary_percent // 100
+    raw_headers = list()
+
+    # the string tables come ahead of the binary headers
+    for hostname, nodename, log_path, uuid_bytes in \
+        producers[:binary_count]:
+        raw_headers.append(encode_string_table(uuid_bytes,
+                                               hostname,
+                                               nodename,
+                                               log_path))
+
+    for sequence in range(args.headers):
+        index = sequence % len(producers)
+        hostname, nodename, log_path, uuid_bytes = producers[index]
+        timestamp = 1357042500.0 + sequence / 1000.0
+        if index < binary_count:
+            raw_headers.append(encode_binary_header(uuid_bytes,
+                                                    1,
+                                                    sequence,
+                                                    timestamp))
+        else:
+            header = {"hostname"    : hostname,
+                      "nodename"    : nodename,
+                      "uuid"        : uuid.UUID(bytes=uuid_bytes).hex,
+                      "pid"         : 1,
+                      "sequence"    : sequence,
+                      "timestamp"   : timestamp,
+                      "log_path"    : log_path, }
+            raw_headers.append(json.dumps(header).encode("utf-8"))
+    return raw_headers
+
+def _run_original(raw_headers, host_regexp, node_regexp, log_path_regexp):
+    host_regex = re.compile(host_regexp)
+    node_regex = re.compile(node_regexp)
+    log_path_regex = re.compile(log_path_regexp)
+    filters = [lambda h: host_regex.match(h["hostname"]) is not None,
+               lambda h: "nodename" in h and \
+                   node_regex.match(h["nodename"]) is not None,
+               lambda h: log_path_regex.match(h["log_path"]) is not None, ]
+
+    header_decoder = HeaderDecoder()
+    passed_count = 0
+    for raw_header in raw_headers:
+        header = header_decoder.decode(raw_header)
+        if header is None:
+            continue
+        if not all([f(header) for f in filters]):
+            continue
+        passed_count += 1
+    return passed_count
+
+def _run_header_filter(raw_headers,
+                       host_regexp,
+                       node_regexp,
+                       log_path_regexp):
+    header_filter = HeaderFilter(host_regexp=host_regexp,
+                                 node_regexp=node_regexp,
+                                 log_path_regexp=log_path_regexp)
+    header_decoder = HeaderDecoder()
+    passed_count = 0
+    for raw_header in raw_headers:
+        header = header_filter.decode_header(raw_header, header_decoder)
+        if header is None:
+            continue
+        passed_count += 1
+    return passed_count
+
+def main():
+    """
+    main entry point
+    """
+    args = _parse_commandline()
+    raw_headers = _create_raw_headers(args)
+
+    for case_name, regexps in \
+        [("selective", (r"host\d\d0", r"node", r"/var/log/", )),
+         ("broad", (r"host", r"node", r"/var/log/", )), ]:
+        for name, run_function in \
+            [("original", _run_original),
+             ("header_filter", _run_header_filter), ]:
+            start_time = time.time()
+            passed_count = run_function(raw_headers, *regexps)
+            elapsed_time = time.time() - start_time
+            print("{0:9} {1:13} {2:8} passed {3:8.3f}s "
+                  "{4:10.0f} headers/s".format(case_name,
+                                               name,
+                                               passed_count,
+                                               elapsed_time,
+                                               len(raw_headers) /
+                                               elapsed_time))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
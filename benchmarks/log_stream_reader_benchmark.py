@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""
+log_stream_reader_benchmark.py
+
+Measure the records per second we can read from a log stream file, with
+generate_log_stream_from_file (three GzipFile reads a record) and with
+generate_log_stream_batches_from_file (a chunk at a time, see log_stream.py).
+
+The file is written by a LogStreamWriter with --records JSON header records
+of about --body-size bytes, either recompressed (version 2 frames) or
+stored as they came off the wire in batches of --batch-size (version 3
+frames, passthrough). Each reader is run over each file:
+
+    generator   generate_log_stream_from_file
+    batches     generate_log_stream_batches_from_file, records as bytes
+    views       generate_log_stream_batches_from_file, records as memoryviews
+
+usage:
+    PYTHONPATH=. python benchmarks/log_stream_reader_benchmark.py
+"""
+import argparse
+import json
+import os
+import os.path
+import shutil
+import sys
+import time
+
+from old_log_inn.log_batch import pack_batch
+from old_log_inn.log_stream import LogStreamWriter, \
+    generate_log_stream_batches_from_file, \
+    generate_log_stream_from_file
+from old_log_inn.zlib_dictionary import ZlibDecompressor
+
+_test_dir = "/tmp/log_stream_reader_benchmark"
+_work_dir = os.path.join(_test_dir, "work")
+_complete_dir = os.path.join(_test_dir, "complete")
+
+def _parse_commandline():
+    parser = argparse.ArgumentParser(
+        description="log_stream_reader_benchmark")
+    parser.add_argument("--records", dest="records", type=int,
+                        default=200000)
+    parser.add_argument("--body-size", dest="body_size", type=int,
+                        default=100)
+    parser.add_argument("--batch-size", dest="batch_size", type=int,
+                        default=100)
+    parser.add_argument("--chunk-size", dest="chunk_size", type=int,
+                        default=1024 ** 2)
+    return parser.parse_args()
+
+def _create_records(args):
+    records = list()
+    for sequence in range(args.records):
+        body = "{0:08} ".format(sequence) + "x" * (args.body_size - 9)
+        header = {"hostname"    : "host{0:03}".format(sequence % 50),
+                  "log_path"    : "/var/log/service.log",
+                  "sequence"    : sequence,
+                  "timestamp"   : 1357042500.0 + sequence / 1000.0,
+                  "body_size"   : len(body.encode("utf-8")), }
+        records.append((json.dumps(header).encode("utf-8"),
+                        body.encode("utf-8"), ))
+    return records
+
+def _write_file(args, records, passthrough):
+    if os.path.isdir(_test_dir):
+        shutil.rmtree(_test_dir)
+    os.makedirs(_work_dir)
+    os.makedirs(_complete_dir)
+
+    writer = LogStreamWriter("logs.",
+                             ".gz",
+                             3600,
+                             _work_dir,
+                             _complete_dir,
+                             passthrough=passthrough)
+    if passthrough:
+        messages = list()
+        for start in range(0, len(records), args.batch_size):
+            batch = records[start:start+args.batch_size]
+            messages.append(pack_batch([h for (h, _) in batch],
+                                       [d for (_, d) in batch]))
+        writer.write_messages(messages, ZlibDecompressor())
+    else:
+        writer.write_records(records)
+    writer._close_current_file()
+
+    (file_name, ) = os.listdir(_complete_dir)
+    return os.path.join(_complete_dir, file_name)
+
+def _run_generator(args, path):
+    record_count = 0
+    for _ in generate_log_stream_from_file(path):
+        record_count += 1
+    return record_count
+
+def _run_batches(args, path, views=False):
+    record_count = 0
+    for records in generate_log_stream_batches_from_file(
+        path, chunk_size=args.chunk_size, views=views):
+        record_count += len(records)
+    return record_count
+
+def _run_views(args, path):
+    return _run_batches(args, path, views=True)
+
+def main():
+    """
+    main entry point
+    """
+    args = _parse_commandline()
+    records = _create_records(args)
+
+    for case_name, passthrough in [("version2", False, ),
+                                   ("version3", True, ), ]:
+        path = _write_file(args, records, passthrough)
+        for name, run_function in [("generator", _run_generator),
+                                   ("batches", _run_batches),
+                                   ("views", _run_views), ]:
+            start_time = time.time()
+            record_count = run_function(args, path)
+            elapsed_time = time.time() - start_time
+            print("{0:8} {1:9} {2:8} records {3:8.3f}s "
+                  "{4:10.0f} records/s".format(case_name,
+                                               name,
+                                               record_count,
+                                               elapsed_time,
+                                               record_count /
+                                               elapsed_time))
+
+    shutil.rmtree(_test_dir)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
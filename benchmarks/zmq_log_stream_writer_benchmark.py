@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+zmq_log_stream_writer_benchmark.py
+
+Measure the records per second that the zmq_log_stream_writer receive loop
+can take from a local PUB socket over ipc:// and write to disk.
+
+A separate process publishes the same pre-compressed messages for each of
+two receive loops, and we time the loop draining them from the sub socket:
+
+    single  one message from each ready socket for every poll,
+            written one record at a time as the original writer did:
+            computing the file timestamp with datetime.utcnow and strftime
+            to check for rollover, and flushing the file, for every record
+            (the original loop, --flush-records does not apply)
+    drain   up to --drain-budget messages from each ready socket for every
+            poll, written with a single rollover check
+    pipeline
+            drained as above, decompressed and compressed by
+            --pipeline-workers worker threads (see log_stream_pipeline.py)
+    passthrough
+            drained as above, stored without compressing again
+
+usage:
+    PYTHONPATH=. python benchmarks/zmq_log_stream_writer_benchmark.py
+"""
+import argparse
+from datetime import datetime, timedelta
+import json
+from multiprocessing import Process
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+import zmq
+
+from old_log_inn.log_stream import _compute_timestamp, \
+    LogStreamWriter, \
+    durabilities
+from old_log_inn.log_stream_pipeline import LogStreamPipeline
+from old_log_inn.zlib_dictionary import ZlibDecompressor
+from old_log_inn.zmq_log_stream_writer import _drain_socket, \
+    _drain_socket_messages, \
+    _receive_one_message
+from old_log_inn.log_batch import unpack_message
+
+# an empty record marks the end of the run
+_end_message = [b"", zlib.compress(b""), zlib.compress(b""), ]
+_end_record = (b"", b"", )
+_granularity = 3600
+
+def _parse_commandline():
+    parser = argparse.ArgumentParser(
+        description="zmq_log_stream_writer_benchmark")
+    parser.add_argument("--messages", dest="messages", type=int,
+                        default=100000)
+    parser.add_argument("--drain-budget", dest="drain_budget", type=int,
+                        default=1000)
+    parser.add_argument("--flush-records", dest="flush_records", type=int,
+                        default=1000)
+    parser.add_argument("--pipeline-workers", dest="pipeline_workers",
+                        type=int, default=4)
+    parser.add_argument("--durability", dest="durability",
+                        choices=durabilities, default="flush")
+    return parser.parse_args()
+
+def _create_messages(count):
+    messages = list()
+    for sequence in range(count):
+        body = "benchmark log line {0:08}".format(sequence)
+        header = {"hostname"    : "benchmark",
+                  "uuid"        : "0123456789abcdef0123456789abcdef",
+                  "pid"         : 1,
+                  "sequence"    : sequence,
+                  "timestamp"   : time.time(),
+                  "log_path"    : "benchmark/benchmark.log",
+                  "body_size"   : len(body.encode("utf-8")), }
+        messages.append(
+            [b"",
+             zlib.compress(json.dumps(header).encode("utf-8")),
+             zlib.compress(body.encode("utf-8")), ])
+    return messages
+
+def _publish(address, messages):
+    """
+    publish the messages from a separate process
+    """
+    context = zmq.Context()
+    pub_socket = context.socket(zmq.PUB)
+    pub_socket.hwm = 0
+    pub_socket.bind(address)
+
+    # let the subscription reach us
+    time.sleep(1.0)
+
+    for message in messages:
+        pub_socket.send_multipart(message)
+    pub_socket.send_multipart(_end_message)
+
+    pub_socket.close(linger=-1)
+    context.term()
+
+def _receive_single(sub_socket, decompressor, _drain_budget, stream_writer):
+    _topic, frames, _trailer = _receive_one_message(sub_socket)
+    records = unpack_message(frames, decompressor.decompress)
+    if records == [_end_record, ]:
+        return 0, True
+    for header, data in records:
+        # the rollover check of the original LogStreamWriter.write
+        timestamp = _compute_timestamp(timedelta(seconds=_granularity),
+                                       datetime.utcnow())
+        if stream_writer._output_timestamp is not None and \
+            timestamp != stream_writer._output_timestamp:
+            stream_writer._close_current_file()
+        stream_writer.write(header, data)
+    return len(records), False
+
+def _receive_drain(sub_socket, decompressor, drain_budget, stream_writer):
+    records = list()
+    _drain_socket(sub_socket, decompressor, drain_budget, records)
+    done = len(records) > 0 and records[-1] == _end_record
+    if done:
+        records.pop()
+    stream_writer.write_records(records)
+    return len(records), done
+
+class _PipelineReceiver(object):
+    """
+    feed drained messages to a LogStreamPipeline
+    """
+    def __init__(self, worker_count):
+        self._worker_count = worker_count
+        self._pipeline = None
+
+    def __call__(self, sub_socket, decompressor, drain_budget, stream_writer):
+        if self._pipeline is None:
+            self._pipeline = LogStreamPipeline(stream_writer,
+                                               decompressor,
+                                               self._worker_count)
+            self._pipeline.start()
+        messages = list()
+        _drain_socket_messages(sub_socket, drain_budget, messages)
+        done = len(messages) > 0 and messages[-1] == _end_message[1:]
+        if done:
+            messages.pop()
+        self._pipeline.submit(messages)
+        if done:
+            self._pipeline.close()
+            self._pipeline = None
+        return len(messages), done
+
+def _receive_passthrough(sub_socket, decompressor, drain_budget, 
+                         stream_writer):
+    messages = list()
+    _drain_socket_messages(sub_socket, drain_budget, messages)
+    done = len(messages) > 0 and messages[-1] == _end_message[1:]
+    if done:
+        messages.pop()
+    stream_writer.write_messages(messages, decompressor)
+    return len(messages), done
+
+def _run(context, address, messages, receive_function, args):
+    work_dir = tempfile.mkdtemp()
+    try:
+        # the original writer flushed the file after every record
+        flush_records = args.flush_records
+        if receive_function is _receive_single:
+            flush_records = None
+        stream_writer = LogStreamWriter("logs.",
+                                        ".gz",
+                                        _granularity,
+                                        os.path.join(work_dir, "work"),
+                                        os.path.join(work_dir, "complete"),
+                                        flush_records=flush_records,
+                                        durability=args.durability,
+                                        passthrough=receive_function is \
+                                            _receive_passthrough)
+        for directory in ["work", "complete", ]:
+            os.mkdir(os.path.join(work_dir, directory))
+
+        publisher = Process(target=_publish, args=(address, messages, ))
+        publisher.start()
+
+        sub_socket = context.socket(zmq.SUB)
+        sub_socket.hwm = 0
+        sub_socket.setsockopt(zmq.SUBSCRIBE, b"")
+        sub_socket.connect(address)
+
+        poller = zmq.Poller()
+        poller.register(sub_socket, zmq.POLLIN)
+
+        # queue everything up in the sub socket before we start the clock,
+        # so we measure the receive loop and not the publisher
+        publisher.join()
+
+        decompressor = ZlibDecompressor()
+        record_count = 0
+        start_time = time.time()
+        while True:
+            poller.poll()
+            count, done = receive_function(sub_socket,
+                                           decompressor,
+                                           args.drain_budget,
+                                           stream_writer)
+            record_count += count
+            if done:
+                break
+        stream_writer.flush()
+        elapsed_time = time.time() - start_time
+
+        sub_socket.close()
+        return record_count, elapsed_time
+    finally:
+        shutil.rmtree(work_dir)
+
+def main():
+    """
+    main entry point
+    """
+    args = _parse_commandline()
+
+    messages = _create_messages(args.messages)
+    context = zmq.Context()
+    address = "ipc://{0}".format(os.path.join(tempfile.gettempdir(),
+                                 "zmq_log_stream_writer_benchmark.socket"))
+
+    for name, receive_function in \
+        [("single", _receive_single),
+         ("drain", _receive_drain),
+         ("pipeline", _PipelineReceiver(args.pipeline_workers)), 
+         ("passthrough", _receive_passthrough), ]:
+        record_count, elapsed_time = \
+            _run(context, address, messages, receive_function, args)
+        print("{0:11} {1:8} records {2:8.3f}s {3:10.0f} records/s".format(
+            name, record_count, elapsed_time, record_count / elapsed_time))
+
+    context.term()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
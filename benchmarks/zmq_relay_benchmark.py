@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+zmq_relay_benchmark.py
+
+Measure the messages per second, and the CPU time per message, of the relay
+hops: zmq_push_pub_forwarder (PULL to PUB) and zmq_subscription_aggregator
+(SUB to PUB).
+
+A publisher process sends the same messages through a relay process to a
+subscriber (this process) over ipc://. We time the subscriber from the first
+message to the last, and the relay process reports the CPU time it spent.
+Each hop is run two ways:
+
+    copy        each frame received as a fresh bytes object with recv()
+                and sent with send() (the original loops)
+    zero-copy   the frames received with recv_multipart(copy=False) and sent
+                on as the same zmq.Frame objects
+
+for each of --body-sizes.
+
+usage:
+    PYTHONPATH=. python benchmarks/zmq_relay_benchmark.py
+"""
+import argparse
+import functools
+import json
+from multiprocessing import Process, Queue
+import os
+import os.path
+import resource
+import sys
+import tempfile
+import time
+import zlib
+
+import zmq
+
+from old_log_inn.log_batch import message_frame_count
+from old_log_inn.log_header import HeaderDecoder
+from old_log_inn.zlib_dictionary import ZlibDecompressor
+from old_log_inn.zmq_push_pub_forwarder import _forward_message, \
+    _topic_messages
+from old_log_inn.subscription_shard import relay_message
+
+def _parse_commandline():
+    parser = argparse.ArgumentParser(description="zmq_relay_benchmark")
+    parser.add_argument("--messages", dest="messages", type=int,
+                        default=50000)
+    parser.add_argument("--body-sizes", dest="body_sizes", type=int,
+                        nargs="+", default=[256, 16384, ])
+    return parser.parse_args()
+
+def _create_messages(count, body_size):
+    messages = list()
+    body = zlib.compress(os.urandom(body_size), 0)
+    for sequence in range(count):
+        header = {"hostname"    : "benchmark",
+                  "uuid"        : "0123456789abcdef0123456789abcdef",
+                  "pid"         : 1,
+                  "sequence"    : sequence,
+                  "timestamp"   : time.time(),
+                  "log_path"    : "benchmark/benchmark.log", }
+        messages.append([zlib.compress(json.dumps(header).encode("utf-8")),
+                         body, ])
+    return messages
+
+def _forward_copy(pull_socket,
+                  pub_socket,
+                  topic_bytes,
+                  decompressor,
+                  header_decoder):
+    """
+    the original zmq_push_pub_forwarder loop
+    """
+    frames = [pull_socket.recv(), ]
+    for _ in range(message_frame_count(frames[0]) - 1):
+        assert pull_socket.rcvmore
+        frames.append(pull_socket.recv())
+    assert not pull_socket.rcvmore
+
+    for topic, topic_frames in _topic_messages(frames,
+                                               topic_bytes,
+                                               decompressor,
+                                               header_decoder):
+        pub_socket.send(topic, zmq.SNDMORE)
+        for frame in topic_frames[:-1]:
+            pub_socket.send(frame, zmq.SNDMORE)
+        pub_socket.send(topic_frames[-1])
+
+def _relay_copy(sub_socket, pub_socket):
+    """
+    the original zmq_subscription_aggregator loop
+    """
+    topic = sub_socket.recv()
+    assert sub_socket.rcvmore
+    frames = [sub_socket.recv(), ]
+    for _ in range(message_frame_count(frames[0]) - 1):
+        assert sub_socket.rcvmore
+        frames.append(sub_socket.recv())
+    assert not sub_socket.rcvmore
+
+    pub_socket.send(topic, zmq.SNDMORE)
+    for frame in frames[:-1]:
+        pub_socket.send(frame, zmq.SNDMORE)
+    pub_socket.send(frames[-1])
+
+def _publish(socket_type, address, messages):
+    """
+    send the messages from a separate process
+    """
+    context = zmq.Context()
+    output_socket = context.socket(socket_type)
+    output_socket.hwm = 0
+    output_socket.bind(address)
+
+    # let the relay connect (and subscribe)
+    time.sleep(1.0)
+
+    for message in messages:
+        if socket_type == zmq.PUB:
+            output_socket.send_multipart([b"benchmark", ] + message)
+        else:
+            output_socket.send_multipart(message)
+
+    output_socket.close(linger=-1)
+    context.term()
+
+def _relay(socket_type,
+           relay_function,
+           input_address,
+           output_address,
+           count,
+           result_queue):
+    """
+    relay count messages in a separate process,
+    report the CPU time after the first one
+    """
+    context = zmq.Context()
+    input_socket = context.socket(socket_type)
+    input_socket.hwm = 0
+    if socket_type == zmq.SUB:
+        input_socket.setsockopt(zmq.SUBSCRIBE, b"")
+    input_socket.connect(input_address)
+
+    output_socket = context.socket(zmq.PUB)
+    output_socket.hwm = 0
+    output_socket.bind(output_address)
+
+    if socket_type == zmq.PULL:
+        relay_function = functools.partial(relay_function,
+                                           topic_bytes=None,
+                                           decompressor=ZlibDecompressor(),
+                                           header_decoder=HeaderDecoder())
+
+    relay_function(input_socket, output_socket)
+    start_usage = resource.getrusage(resource.RUSAGE_SELF)
+    for _ in range(count - 1):
+        relay_function(input_socket, output_socket)
+    end_usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    result_queue.put((end_usage.ru_utime - start_usage.ru_utime) + \
+                     (end_usage.ru_stime - start_usage.ru_stime))
+    output_socket.close(linger=-1)
+    input_socket.close()
+    context.term()
+
+def _run(context, socket_type, relay_function, messages):
+    work_dir = tempfile.mkdtemp()
+    input_address = "ipc://{0}".format(os.path.join(work_dir, "input"))
+    output_address = "ipc://{0}".format(os.path.join(work_dir, "output"))
+    result_queue = Queue()
+
+    relay = Process(target=_relay, args=(socket_type,
+                                         relay_function,
+                                         input_address,
+                                         output_address,
+                                         len(messages),
+                                         result_queue, ))
+    relay.start()
+
+    sub_socket = context.socket(zmq.SUB)
+    sub_socket.hwm = 0
+    sub_socket.setsockopt(zmq.SUBSCRIBE, b"")
+    sub_socket.connect(output_address)
+    time.sleep(1.0)
+
+    publisher = Process(target=_publish,
+                        args=({zmq.SUB : zmq.PUB,
+                               zmq.PULL : zmq.PUSH}[socket_type],
+                              input_address,
+                              messages, ))
+    publisher.start()
+
+    sub_socket.recv_multipart()
+    start_time = time.time()
+    for _ in range(len(messages) - 1):
+        sub_socket.recv_multipart()
+    elapsed_time = time.time() - start_time
+
+    cpu_time = result_queue.get()
+    publisher.join()
+    relay.join()
+    sub_socket.close()
+    for name in ["input", "output", ]:
+        if os.path.exists(os.path.join(work_dir, name)):
+            os.unlink(os.path.join(work_dir, name))
+    os.rmdir(work_dir)
+
+    return elapsed_time, cpu_time
+
+def main():
+    """
+    main entry point
+    """
+    args = _parse_commandline()
+    context = zmq.Context()
+
+    for body_size in args.body_sizes:
+        messages = _create_messages(args.messages, body_size)
+        for name, socket_type, relay_function in \
+            [("forwarder copy", zmq.PULL, _forward_copy),
+             ("forwarder zero-copy", zmq.PULL, _forward_message),
+             ("aggregator copy", zmq.SUB, _relay_copy),
+             ("aggregator zero-copy", zmq.SUB, relay_message), ]:
+            elapsed_time, cpu_time = \
+                _run(context, socket_type, relay_function, messages)
+            message_count = len(messages) - 1
+            print("{0:6} bytes {1:20} {2:10.0f} messages/s "
+                  "{3:7.2f} us cpu/message".format(
+                      body_size,
+                      name,
+                      message_count / elapsed_time,
+                      cpu_time * 1000000.0 / message_count))
+
+    context.term()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+archive_retrieval.py
+
+Finding and retrieving archived log stream files from a nimbus.io (or any
+boto like) bucket, for search_and_retrieve.
+
+A key name is of the form <prefix>YYYYMMDDHHMMSS<suffix>. Keys with the same
+timestamp (from different aggregator hosts) form a group, which is processed
+together.
+
+generate_retrieved_groups downloads the archives of the coming groups in a
+pool of threads while the caller works on the current group. At most
+prefetch_groups groups are in flight beyond the one the caller holds, so
+disk use stays bounded, and the groups come out strictly in timestamp order.
+
+All we ask of a bucket is get_all_keys(marker=...), returning a list of keys
+with a 'truncated' attribute, and of a key, 'name' and
+get_contents_to_file(file).
+"""
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+import os
+import os.path
+
+from old_log_inn.log_stream import is_log_stream_index_name, \
+    load_log_stream_index, \
+    log_stream_name_from_index_name, \
+    select_log_stream_index_blocks
+
+_timestamp_length = len("YYYYMMDDHHMMSS")
+_default_prefetch_workers = 4
+_default_prefetch_groups = 2
+
+def iterate_archive_keys(bucket,
+                         prefix=None,
+                         suffix=None,
+                         low_timestamp=None,
+                         high_timestamp=None):
+    """
+    fetch keys from nimbus.io
+    return a tuple of timestamp, key
+
+    the keys of sidecar indices are matched by the name of the archive
+    they describe
+    """
+    if prefix is None:
+        prefix = ""
+    prefix_length = len(prefix)
+
+    if suffix is None:
+        suffix = ""
+
+    marker = ""
+    while True:
+        key_list = bucket.get_all_keys(marker=marker)
+        for key in key_list:
+            marker = key.name
+            key_name = key.name
+            if is_log_stream_index_name(key_name):
+                key_name = log_stream_name_from_index_name(key_name)
+            if not key_name.startswith(prefix):
+                continue
+            if not key_name.endswith(suffix):
+                continue
+            timestamp = \
+                key_name[prefix_length:_timestamp_length+prefix_length]
+            if low_timestamp is not None and timestamp < low_timestamp:
+                continue
+            if high_timestamp is not None and timestamp > high_timestamp:
+                continue
+            yield timestamp, key
+        if not key_list.truncated:
+            return
+
+def collect_archive_keys(bucket,
+                         prefix=None,
+                         suffix=None,
+                         low_timestamp=None,
+                         high_timestamp=None):
+    """
+    return a tuple of
+        a dict of lists of archive keys, keyed by timestamp
+        a dict of sidecar index keys, keyed by the name of the archive key
+    """
+    timestamp_key_dict = defaultdict(list)
+    index_key_dict = dict()
+    for timestamp, key in iterate_archive_keys(bucket,
+                                               prefix,
+                                               suffix,
+                                               low_timestamp,
+                                               high_timestamp):
+        if is_log_stream_index_name(key.name):
+            index_key_dict[log_stream_name_from_index_name(key.name)] = key
+        else:
+            timestamp_key_dict[timestamp].append(key)
+    return timestamp_key_dict, index_key_dict
+
+class RetrievedArchive(object):
+    """
+    an archive key retrieved to a local file
+
+    path
+        the local file, None if we did not retrieve it, because its index
+        says none of its blocks can match
+
+    blocks
+        the blocks of the file we want to read (see log_stream.py),
+        None for all of it
+    """
+    def __init__(self, key, path, blocks):
+        self.key = key
+        self.path = path
+        self.blocks = blocks
+
+    def remove(self):
+        """
+        remove the local file (if any)
+        """
+        if self.path is not None and os.path.exists(self.path):
+            os.unlink(self.path)
+
+def _retrieve_key(work_dir, key):
+    retrieve_path = os.path.join(work_dir, key.name)
+    with open(retrieve_path, "wb") as output_file:
+        key.get_contents_to_file(output_file)
+    return retrieve_path
+
+def retrieve_archive(work_dir, key, index_key=None, index_block_preds=None):
+    """
+    retrieve an archive key to a local file in work_dir.
+
+    If we have its sidecar index, we retrieve that first and select the
+    blocks which may hold records that pass index_block_preds,
+    a tuple of (hostname_pred, log_path_pred). If there are none, we don't
+    retrieve the archive.
+
+    return a RetrievedArchive
+    """
+    blocks = None
+    if index_key is not None:
+        index_path = _retrieve_key(work_dir, index_key)
+        try:
+            index = load_log_stream_index(
+                log_stream_name_from_index_name(index_path))
+        finally:
+            os.unlink(index_path)
+
+        hostname_pred, log_path_pred = index_block_preds or (None, None, )
+        blocks = select_log_stream_index_blocks(index,
+                                                hostname_pred=hostname_pred,
+                                                log_path_pred=log_path_pred)
+        if len(blocks) == 0:
+            return RetrievedArchive(key, None, blocks)
+
+    return RetrievedArchive(key, _retrieve_key(work_dir, key), blocks)
+
+def generate_retrieved_groups(work_dir,
+                              timestamp_key_dict,
+                              index_key_dict=None,
+                              index_block_preds=None,
+                              prefetch_workers=_default_prefetch_workers,
+                              prefetch_groups=_default_prefetch_groups):
+    """
+    yield a tuple of (timestamp, list of RetrievedArchive) for each group
+    of keys, in timestamp order, while we retrieve the coming groups in
+    prefetch_workers threads.
+
+    The caller owns the files of the group it is given, and must remove
+    them (RetrievedArchive.remove) before it asks for the next group if it
+    wants disk use to stay bounded.
+    """
+    if index_key_dict is None:
+        index_key_dict = dict()
+
+    timestamps = deque(sorted(timestamp_key_dict.keys()))
+    pending = deque()
+
+    executor = ThreadPoolExecutor(max_workers=max(prefetch_workers, 1))
+    try:
+        while len(timestamps) > 0 or len(pending) > 0:
+            while len(timestamps) > 0 and len(pending) <= prefetch_groups:
+                timestamp = timestamps.popleft()
+                futures = [executor.submit(retrieve_archive,
+                                           work_dir,
+                                           key,
+                                           index_key_dict.get(key.name),
+                                           index_block_preds) \
+                           for key in timestamp_key_dict[timestamp]]
+                pending.append((timestamp, futures, ))
+
+            timestamp, futures = pending.popleft()
+            yield timestamp, [future.result() for future in futures]
+    finally:
+        # if the caller stops early, clean up what we retrieved for it
+        for _, futures in pending:
+            for future in futures:
+                if not future.cancel():
+                    try:
+                        future.result().remove()
+                    except Exception:
+                        pass
+        executor.shutdown()
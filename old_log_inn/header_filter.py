@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+header_filter.py
+
+Filtering log records by regular expressions on the hostname, nodename and
+log_path of their headers, and on their content, as zmq_log_file_logger and
+search_and_retrieve do.
+
+A HeaderFilter compiles the regular expressions once. The tests run in order
+and stop at the first one that fails, and the result of each test is cached
+by value: a stream holds many records but few distinct hostnames and
+log_paths, so nearly every test is a dict lookup.
+
+HeaderFilter.decode_header works on the raw header, and rejects what it can
+before decoding it in full:
+
+    a binary header is judged once per producer, from its string table
+    a JSON header is judged on the values we find in its bytes,
+    falling back to a full decode when we can't find them
+
+so only the headers we keep pay for json.loads.
+"""
+import re
+
+from old_log_inn.log_header import header_encoding, \
+    header_encoding_binary, \
+    header_encoding_json, \
+    header_uuid_bytes
+
+# we cache this many distinct values per field, then start over
+_max_cached_values = 10000
+
+# a string value in a header written by json.dumps, without escapes
+# (a value with escapes is judged after the full decode)
+_raw_value_template = r'"{0}": "([^"\\]*)"'
+
+def _compile(regexp):
+    """
+    an absent or empty regular expression matches everything:
+    we don't test it
+    """
+    if regexp is None or regexp == "":
+        return None
+    return re.compile(regexp)
+
+class _ValueTest(object):
+    """
+    a regular expression match on the value of a header field,
+    cached by value
+    """
+    def __init__(self, field, regex, missing_result):
+        self.field = field
+        self.raw_re = re.compile(
+            _raw_value_template.format(field).encode("utf-8"))
+        self._regex = regex
+        self._missing_result = missing_result
+        self._cache = dict()
+        self._raw_cache = dict()
+
+    def match_raw(self, raw_header):
+        """
+        return True or False if we find the value in a raw JSON header,
+        None if we don't
+        """
+        match_object = self.raw_re.search(raw_header)
+        if match_object is None:
+            return None
+        raw_value = match_object.group(1)
+        try:
+            return self._raw_cache[raw_value]
+        except KeyError:
+            pass
+        if len(self._raw_cache) >= _max_cached_values:
+            self._raw_cache.clear()
+        result = self(raw_value.decode("utf-8"))
+        self._raw_cache[raw_value] = result
+        return result
+
+    def __call__(self, value):
+        if value is None:
+            return self._missing_result
+        try:
+            return self._cache[value]
+        except KeyError:
+            pass
+        if len(self._cache) >= _max_cached_values:
+            self._cache.clear()
+        result = self._regex.match(value) is not None
+        self._cache[value] = result
+        return result
+
+class HeaderFilter(object):
+    """
+    host_regexp, node_regexp, log_path_regexp, content_regexp
+        regular expressions which must match (re.match) the field;
+        None or "" to match anything
+
+    missing_nodename_passes
+        whether a header without a nodename passes node_regexp
+    """
+    def __init__(self,
+                 host_regexp=None,
+                 node_regexp=None,
+                 log_path_regexp=None,
+                 content_regexp=None,
+                 missing_nodename_passes=False):
+        self._value_tests = list()
+        self._hostname_test = None
+        self._log_path_test = None
+
+        host_regex = _compile(host_regexp)
+        if host_regex is not None:
+            self._hostname_test = _ValueTest("hostname", host_regex, False)
+            self._value_tests.append(self._hostname_test)
+
+        node_regex = _compile(node_regexp)
+        if node_regex is not None:
+            self._value_tests.append(_ValueTest("nodename",
+                                                node_regex,
+                                                missing_nodename_passes))
+
+        log_path_regex = _compile(log_path_regexp)
+        if log_path_regex is not None:
+            self._log_path_test = _ValueTest("log_path",
+                                             log_path_regex,
+                                             False)
+            self._value_tests.append(self._log_path_test)
+
+        self._content_regex = _compile(content_regexp)
+
+        # the verdict on each binary producer, keyed by uuid bytes,
+        # with the string table values it was reached on
+        self._producer_verdicts = dict()
+
+    @property
+    def hostname_pred(self):
+        """
+        a function of a hostname, None if we don't test hostnames
+        """
+        return self._hostname_test
+
+    @property
+    def log_path_pred(self):
+        """
+        a function of a log_path, None if we don't test log_paths
+        """
+        return self._log_path_test
+
+    def match_header(self, header):
+        """
+        return True if a decoded header passes
+        """
+        for test in self._value_tests:
+            if not test(header.get(test.field)):
+                return False
+        return True
+
+    def match_content(self, content):
+        """
+        return True if the (decoded) content of a record passes
+        """
+        if self._content_regex is None:
+            return True
+        return self._content_regex.match(content) is not None
+
+    def decode_header(self, raw_header, header_decoder):
+        """
+        return the decoded header if it passes,
+        None if it doesn't, or if it is a string table.
+
+        Raises what HeaderDecoder.decode raises.
+        """
+        if len(self._value_tests) == 0:
+            return header_decoder.decode(raw_header)
+
+        encoding = header_encoding(raw_header)
+
+        if encoding == header_encoding_binary:
+            if not self._match_producer(header_uuid_bytes(raw_header),
+                                        header_decoder):
+                return None
+            return header_decoder.decode(raw_header)
+
+        if encoding != header_encoding_json:
+            return header_decoder.decode(raw_header)
+
+        raw_header = bytes(raw_header)
+        judged = True
+        for test in self._value_tests:
+            result = test.match_raw(raw_header)
+            if result is None:
+                judged = False
+            elif not result:
+                return None
+
+        header = header_decoder.decode(raw_header)
+        if not judged and not self.match_header(header):
+            return None
+        return header
+
+    def _match_producer(self, uuid_bytes, header_decoder):
+        values = header_decoder.string_table_values(uuid_bytes)
+        if values is None:
+            # let the decoder complain
+            return True
+        try:
+            cached_values, verdict = self._producer_verdicts[uuid_bytes]
+        except KeyError:
+            pass
+        else:
+            if cached_values is values:
+                return verdict
+        verdict = self.match_header(values)
+        self._producer_verdicts[uuid_bytes] = (values, verdict, )
+        return verdict
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+hop_latency_report.py
+
+A program to report the latency of traced log messages, as saved by
+zmq_log_stream_writer (--hop-latency-path), over the writer's rolling window.
+
+For each hop (origin-forwarder, forwarder-aggregator, aggregator-writer and
+the total, from the producer to the disk) we print the message count and the
+50th, 99th and 99.9th percentile latency in milliseconds: first for all
+source hosts together, then for each source host.
+
+Give --repeat-interval to print a new report every so many seconds.
+See hop_trace.py for how messages are traced.
+"""
+import argparse
+import logging
+import sys
+import time
+
+from old_log_inn.hop_trace import HopTraceError, \
+    bucket_quantile, \
+    load_hop_latency_window, \
+    total_hop_name
+
+_log_format_template = '%(asctime)s %(levelname)-8s %(name)-20s: %(message)s'
+_log = logging.getLogger("main")
+_quantiles = [("p50", 0.5, ), ("p99", 0.99, ), ("p999", 0.999, ), ]
+_all_hosts = "*"
+
+def _parse_commandline():
+    parser = argparse.ArgumentParser(description='hop_latency_report')
+    parser.add_argument("--path", dest="hop_latency_path",
+                        help="hop latency file saved by the writer")
+    parser.add_argument("--host", dest="hosts", action="append",
+                        help="report only this source host, may be repeated")
+    parser.add_argument("--repeat-interval", dest="repeat_interval",
+                        type=float, default=0.0,
+                        help="seconds between reports (0 for one report)")
+    parser.add_argument("--verbose", dest="verbose", action="store_true",
+                        default=False)
+
+    return parser.parse_args()
+
+def _initialize_logging(verbose):
+    """
+    log to stdout for debugging
+    """
+    handler = logging.StreamHandler(stream=sys.stdout)
+    formatter = logging.Formatter(_log_format_template)
+    handler.setFormatter(formatter)
+    logging.root.addHandler(handler)
+    log_level = (logging.DEBUG if verbose else logging.WARN)
+    logging.root.setLevel(log_level)
+
+def _hop_sort_key(hop_name):
+    # the total goes after the hops it is made of
+    return (hop_name == total_hop_name, hop_name, )
+
+def summarize_hop_latency(bounds, histograms, hosts=None):
+    """
+    bounds
+        the upper bounds of the histogram buckets (seconds)
+
+    histograms
+        a dict of counts lists, by (hop name, host)
+
+    hosts
+        the hosts to report (default all of them)
+
+    return a list of (host, hop name, count, dict of quantile seconds),
+    for all hosts together (host '*'), then for each host
+    """
+    combined = dict()
+    by_host = dict()
+    for (hop_name, host), counts in histograms.items():
+        if hosts is not None and not host in hosts:
+            continue
+        by_host[(host, hop_name, )] = counts
+        combined_counts = combined.setdefault((_all_hosts, hop_name, ),
+                                              [0] * len(counts))
+        for index, count in enumerate(counts):
+            combined_counts[index] += count
+
+    summary = list()
+    for entries in [combined, by_host, ]:
+        for host, hop_name in sorted(entries.keys(),
+                                     key=lambda k: (k[0],
+                                                    _hop_sort_key(k[1]), )):
+            counts = entries[(host, hop_name, )]
+            quantiles = dict((name, bucket_quantile(bounds, counts, q), ) \
+                             for (name, q) in _quantiles)
+            summary.append((host, hop_name, sum(counts), quantiles, ))
+    return summary
+
+def _format_milliseconds(seconds):
+    if seconds is None:
+        return "-"
+    return "{0:.3f}".format(seconds * 1000.0)
+
+def _print_report(window, summary):
+    print("hop latency (ms) over {0:.0f}s to {1}".format(
+        window["window"],
+        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(window["time"]))))
+    print("{0:<24} {1:<24} {2:>10} {3:>10} {4:>10} {5:>10}".format(
+        "host", "hop", "count", *[name for (name, _) in _quantiles]))
+    for host, hop_name, count, quantiles in summary:
+        print("{0:<24} {1:<24} {2:>10} {3:>10} {4:>10} {5:>10}".format(
+            host,
+            hop_name,
+            count,
+            *[_format_milliseconds(quantiles[name]) \
+              for (name, _) in _quantiles]))
+    sys.stdout.flush()
+
+def main():
+    """
+    main entry point
+    """
+    args = _parse_commandline()
+
+    _initialize_logging(args.verbose)
+
+    while True:
+        try:
+            window, histograms = \
+                load_hop_latency_window(args.hop_latency_path)
+        except (IOError, OSError, ValueError, HopTraceError):
+            instance = sys.exc_info()[1]
+            _log.error("unable to load {0}: {1}".format(
+                args.hop_latency_path, instance))
+            return 1
+
+        _print_report(window, summarize_hop_latency(window["bounds"],
+                                                    histograms,
+                                                    args.hosts))
+        if args.repeat_interval <= 0.0:
+            break
+        try:
+            time.sleep(args.repeat_interval)
+        except KeyboardInterrupt:
+            break
+        print("")
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
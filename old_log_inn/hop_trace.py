@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+hop_trace.py
+
+Hop timestamps, for measuring how long log records take to get from the
+producer to the disk.
+
+A relay (forwarder, aggregator) may add a trailer frame to a message, after
+its last frame:
+
+    hop trailer marker, then for each stamp: hop (1 byte), time (double)
+
+A relay starts a trailer on every Nth message it relays (--hop-trace-every),
+and stamps every message that already has one, so a message is sampled once,
+at the first relay that traces, and followed from there to the disk. A
+receiver that doesn't care about the trailer just drops it.
+
+The writer takes the time the producer made the record from its header (the
+first record of a batch), and adds its own stamp once it has written the
+message. The time between each pair of stamps is a hop, named for the stamps
+at its ends (forwarder-aggregator, say), and the time from the producer to
+the writer is the total. A HopLatencyWindow keeps a histogram of each hop, by
+source host, over a rolling window, and saves it for hop_latency_report.py.
+
+The stamps come from the clocks of different machines: a hop between hosts
+is only as accurate as their clocks agree.
+"""
+from bisect import bisect_left
+from collections import deque
+import json
+import os
+import struct
+import time
+import zlib
+
+import zmq
+
+from old_log_inn.log_batch import LogBatchError, \
+    is_batch_marker, \
+    unpack_batch_block
+from old_log_inn.log_header import LogHeaderError, header_timestamp
+from old_log_inn.log_topic import topic_separator
+from old_log_inn.zlib_dictionary import ZlibDictionaryError
+
+_hop_trailer_marker = b"\x00old_log_inn.hops"
+_hop_format = "!Bd"
+_hop_size = struct.calcsize(_hop_format)
+_window_version = 1
+
+hop_origin = 0
+hop_forwarder = 1
+hop_aggregator = 2
+hop_writer = 3
+hop_names = {hop_origin     : "origin",
+             hop_forwarder  : "forwarder",
+             hop_aggregator : "aggregator",
+             hop_writer     : "writer", }
+total_hop_name = "total"
+
+# seconds: 20 buckets a decade from 10 microseconds to 1000 seconds
+latency_bounds = tuple(1e-5 * 10.0 ** (n / 20.0) for n in range(161))
+
+class HopTraceError(Exception):
+    pass
+
+def _frame_buffer(frame):
+    if isinstance(frame, zmq.Frame):
+        return frame.buffer
+    return frame
+
+def is_hop_trailer(frame):
+    """
+    return True if a frame is a hop trailer
+    """
+    return bytes(frame[:len(_hop_trailer_marker)]) == _hop_trailer_marker
+
+def split_hop_trailer(frames, expected_count):
+    """
+    frames
+        the frames of a message, perhaps with a hop trailer
+
+    expected_count
+        the number of frames the message has without a trailer
+
+    return a tuple of (frames without the trailer, trailer or None)
+    """
+    if len(frames) > expected_count and \
+        is_hop_trailer(_frame_buffer(frames[-1])):
+        return frames[:-1], frames[-1]
+    return frames, None
+
+def add_hop_stamp(trailer, hop, timestamp):
+    """
+    return the trailer (a new one if trailer is None) with a stamp added
+    """
+    if trailer is None:
+        trailer = _hop_trailer_marker
+    return b"".join([bytes(_frame_buffer(trailer)),
+                     struct.pack(_hop_format, hop, timestamp), ])
+
+def unpack_hop_trailer(trailer):
+    """
+    return the list of (hop, timestamp) stamps in a trailer
+    """
+    trailer = _frame_buffer(trailer)
+    if not is_hop_trailer(trailer):
+        raise HopTraceError("not a hop trailer")
+    start = len(_hop_trailer_marker)
+    if (len(trailer) - start) % _hop_size != 0:
+        raise HopTraceError("truncated hop trailer {0}".format(len(trailer)))
+    return [struct.unpack_from(_hop_format, trailer, offset) \
+            for offset in range(start, len(trailer), _hop_size)]
+
+class HopStamper(object):
+    """
+    add a relay's stamp to the messages it relays
+    """
+    def __init__(self, hop, trace_every=0):
+        """
+        hop
+            which relay we are: hop_forwarder, hop_aggregator
+
+        trace_every
+            start a trailer on every trace_every message that doesn't
+            have one, 0 for none
+        """
+        self._hop = hop
+        self._trace_every = trace_every
+        self._countdown = trace_every
+        self.started_count = 0
+        self.stamped_count = 0
+
+    def stamp(self, frames, expected_count, current_time=None):
+        """
+        frames
+            the frames of a message, perhaps with a hop trailer
+
+        expected_count
+            the number of frames the message has without a trailer
+
+        return the frames to send on: the frames we were given,
+        or a new list ending with the stamped trailer
+        """
+        message_frames, trailer = split_hop_trailer(frames, expected_count)
+        if trailer is None:
+            if self._trace_every <= 0:
+                return frames
+            self._countdown -= 1
+            if self._countdown > 0:
+                return frames
+            self._countdown = self._trace_every
+            self.started_count += 1
+
+        if current_time is None:
+            current_time = time.time()
+        self.stamped_count += 1
+        return list(message_frames) + \
+            [add_hop_stamp(trailer, self._hop, current_time), ]
+
+def message_origin_time(frames, decompress):
+    """
+    return the timestamp of the first record of a message (trailer and topic
+    excluded), or None if it has no records, only string tables
+    """
+    if not is_batch_marker(frames[0]):
+        return header_timestamp(decompress(frames[0]))
+    for raw_header in unpack_batch_block(decompress(frames[1])):
+        timestamp = header_timestamp(raw_header)
+        if timestamp is not None:
+            return timestamp
+    return None
+
+def message_hops(trailer, origin_time, end_time):
+    """
+    return a list of (hop name, seconds) for a traced message:
+    each hop between its stamps, then the total
+    """
+    stamps = [(hop_origin, origin_time, ), ] + \
+        unpack_hop_trailer(trailer) + \
+        [(hop_writer, end_time, ), ]
+    hops = list()
+    for (start_hop, start_time), (end_hop, stamp_time) in \
+        zip(stamps, stamps[1:]):
+        hop_name = "-".join([hop_names.get(start_hop, str(start_hop)),
+                             hop_names.get(end_hop, str(end_hop)), ])
+        hops.append((hop_name, stamp_time - start_time, ))
+    hops.append((total_hop_name, end_time - origin_time, ))
+    return hops
+
+def bucket_quantile(bounds, counts, quantile):
+    """
+    return the upper bound of the bucket holding the given quantile
+    (0.0 to 1.0) of the counts, or None if there are no counts
+    """
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = quantile * total
+    cumulative_count = 0
+    for index, count in enumerate(counts):
+        cumulative_count += count
+        if cumulative_count >= rank and count > 0:
+            if index < len(bounds):
+                return bounds[index]
+            return float("inf")
+    return float("inf")
+
+class HopLatencyWindow(object):
+    """
+    histograms of hop latency, by hop and source host,
+    over a rolling window of time
+    """
+    def __init__(self, window_seconds=300.0, slice_seconds=10.0,
+                 bounds=latency_bounds):
+        """
+        window_seconds
+            how far back we look
+
+        slice_seconds
+            we forget what we saw a slice at a time
+        """
+        self._window_seconds = window_seconds
+        self._slice_seconds = slice_seconds
+        self._bounds = bounds
+        # (slice start time, dict of counts lists by (hop, host))
+        self._slices = deque()
+
+    def observe(self, hop_name, host, latency, current_time=None):
+        if current_time is None:
+            current_time = time.time()
+        histograms = self._current_slice(current_time)
+        key = (hop_name, host, )
+        counts = histograms.get(key)
+        if counts is None:
+            counts = [0] * (len(self._bounds) + 1)
+            histograms[key] = counts
+        counts[bisect_left(self._bounds, latency)] += 1
+
+    def counts(self, current_time=None):
+        """
+        return a dict of counts lists, by (hop name, host),
+        for the window up to current_time
+        """
+        if current_time is None:
+            current_time = time.time()
+        self._expire(current_time)
+        totals = dict()
+        for _, histograms in self._slices:
+            for key, counts in histograms.items():
+                total_counts = totals.get(key)
+                if total_counts is None:
+                    totals[key] = list(counts)
+                    continue
+                for index, count in enumerate(counts):
+                    total_counts[index] += count
+        return totals
+
+    def to_dict(self, current_time=None):
+        """
+        return the window as a dict that json can store
+        (counts are sparse lists of [bucket index, count])
+        """
+        if current_time is None:
+            current_time = time.time()
+        latencies = list()
+        for (hop_name, host), counts in sorted(
+            self.counts(current_time).items()):
+            latencies.append({"hop"     : hop_name,
+                              "host"    : host,
+                              "counts"  : [[index, count] for (index, count) \
+                                           in enumerate(counts) if count > 0],
+                             })
+        return {"version"   : _window_version,
+                "time"      : current_time,
+                "window"    : self._window_seconds,
+                "bounds"    : list(self._bounds),
+                "latencies" : latencies, }
+
+    def save(self, path, current_time=None):
+        """
+        write the window to path (json), replacing it whole
+        """
+        work_path = "{0}.tmp".format(path)
+        with open(work_path, "w") as output_file:
+            json.dump(self.to_dict(current_time), output_file)
+        os.rename(work_path, path)
+
+    def _current_slice(self, current_time):
+        slice_start = current_time - (current_time % self._slice_seconds)
+        if len(self._slices) == 0 or self._slices[-1][0] < slice_start:
+            self._slices.append((slice_start, dict(), ))
+            self._expire(current_time)
+        return self._slices[-1][1]
+
+    def _expire(self, current_time):
+        while len(self._slices) > 0 and \
+            self._slices[0][0] + self._slice_seconds <= \
+                current_time - self._window_seconds:
+            self._slices.popleft()
+
+def load_hop_latency_window(path):
+    """
+    return a tuple of (window dict as saved,
+    dict of counts lists by (hop name, host))
+    """
+    with open(path) as input_file:
+        window = json.load(input_file)
+    if window.get("version") != _window_version:
+        raise HopTraceError("unknown hop latency version {0}".format(
+            window.get("version")))
+    bucket_count = len(window["bounds"]) + 1
+    histograms = dict()
+    for entry in window["latencies"]:
+        counts = [0] * bucket_count
+        for index, count in entry["counts"]:
+            counts[index] = count
+        histograms[(entry["hop"], entry["host"], )] = counts
+    return window, histograms
+
+_trace_errors = (HopTraceError,
+                 LogBatchError,
+                 LogHeaderError,
+                 ZlibDictionaryError,
+                 zlib.error,
+                 ValueError,
+                 KeyError, )
+
+class HopLatencyTracker(object):
+    """
+    turn the traced messages a writer receives into latency histograms
+    """
+    def __init__(self, decompress, window, metrics=None):
+        """
+        decompress
+            the function that decompresses message frames
+
+        window
+            a HopLatencyWindow
+
+        metrics
+            a MetricsRegistry for a histogram of each hop (all hosts)
+        """
+        self._decompress = decompress
+        self._window = window
+        self._metrics = metrics
+        self._histograms = dict()
+        self.error_count = 0
+
+    @property
+    def window(self):
+        return self._window
+
+    def observe(self, topic, frames, trailer, end_time=None):
+        """
+        topic
+            the topic the message came under: we take the source host
+            from it
+
+        frames
+            the frames of the message (topic and trailer excluded)
+
+        trailer
+            the message's hop trailer
+
+        end_time
+            when we finished with the message
+        """
+        if end_time is None:
+            end_time = time.time()
+        try:
+            origin_time = message_origin_time(frames, self._decompress)
+            if origin_time is None:
+                return
+            hops = message_hops(trailer, origin_time, end_time)
+            host = bytes(topic).decode("utf-8").split(topic_separator)[0]
+        except _trace_errors:
+            self.error_count += 1
+            return
+
+        for hop_name, latency in hops:
+            self._window.observe(hop_name, host, latency, end_time)
+            if self._metrics is not None:
+                self._histogram(hop_name).observe(latency)
+
+    def _histogram(self, hop_name):
+        histogram = self._histograms.get(hop_name)
+        if histogram is None:
+            histogram = self._metrics.histogram(
+                "hop_latency_seconds",
+                "seconds between the stamps of traced messages",
+                {"hop" : hop_name})
+            self._histograms[hop_name] = histogram
+        return histogram
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+log_batch.py
+
+Batched multi-record framing for log messages.
+
+A single log message has two ZMQ frames: a compressed header and a compressed
+body. A batch carries many log records in a single multipart message of three
+frames:
+
+    batch marker
+    compressed header block
+    compressed body block
+
+Each block is the concatenation of its items, every item preceded by its
+length packed as an unsigned 32 bit int. The items in the header block are
+exactly the headers that single messages would have carried, so the per
+record uuid and sequence survive for downstream de-duplication.
+"""
+import struct
+import zlib
+
+_batch_marker = b"\x00old_log_inn.batch"
+_item_length_format = "!I"
+_item_length_size = struct.calcsize(_item_length_format)
+
+class LogBatchError(Exception):
+    pass
+
+def is_batch_marker(frame):
+    """
+    return True if the (first) frame of a message marks a batch
+    """
+    return frame == _batch_marker
+
+def message_frame_count(first_frame):
+    """
+    return the number of frames we expect in a log message,
+    given its first frame (topic excluded)
+    """
+    return 3 if is_batch_marker(first_frame) else 2
+
+def _pack_block(items):
+    accum = list()
+    for item in items:
+        accum.append(struct.pack(_item_length_format, len(item)))
+        accum.append(item)
+    return b"".join(accum)
+
+def _unpack_block(block):
+    items = list()
+    offset = 0
+    while offset < len(block):
+        if offset + _item_length_size > len(block):
+            raise LogBatchError("truncated item length at {0}".format(offset))
+        (item_length, ) = struct.unpack_from(_item_length_format,
+                                             block,
+                                             offset)
+        offset += _item_length_size
+        if offset + item_length > len(block):
+            raise LogBatchError("truncated item at {0} expected {1}".format(
+                offset, item_length))
+        items.append(block[offset:offset+item_length])
+        offset += item_length
+    return items
+
+def unpack_batch_block(block):
+    """
+    return the list of items in an uncompressed header or body block
+    """
+    return _unpack_block(block)
+
+def batch_block_size(item_sizes):
+    """
+    return the size of an uncompressed block of items of the given sizes
+    """
+    return sum(_item_length_size + item_size for item_size in item_sizes)
+
+def pack_batch(headers, bodies, compress=zlib.compress):
+    """
+    headers
+        a list of uncompressed headers (bytes)
+
+    bodies
+        a list of uncompressed bodies (bytes), one for each header
+
+    compress
+        the function that compresses each block
+
+    return the list of frames for a batch message
+    """
+    assert len(headers) == len(bodies), (len(headers), len(bodies), )
+    return [_batch_marker,
+            compress(_pack_block(headers)),
+            compress(_pack_block(bodies)), ]
+
+def unpack_batch(compressed_header_block, 
+                 compressed_body_block, 
+                 decompress=zlib.decompress):
+    """
+    return a list of (header, body) tuples of uncompressed bytes
+    """
+    headers = _unpack_block(decompress(compressed_header_block))
+    bodies = _unpack_block(decompress(compressed_body_block))
+    if len(headers) != len(bodies):
+        raise LogBatchError("{0} headers but {1} bodies".format(
+            len(headers), len(bodies)))
+    return list(zip(headers, bodies))
+
+def unpack_message_headers(frames, decompress=zlib.decompress):
+    """
+    return the list of uncompressed headers of a log message
+    (topic excluded), without decompressing its body
+    """
+    if is_batch_marker(frames[0]):
+        return unpack_batch_block(decompress(frames[1]))
+    return [decompress(frames[0]), ]
+
+def unpack_message(frames, decompress=zlib.decompress):
+    """
+    frames
+        the frames of a log message (topic excluded), either a single
+        log record or a batch
+
+    decompress
+        the function that decompresses each frame
+
+    return a list of (header, body) tuples of uncompressed bytes
+    """
+    if is_batch_marker(frames[0]):
+        _, compressed_header_block, compressed_body_block = frames
+        return unpack_batch(compressed_header_block, 
+                            compressed_body_block,
+                            decompress)
+
+    compressed_header, compressed_body = frames
+    return [(decompress(compressed_header), decompress(compressed_body), ), ]
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""
+log_file_writer.py
+
+Buffered, size rotated, plain text log files, for zmq_log_file_logger.
+
+The files rotate as logging.handlers.RotatingFileHandler rotates them: when
+a line would take a file to max_bytes, the file is renamed name.1 (name.1
+becomes name.2, and so on, keeping keep backups) and a new file is started.
+With max_bytes or keep 0, a file never rotates.
+
+Unlike a handler, we don't write and flush every line. Each file buffers its
+lines and writes them with one call, once it has flush_bytes of them or the
+oldest has waited flush_interval seconds (the caller must call
+check_for_flush now and then for this to happen while no lines arrive). We
+count the size of each file as we write, rather than asking the file.
+
+A rotation renames the full file out of the way (one rename) and starts the
+new file at once. Moving the backups up is left to a BackupRotator thread,
+so the caller doesn't wait on that, or on the disk.
+"""
+from collections import OrderedDict
+import os
+import os.path
+import queue
+import threading
+import time
+
+_default_flush_bytes = 64 * 1024
+_default_flush_interval = 1.0
+
+def _backup_path(path, index):
+    return "{0}.{1}".format(path, index)
+
+def shift_backups(rotated_path, path, keep):
+    """
+    move the backups of path up one (dropping the oldest),
+    and make rotated_path (the file just rotated out) the first
+    """
+    for index in range(keep - 1, 0, -1):
+        source_path = _backup_path(path, index)
+        if os.path.exists(source_path):
+            os.rename(source_path, _backup_path(path, index + 1))
+    os.rename(rotated_path, _backup_path(path, 1))
+
+class BackupRotator(threading.Thread):
+    """
+    move backups up in the background, in the order we are given them
+    """
+    def __init__(self):
+        super(BackupRotator, self).__init__(name="BackupRotator")
+        self.daemon = True
+        self._queue = queue.Queue()
+        self.error_count = 0
+
+    def submit(self, rotated_path, path, keep):
+        self._queue.put((rotated_path, path, keep, ))
+
+    def run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                break
+            try:
+                shift_backups(*entry)
+            except OSError:
+                self.error_count += 1
+
+    def close(self):
+        """
+        finish the work we have been given
+        """
+        self._queue.put(None)
+        self.join()
+
+class RotatingLogFile(object):
+    """
+    a plain text log file, written in buffered batches, rotated by size
+    """
+    def __init__(self, path, max_bytes, keep, rotator=None,
+                 flush_bytes=_default_flush_bytes):
+        """
+        rotator
+            a BackupRotator to move the backups up, None to do it here
+        """
+        self._path = path
+        self._max_bytes = max_bytes
+        self._keep = keep
+        self._rotator = rotator
+        self._flush_bytes = flush_bytes
+        self._rotation_count = 0
+
+        self._buffer = list()
+        self._buffer_size = 0
+        self._open()
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def size(self):
+        """
+        the size of the file, including the lines we have yet to write
+        """
+        return self._size
+
+    @property
+    def buffer_size(self):
+        return self._buffer_size
+
+    def write(self, line):
+        """
+        add a line (without its newline) to the file,
+        rotating first if it would take the file to max_bytes
+
+        return True if we wrote the buffer out
+        """
+        data = "{0}\n".format(line).encode("utf-8")
+        if self._max_bytes > 0 and self._keep > 0 and self._size > 0 and \
+            self._size + len(data) >= self._max_bytes:
+            self._rotate()
+
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        self._size += len(data)
+        if self._buffer_size >= self._flush_bytes:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """
+        write out the buffered lines
+        """
+        if self._buffer_size == 0:
+            return
+        self._file.write(b"".join(self._buffer))
+        self._buffer = list()
+        self._buffer_size = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def _open(self):
+        # unbuffered: we write each batch with one call
+        self._file = open(self._path, "ab", buffering=0)
+        self._size = os.fstat(self._file.fileno()).st_size
+
+    def _rotate(self):
+        self.close()
+        self._rotation_count += 1
+        rotated_path = "{0}.rotating-{1}".format(self._path,
+                                                 self._rotation_count)
+        os.rename(self._path, rotated_path)
+        self._open()
+        if self._rotator is None:
+            shift_backups(rotated_path, self._path, self._keep)
+        else:
+            self._rotator.submit(rotated_path, self._path, self._keep)
+
+class LogFileWriter(object):
+    """
+    the log files in a directory, by name
+    """
+    def __init__(self, log_dir, max_bytes, keep,
+                 flush_bytes=_default_flush_bytes,
+                 flush_interval=_default_flush_interval,
+                 background_rotation=True):
+        """
+        flush_bytes
+            write a file's lines once it has this many bytes of them
+            (0 for every line)
+
+        flush_interval
+            write a file's lines once the oldest is this many seconds old
+        """
+        self._log_dir = log_dir
+        self._max_bytes = max_bytes
+        self._keep = keep
+        self._flush_bytes = flush_bytes
+        self._flush_interval = flush_interval
+        self._files = dict()
+        # files with buffered lines, by name, oldest first,
+        # with the time their oldest line must be written by
+        self._pending = OrderedDict()
+
+        self._rotator = None
+        if background_rotation:
+            self._rotator = BackupRotator()
+            self._rotator.start()
+
+    @property
+    def file_count(self):
+        return len(self._files)
+
+    @property
+    def rotation_error_count(self):
+        if self._rotator is None:
+            return 0
+        return self._rotator.error_count
+
+    def write(self, log_filename, line, current_time=None):
+        """
+        add a line to the named file, opening it if we must
+        """
+        log_file = self._files.get(log_filename)
+        if log_file is None:
+            log_file = RotatingLogFile(os.path.join(self._log_dir,
+                                                    log_filename),
+                                       self._max_bytes,
+                                       self._keep,
+                                       self._rotator,
+                                       self._flush_bytes)
+            self._files[log_filename] = log_file
+
+        if log_file.write(line):
+            self._pending.pop(log_filename, None)
+        elif not log_filename in self._pending:
+            if current_time is None:
+                current_time = time.time()
+            self._pending[log_filename] = current_time + self._flush_interval
+
+    def check_for_flush(self, current_time=None):
+        """
+        write out the files whose oldest line has waited flush_interval
+        """
+        if len(self._pending) == 0:
+            return
+        if current_time is None:
+            current_time = time.time()
+        while len(self._pending) > 0:
+            log_filename, deadline = next(iter(self._pending.items()))
+            if deadline > current_time:
+                break
+            del self._pending[log_filename]
+            self._files[log_filename].flush()
+
+    def poll_timeout(self, timeout, current_time=None):
+        """
+        return the poll timeout (seconds) that lets us write the next
+        file on time
+        """
+        if len(self._pending) == 0:
+            return timeout
+        if current_time is None:
+            current_time = time.time()
+        deadline = next(iter(self._pending.values()))
+        return max(0.0, min(timeout, deadline - current_time))
+
+    def close(self):
+        """
+        write out and close every file, and finish the rotations
+        """
+        for log_file in self._files.values():
+            log_file.close()
+        self._files.clear()
+        self._pending.clear()
+        if self._rotator is not None:
+            self._rotator.close()
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+"""
+log_header.py
+
+Encoding and decoding of log record headers.
+
+A header is either a JSON object (the original format) or a compact binary
+record. The first byte of an uncompressed header tells them apart:
+
+    '{'     a JSON object
+    0x01    a binary record header
+    0x02    a binary string table
+
+A binary record header has fixed width fields:
+
+    version (0x01), uuid (16 bytes), pid, sequence, timestamp
+
+perhaps followed by the size of the uncompressed body, which a producer
+adds so a writer can store the body without decompressing it (a JSON header
+carries it as "body_size").
+
+The strings that describe a producer (hostname, nodename, log_path) never
+change, so rather than repeating them in every header, the producer sends them
+now and then in a string table keyed by its uuid:
+
+    version (0x02), uuid (16 bytes), hostname, nodename, log_path
+
+each string packed as a 2 byte length followed by utf-8. An empty nodename
+means the producer has none. A string table travels as an ordinary log
+record with an empty body.
+
+HeaderDecoder turns any of these into the same python dict, remembering the
+string tables it has seen.
+"""
+import json
+import re
+import struct
+import sys
+import uuid
+
+header_encoding_json = 0
+header_encoding_binary = 1
+header_encoding_string_table = 2
+header_encodings = [header_encoding_json,
+                    header_encoding_binary,
+                    header_encoding_string_table, ]
+
+_binary_header_format = "!B16sIQd"
+_binary_header_size = struct.calcsize(_binary_header_format)
+_body_size_format = "!I"
+_binary_header_body_size_size = \
+    _binary_header_size + struct.calcsize(_body_size_format)
+_string_table_prefix_format = "!B16s"
+_string_table_prefix_size = struct.calcsize(_string_table_prefix_format)
+_string_length_format = "!H"
+_string_length_size = struct.calcsize(_string_length_format)
+_uuid_slice = slice(1, 17)
+_json_uuid_re = re.compile(br'"uuid": "([0-9a-f]{32})"')
+_json_sequence_re = re.compile(br'"sequence": ([0-9]+)')
+_json_body_size_re = re.compile(br'"body_size": ([0-9]+)')
+
+class LogHeaderError(Exception):
+    pass
+
+class UnknownStringTableError(LogHeaderError):
+    pass
+
+def header_encoding(raw_header):
+    """
+    return the encoding of an uncompressed header
+    """
+    first_byte = raw_header[0] if len(raw_header) > 0 else None
+    if first_byte == header_encoding_binary:
+        return header_encoding_binary
+    if first_byte == header_encoding_string_table:
+        return header_encoding_string_table
+    return header_encoding_json
+
+def header_uuid_bytes(raw_header):
+    """
+    return the 16 byte uuid of a binary header or string table
+    """
+    return bytes(raw_header[_uuid_slice])
+
+def encode_binary_header(uuid_bytes, pid, sequence, timestamp,
+                         body_size=None):
+    """
+    return a binary record header,
+    ending with the body size if we are given it
+    """
+    header = struct.pack(_binary_header_format,
+                         header_encoding_binary,
+                         uuid_bytes,
+                         pid,
+                         sequence,
+                         timestamp)
+    if body_size is None:
+        return header
+    return header + struct.pack(_body_size_format, body_size)
+
+def _unpack_binary_header(raw_header):
+    """
+    return the tuple of fixed fields of a binary record header,
+    without the body size
+    """
+    if len(raw_header) == _binary_header_body_size_size:
+        raw_header = raw_header[:_binary_header_size]
+    elif len(raw_header) != _binary_header_size:
+        raise LogHeaderError("invalid binary header size {0}".format(
+            len(raw_header)))
+    return struct.unpack(_binary_header_format, raw_header)
+
+def encode_string_table(uuid_bytes, hostname, nodename, log_path):
+    """
+    return a binary string table
+    """
+    accum = [struct.pack(_string_table_prefix_format,
+                         header_encoding_string_table,
+                         uuid_bytes), ]
+    for value in [hostname, nodename or "", log_path, ]:
+        encoded_value = value.encode("utf-8")
+        accum.append(struct.pack(_string_length_format, len(encoded_value)))
+        accum.append(encoded_value)
+    return b"".join(accum)
+
+def _decode_string_table(raw_header):
+    offset = _string_table_prefix_size
+    values = list()
+    for _ in range(3):
+        if offset + _string_length_size > len(raw_header):
+            raise LogHeaderError("truncated string table")
+        (length, ) = struct.unpack_from(_string_length_format,
+                                        raw_header,
+                                        offset)
+        offset += _string_length_size
+        if offset + length > len(raw_header):
+            raise LogHeaderError("truncated string table")
+        value = bytes(raw_header[offset:offset+length]).decode("utf-8")
+        values.append(sys.intern(value))
+        offset += length
+    return values
+
+def header_timestamp(raw_header):
+    """
+    return the timestamp of an uncompressed record header,
+    or None if it is a string table,
+    without needing the producer's string table
+    """
+    encoding = header_encoding(raw_header)
+
+    if encoding == header_encoding_json:
+        return json.loads(bytes(raw_header).decode("utf-8"))["timestamp"]
+
+    if encoding == header_encoding_string_table:
+        return None
+
+    return _unpack_binary_header(raw_header)[4]
+
+def header_sequence(raw_header):
+    """
+    return a tuple of (uuid bytes, sequence) of an uncompressed record
+    header, or None if it is a string table,
+    without needing the producer's string table
+    """
+    encoding = header_encoding(raw_header)
+
+    if encoding == header_encoding_json:
+        raw_header = bytes(raw_header)
+        uuid_match = _json_uuid_re.search(raw_header)
+        sequence_match = _json_sequence_re.search(raw_header)
+        if uuid_match is not None and sequence_match is not None:
+            return (bytes.fromhex(uuid_match.group(1).decode("ascii")),
+                    int(sequence_match.group(1)), )
+        # not as our producers write it: take the slow road
+        header = json.loads(raw_header.decode("utf-8"))
+        return (uuid.UUID(hex=header["uuid"]).bytes, header["sequence"], )
+
+    if encoding == header_encoding_string_table:
+        return None
+
+    _, uuid_bytes, _, sequence, _ = _unpack_binary_header(raw_header)
+    return (uuid_bytes, sequence, )
+
+def header_body_size(raw_header):
+    """
+    return the size of the uncompressed body that goes with an uncompressed
+    header, or None if the header doesn't say (a producer that doesn't add
+    it, or a JSON header not as our producers write it).
+    A string table's body is always empty.
+    """
+    encoding = header_encoding(raw_header)
+
+    if encoding == header_encoding_json:
+        body_size_match = _json_body_size_re.search(bytes(raw_header))
+        if body_size_match is None:
+            return None
+        return int(body_size_match.group(1))
+
+    if encoding == header_encoding_string_table:
+        return 0
+
+    if len(raw_header) != _binary_header_body_size_size:
+        return None
+    (body_size, ) = struct.unpack_from(_body_size_format,
+                                       raw_header,
+                                       _binary_header_size)
+    return body_size
+
+class HeaderDecoder(object):
+    """
+    decode headers of any encoding into dicts,
+    remembering the string tables of binary producers
+    """
+    def __init__(self):
+        self._string_tables = dict()
+
+    @property
+    def string_tables(self):
+        """
+        a dict of the raw string tables we know, keyed by uuid bytes
+        """
+        return dict((k, v[0], ) for (k, v) in self._string_tables.items())
+
+    def add_string_table(self, raw_header):
+        """
+        remember a string table
+        """
+        uuid_bytes = header_uuid_bytes(raw_header)
+        existing = self._string_tables.get(uuid_bytes)
+        if existing is not None and existing[0] == raw_header:
+            return
+
+        hostname, nodename, log_path = _decode_string_table(raw_header)
+        base = {"hostname"  : hostname,
+                "uuid"      : sys.intern(uuid.UUID(bytes=uuid_bytes).hex),
+                "log_path"  : log_path, }
+        if nodename != "":
+            base["nodename"] = nodename
+        self._string_tables[uuid_bytes] = (bytes(raw_header), base, )
+
+    def string_table_values(self, uuid_bytes):
+        """
+        return a dict of the strings (hostname, nodename, log_path, uuid)
+        of a binary producer, or None if we don't have its table.
+        The dict is shared: don't change it. It is replaced, not changed,
+        when the producer's table changes.
+        """
+        entry = self._string_tables.get(uuid_bytes)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def decode(self, raw_header):
+        """
+        return the header as a dict,
+        or None if it is a string table (which we remember)
+        """
+        encoding = header_encoding(raw_header)
+
+        if encoding == header_encoding_json:
+            return json.loads(bytes(raw_header).decode("utf-8"))
+
+        if encoding == header_encoding_string_table:
+            self.add_string_table(raw_header)
+            return None
+
+        _, uuid_bytes, pid, sequence, timestamp = \
+            _unpack_binary_header(raw_header)
+        try:
+            _, base = self._string_tables[uuid_bytes]
+        except KeyError:
+            raise UnknownStringTableError("no string table for {0}".format(
+                uuid.UUID(bytes=uuid_bytes).hex))
+
+        header = dict(base)
+        header["pid"] = pid
+        header["sequence"] = sequence
+        header["timestamp"] = timestamp
+        return header
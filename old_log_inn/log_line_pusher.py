@@ -5,6 +5,24 @@ log_line_pusher.py
 An object that pushes individual log lines over zeromq.
 This object is intended for use by both the ZMQPushLogHandler and
 the Stdin to ZMQ Push Log Handler.
+
+Batching is opt in: if batch_size is given, log lines are gathered until 
+there are batch_size of them, or until batch_interval seconds have passed 
+since the first one, and then sent together as a single batch message
+(see log_batch.py)
+
+If the ENV variable PYTHON_ZMQ_LOG_ZDICT names a zlib dictionary file,
+headers and bodies are compressed with that preset dictionary
+(see zlib_dictionary.py)
+
+Headers are JSON by default. With header_encoding 'binary' (or the ENV 
+variable PYTHON_ZMQ_LOG_HEADER_ENCODING=binary) they are compact binary 
+records, and the producer's strings go out in a string table 
+(see log_header.py): at the head of every batch, or, when not batching, 
+with the first log line and then every string_table_interval seconds.
+
+Every header carries the size of its uncompressed body, so a writer storing
+messages as they come (see log_stream.py) needn't decompress the bodies.
 """
 import json
 import os
@@ -12,21 +30,27 @@ import socket
 import sys
 import time
 import uuid
-import zlib
 
 import zmq
 
+from old_log_inn.log_batch import pack_batch
+from old_log_inn.log_header import encode_binary_header, encode_string_table
+from old_log_inn.zlib_dictionary import load_zlib_dictionary, ZlibCompressor
 from old_log_inn.zmq_util import is_ipc_protocol, \
     prepare_ipc_path, \
     is_interrupted_system_call
 
 _hostname = os.environ.get("HOSTNAME", socket.gethostname())
+_header_encoding_json = "json"
+_header_encoding_binary = "binary"
 
 class LogLinePusher(object):
     """
     an object that pushes individual log lines over zeromq
     """
-    def __init__(self, zmq_context, log_path):
+    def __init__(self, zmq_context, log_path, batch_size=None, 
+                 batch_interval=0.1, zdict=None, header_encoding=None,
+                 string_table_interval=10.0):
         """
         zmq_context
             zeromq context
@@ -37,11 +61,58 @@ class LogLinePusher(object):
             file based logging. 
             This may include slashes to indicate directories.
             Used as a key to identify this log.
+
+        batch_size
+            If not None, the maximum number of log lines to gather into
+            a single batch message.
+
+        batch_interval
+            The maximum time (in seconds) to hold a log line waiting 
+            for a batch to fill. The age of the batch is checked when a line
+            is pushed: the owner must call flush() by flush_deadline() to
+            send a partial batch on time, as a LogLineSender does.
+
+        zdict
+            A preset zlib dictionary (bytes). If None, we load the file named
+            by PYTHON_ZMQ_LOG_ZDICT, if that is set.
+
+        header_encoding
+            'json' or 'binary'. If None, we use PYTHON_ZMQ_LOG_HEADER_ENCODING,
+            defaulting to 'json'
+
+        string_table_interval
+            when sending binary headers without batching, the time (in 
+            seconds) between repeats of the string table, so that receivers
+            which connect late can decode our headers
         """
         self._log_path = log_path
         self._nodename = os.environ.get("ZMQ_LOG_NODE_NAME")
         self._uuid = uuid.uuid4()
         self._sequence = 0
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._batch_headers = list()
+        self._batch_bodies = list()
+        self._batch_line_count = 0
+        self._batch_start_time = None
+        if zdict is None and "PYTHON_ZMQ_LOG_ZDICT" in os.environ:
+            zdict = load_zlib_dictionary(os.environ["PYTHON_ZMQ_LOG_ZDICT"])
+        self._compressor = ZlibCompressor(zdict)
+        if header_encoding is None:
+            header_encoding = os.environ.get("PYTHON_ZMQ_LOG_HEADER_ENCODING",
+                                             _header_encoding_json)
+        if header_encoding == _header_encoding_binary:
+            self._string_table = encode_string_table(self._uuid.bytes,
+                                                     _hostname,
+                                                     self._nodename,
+                                                     log_path)
+        elif header_encoding == _header_encoding_json:
+            self._string_table = None
+        else:
+            raise ValueError("Invalid header_encoding {0}".format(
+                header_encoding))
+        self._string_table_interval = string_table_interval
+        self._string_table_time = None
         self._push_sockets = list()
         for address in os.environ["PYTHON_ZMQ_LOG_HANDLER"].split():
             if is_ipc_protocol(address):
@@ -51,31 +122,100 @@ class LogLinePusher(object):
             push_socket.connect(address)
             self._push_sockets.append(push_socket)
 
-    def push_log_line(self, log_line):
+    def push_log_line(self, log_line, timestamp=None):
         """
         log_line
             one log entry
+
+        timestamp
+            the time of the log event, defaults to the current time
         """
         self._sequence += 1
 
-        header = {"hostname"    : _hostname,
-                  "uuid"        : self._uuid.hex,
-                  "sequence"    : self._sequence,
-                  "pid"         : os.getpid(),
-                  "timestamp"   : time.time(),
-                  "log_path"    : self._log_path}
-        if self._nodename is not None:
-            header["nodename"] = self._nodename
+        if timestamp is None:
+            timestamp = time.time()
+
+        encoded_line = log_line.encode("utf-8")
+
+        if self._string_table is None:
+            header = {"hostname"    : _hostname,
+                      "uuid"        : self._uuid.hex,
+                      "sequence"    : self._sequence,
+                      "pid"         : os.getpid(),
+                      "timestamp"   : timestamp,
+                      "log_path"    : self._log_path,
+                      "body_size"   : len(encoded_line)}
+            if self._nodename is not None:
+                header["nodename"] = self._nodename
+            encoded_header = json.dumps(header).encode("utf-8")
+        else:
+            encoded_header = encode_binary_header(self._uuid.bytes,
+                                                  os.getpid(),
+                                                  self._sequence,
+                                                  timestamp,
+                                                  len(encoded_line))
+
+        current_time = time.time()
+
+        if self._batch_size is None:
+            compress = self._compressor.compress
+            if self._string_table is not None and \
+                (self._string_table_time is None or \
+                 current_time - self._string_table_time >= \
+                 self._string_table_interval):
+                self._send([compress(self._string_table), compress(b""), ])
+                self._string_table_time = current_time
+            compressed_header = compress(encoded_header)
+            compressed_record = compress(encoded_line)
+            self._send([compressed_header, compressed_record, ])
+            return
+
+        if len(self._batch_headers) == 0:
+            self._batch_start_time = current_time
+            if self._string_table is not None:
+                self._batch_headers.append(self._string_table)
+                self._batch_bodies.append(b"")
+        self._batch_headers.append(encoded_header)
+        self._batch_bodies.append(encoded_line)
+        self._batch_line_count += 1
+
+        if self._batch_line_count >= self._batch_size or \
+            current_time >= self.flush_deadline():
+            self.flush()
+
+    def flush_deadline(self):
+        """
+        return the time by which a partial batch should be sent, 
+        or None if there is nothing waiting
+        """
+        if self._batch_start_time is None:
+            return None
+        return self._batch_start_time + self._batch_interval
+
+    def flush(self):
+        """
+        send any log lines waiting in a partial batch
+        """
+        if len(self._batch_headers) == 0:
+            return
 
-        header_json = json.dumps(header)
-        compressed_header = zlib.compress(header_json.encode("utf-8"))
+        frames = pack_batch(self._batch_headers, 
+                            self._batch_bodies,
+                            self._compressor.compress)
+        self._batch_headers = list()
+        self._batch_bodies = list()
+        self._batch_line_count = 0
+        self._batch_start_time = None
 
-        compressed_record = zlib.compress(log_line.encode("utf-8"))
+        self._send(frames)
 
+    def _send(self, frames):
+        last_index = len(frames) - 1
         for push_socket in self._push_sockets:
             try:
-                push_socket.send(compressed_header, zmq.SNDMORE)
-                push_socket.send(compressed_record)
+                for index, frame in enumerate(frames):
+                    flags = (zmq.SNDMORE if index < last_index else 0)
+                    push_socket.send(frame, flags)
             except zmq.ZMQError:
                 instance = sys.exc_info()[1]
                 # allow interrupted system call at shutdown
@@ -86,5 +226,6 @@ class LogLinePusher(object):
         """
         shut down the line pusher
         """
+        self.flush()
         for push_socket in self._push_sockets:
             push_socket.close()
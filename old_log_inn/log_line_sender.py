@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+log_line_sender.py
+
+A single background thread per process that pushes log lines through
+LogLinePusher objects, so the thread that logs never blocks on a ZMQ socket.
+
+Log lines wait in a bounded in-memory ring. When the ring is full, the
+overflow policy of the caller decides what happens:
+
+    block       wait for room in the ring
+    drop-oldest discard the oldest line in the ring to make room
+    drop-newest discard the line being added
+
+A LogLinePusher handed to the sender belongs to the sender thread from then
+on: the thread pushes its lines, sends its partial batches when they are due,
+and closes it. Closing a pusher through the sender (close_pusher) returns
+only after every line queued ahead of the close has been sent.
+"""
+from collections import deque
+import os
+import threading
+import time
+
+overflow_block = "block"
+overflow_drop_oldest = "drop-oldest"
+overflow_drop_newest = "drop-newest"
+overflow_policies = [overflow_block,
+                     overflow_drop_oldest,
+                     overflow_drop_newest, ]
+
+_default_capacity = 10000
+
+_flush_request = "flush"
+_close_request = "close"
+
+_sender_lock = threading.Lock()
+_sender = None
+
+class LogLineSender(threading.Thread):
+    """
+    a background thread draining a bounded ring of log lines
+    """
+    def __init__(self, capacity):
+        super(LogLineSender, self).__init__(name="LogLineSender")
+        self.daemon = True
+
+        self._capacity = capacity
+        self._ring = deque()
+        self._requests = list()
+        self._condition = threading.Condition()
+        self._pushers = list()
+        self._halt = False
+        self._pid = os.getpid()
+
+        self.enqueued_count = 0
+        self.sent_count = 0
+        self.blocked_count = 0
+        self.dropped_oldest_count = 0
+        self.dropped_newest_count = 0
+        self.error_count = 0
+
+    @property
+    def pid(self):
+        return self._pid
+
+    @property
+    def pusher_count(self):
+        return len(self._pushers)
+
+    def counters(self):
+        """
+        return a dict of the sender's counters
+        """
+        with self._condition:
+            return {"queued"            : len(self._ring),
+                    "enqueued"          : self.enqueued_count,
+                    "sent"              : self.sent_count,
+                    "blocked"           : self.blocked_count,
+                    "dropped_oldest"    : self.dropped_oldest_count,
+                    "dropped_newest"    : self.dropped_newest_count,
+                    "errors"            : self.error_count, }
+
+    def add_pusher(self, log_line_pusher):
+        """
+        take ownership of a LogLinePusher
+        """
+        with self._condition:
+            self._pushers.append(log_line_pusher)
+
+    def push_log_line(self, log_line_pusher, log_line, timestamp,
+                      overflow_policy=overflow_block):
+        """
+        queue a log line to be pushed from the background thread
+        """
+        with self._condition:
+            if len(self._ring) >= self._capacity:
+                if overflow_policy == overflow_drop_newest:
+                    self.dropped_newest_count += 1
+                    return
+                if overflow_policy == overflow_drop_oldest:
+                    self._ring.popleft()
+                    self.dropped_oldest_count += 1
+                else:
+                    self.blocked_count += 1
+                    while len(self._ring) >= self._capacity:
+                        self._condition.wait()
+
+            self._ring.append((log_line_pusher, log_line, timestamp, ))
+            self.enqueued_count += 1
+            self._condition.notify_all()
+
+    def flush_pusher(self, log_line_pusher):
+        """
+        wait until every line queued so far has been sent,
+        including partial batches of this pusher
+        """
+        self._request(_flush_request, log_line_pusher)
+
+    def close_pusher(self, log_line_pusher):
+        """
+        wait until every line queued so far has been sent,
+        then close the pusher
+        """
+        self._request(_close_request, log_line_pusher)
+
+    def halt(self):
+        """
+        stop the thread after it has sent everything queued
+        """
+        with self._condition:
+            self._halt = True
+            self._condition.notify_all()
+
+    def _request(self, request, log_line_pusher):
+        if not self.is_alive():
+            raise RuntimeError("LogLineSender is not running")
+        done_event = threading.Event()
+        with self._condition:
+            self._requests.append((request, log_line_pusher, done_event, ))
+            self._condition.notify_all()
+        done_event.wait()
+
+    def _compute_wait_timeout(self):
+        deadlines = [p.flush_deadline() for p in self._pushers]
+        deadlines = [d for d in deadlines if d is not None]
+        if len(deadlines) == 0:
+            return None
+        return max(0.0, min(deadlines) - time.time())
+
+    def run(self):
+        while True:
+            with self._condition:
+                while len(self._ring) == 0 and \
+                    len(self._requests) == 0 and \
+                    not self._halt:
+                    timeout = self._compute_wait_timeout()
+                    if timeout is not None and timeout <= 0.0:
+                        break
+                    self._condition.wait(timeout)
+
+                items = list(self._ring)
+                self._ring.clear()
+                requests = self._requests
+                self._requests = list()
+                halt = self._halt
+
+                # wake anyone blocked on a full ring
+                self._condition.notify_all()
+
+            for log_line_pusher, log_line, timestamp in items:
+                try:
+                    log_line_pusher.push_log_line(log_line, timestamp)
+                except Exception:
+                    self.error_count += 1
+                else:
+                    self.sent_count += 1
+
+            current_time = time.time()
+            for log_line_pusher in list(self._pushers):
+                deadline = log_line_pusher.flush_deadline()
+                if deadline is not None and deadline <= current_time:
+                    self._call_pusher(log_line_pusher.flush)
+
+            for request, log_line_pusher, done_event in requests:
+                if request == _close_request:
+                    self._call_pusher(log_line_pusher.close)
+                    with self._condition:
+                        self._pushers.remove(log_line_pusher)
+                else:
+                    self._call_pusher(log_line_pusher.flush)
+                done_event.set()
+
+            if halt and len(items) == 0 and len(requests) == 0:
+                break
+
+    def _call_pusher(self, function):
+        try:
+            function()
+        except Exception:
+            self.error_count += 1
+
+def acquire_log_line_sender(log_line_pusher, capacity=None):
+    """
+    hand a LogLinePusher over to the background LogLineSender for this 
+    process, starting the thread if it is not running.
+
+    capacity
+        the size of the ring, used only when the thread is started
+
+    return the LogLineSender
+    """
+    global _sender
+    with _sender_lock:
+        if _sender is None or \
+            _sender.pid != os.getpid() or \
+            not _sender.is_alive():
+            _sender = LogLineSender(capacity or _default_capacity)
+            _sender.start()
+        _sender.add_pusher(log_line_pusher)
+        return _sender
+
+def release_log_line_sender(log_line_sender, log_line_pusher):
+    """
+    send everything queued for the pusher and close it.
+    stop the background thread if no one is using it anymore
+    """
+    global _sender
+    with _sender_lock:
+        log_line_sender.close_pusher(log_line_pusher)
+        if log_line_sender.pusher_count > 0:
+            return
+        log_line_sender.halt()
+        log_line_sender.join()
+        if _sender is log_line_sender:
+            _sender = None
@@ -3,19 +3,159 @@
 log_stream.py
 
 objects for managing log streams: LogStreamWriter, LogStreamReader
+
+A log stream is a gzip file of frames, each frame holding one header and
+one data block. A frame begins with its protocol version:
+
+    version 1: version, header size, data size
+    version 2: version, header encoding, header size, data size
+    version 3: version, header encoding, flags, 
+               compressed header size, header size, 
+               compressed data size, data size
+
+The header encoding is one of those in log_header.py. 
+
+A version 3 frame holds the header and data as the producer compressed them
+with zlib (perhaps with a preset dictionary, see zlib_dictionary.py), so the
+writer can store a message without compressing it again. If the batch flag
+is set, the header and data are the header block and body block of a batch
+message (see log_batch.py) and the frame holds all of its records. 
+The writer decompresses only the header, taking the data size from the
+body sizes the producer put in the headers (see log_header.py). It
+decompresses the data only when a header doesn't give its body size.
+A reader checks the header and data of a version 3 frame as it decompresses
+them: a frame that fails (a bad body, say) is skipped, and reported in
+bad_frames if the caller gives one, so it costs only its own records.
+The writer stores version 3 frames in gzip members written at compression 
+level 0. A reader decompresses them as it goes, with the preset dictionaries
+it is given.
+
+A file may be written as a series of blocks, each block a complete gzip member
+(the file as a whole is still a valid gzip file). The writer then also writes
+a sidecar index, named for the file with '.index' added, listing each block's 
+offset and size in the file, its record count, its minimum and maximum 
+header timestamp, and the hostnames and log_paths of its records. 
+A reader can use the index to seek straight to the blocks it wants.
+
+The writer puts the string table of a producer with binary headers into each 
+block, ahead of that producer's first record in the block, so every block can 
+be read on its own.
+
+encode_log_stream_block does the compression work of building a block away 
+from the writer (in a worker thread, say), and LogStreamWriter.append_block 
+adds the finished block to the current file.
+
+By default the writer flushes the file (but not the compressor) after each
+write, as it always has. Given flush_records or flush_interval, it commits
+records to disk in groups instead: after every flush_records records, or
+once the oldest uncommitted record is flush_interval seconds old, whichever
+comes first. The durability setting says what a commit does:
+
+    none    nothing, records reach the disk as buffers fill
+    flush   flush the compressor and the file, so the records can be read
+    fsync   flush, then fsync the file
+
+(Without group commit, the compressor is never flushed: flush and fsync
+flush, or flush and fsync, the file alone.) Flushing the compressor costs
+compression: a sync flush after every small record doubles the size of
+the file.
+
+The writer counts the records and bytes it writes, and times its commits and
+rollovers, in the metrics registry it is given (see metrics.py).
+
+generate_log_stream_batches_from_file reads a file (or the indexed blocks of
+it) much faster than generate_log_stream_from_file. Rather than reading each
+frame through GzipFile, it decompresses the file a chunk at a time (from a
+read buffer it reuses) and parses all the complete frames in a chunk at once,
+with struct unpack_from at offsets into it. It yields the records of a chunk
+as one list, as bytes, or as memoryviews of the chunk to save copying them.
+
+generate_log_stream_from_directory_parallel reads the files of a directory
+in a pool of worker processes, filtering and mapping their records there,
+so only the records the caller wants come back to it. The work is split into
+units of about unit_bytes of a file, cut at the block offsets of its index
+(a file without an index is one unit), and no more than lookahead_bytes of
+units are read, or waiting to be yielded, at once.
+
+A writer that is killed leaves its current file in the work directory, torn:
+its last gzip member, and perhaps its last frame, cut short. On startup,
+LogStreamWriter.recover_work_dir salvages the complete frames of such files
+into valid gzip files and moves them to the complete directory (see
+salvage_log_stream_file). generate_log_stream_from_file(tolerant=True) reads
+a torn file up to its last complete frame.
+
+A completed file whose name is taken in the complete directory (by a file
+recovered from the same time slot, say) is given the next free name of the
+form <prefix>YYYYMMDDHHMMSS_NN<suffix>, which sorts after the first (for a
+suffix like ".maple1.gz").
+
+With max_file_bytes or max_file_records, the writer also splits a time slot
+into numbered segments, each completed as it reaches the limit:
+<prefix>YYYYMMDDHHMMSS.NNNN<suffix>, numbered from 0001. The timestamp
+stays where archive_retrieval looks for it, and the names sort in the order
+the segments were written. The limit is checked after each record, message
+or block, so a segment may pass it by one message or block. The bytes are
+those of the file so far: what the compressor holds back is not counted.
 """
-from datetime import datetime, timedelta
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
 from gzip import GzipFile
+import io
+import json
+import multiprocessing
 import os
 import os.path
 import struct
+import sys
+import time
+import zlib
+
+from old_log_inn.log_batch import LogBatchError, \
+    batch_block_size, \
+    is_batch_marker, \
+    unpack_batch_block
+from old_log_inn.log_header import header_encoding_json, \
+    header_encoding_binary, \
+    header_encoding_string_table, \
+    header_encodings, \
+    header_encoding, \
+    header_body_size, \
+    header_uuid_bytes, \
+    HeaderDecoder, \
+    LogHeaderError
+from old_log_inn.metrics import MetricsRegistry, Timer
+from old_log_inn.zlib_dictionary import ZlibDictionaryError
 
 class LogStreamError(Exception):
     pass
 
-_frame_format = "!BII"
-_frame_size = struct.calcsize(_frame_format)
-_frame_protocol_version = 1
+_frame_format = "!BBII"
+_frame_protocol_version = 2
+_compressed_frame_format = "!BBBIIII"
+_compressed_frame_protocol_version = 3
+_frame_body_formats = {1 : "!II", 2 : "!BII", 3 : "!BBIIII", }
+_compressed_frame_batch_flag = 0x01
+# what a version 3 frame we can't read (but can step over) raises
+_bad_frame_errors = (zlib.error, LogStreamError, LogBatchError, )
+_frame_body_sizes = dict((version, struct.calcsize(frame_body_format), ) \
+                         for version, frame_body_format \
+                         in _frame_body_formats.items())
+_frame_body_structs = dict((version, struct.Struct(frame_body_format), ) \
+                          for version, frame_body_format \
+                          in _frame_body_formats.items())
+_gzip_wbits = 16 + zlib.MAX_WBITS
+_default_read_chunk_size = 1024 ** 2
+_default_read_unit_bytes = 16 * 1024 ** 2
+_default_lookahead_units_per_worker = 2
+_salvage_suffix = ".salvage"
+_index_suffix = ".index"
+_index_version = 1
+
+durability_none = "none"
+durability_flush = "flush"
+durability_fsync = "fsync"
+durabilities = [durability_none, durability_flush, durability_fsync, ]
 
 def _compute_timestamp(granularity, time_value):
     """
@@ -46,8 +186,353 @@ def _compute_timestamp(granularity, time_value):
     # return a formatted string
     return timestamp_value.strftime("%Y%m%d%H%M%S")
 
+def log_stream_index_name(name):
+    """
+    return the name of the sidecar index for a log stream file (or key)
+    """
+    return "".join([name, _index_suffix, ])
+
+def is_log_stream_index_name(name):
+    """
+    return True if the name is that of a sidecar index
+    """
+    return name.endswith(_index_suffix)
+
+def log_stream_name_from_index_name(name):
+    """
+    return the name of the log stream file that an index describes
+    """
+    assert is_log_stream_index_name(name), name
+    return name[:-len(_index_suffix)]
+
+class _IndexBlock(object):
+    """
+    accumulate the index entry for one block
+    """
+    def __init__(self, offset):
+        self.offset = offset
+        self.size = None
+        self.record_count = 0
+        self.min_timestamp = None
+        self.max_timestamp = None
+        self.hostnames = set()
+        self.log_paths = set()
+        # True if we have a record whose header we could not decode:
+        # a reader must not skip this block 
+        self.unknown = False
+        # binary headers whose string table the encoder didn't have,
+        # for the writer to index (see LogStreamWriter.append_block)
+        self.deferred_headers = list()
+
+    def add_header(self, header):
+        """
+        header
+            a decoded header dict, 
+            or None for a record whose header we could not decode
+        """
+        if header is None or not isinstance(header, dict):
+            self.unknown = True
+            return
+        try:
+            timestamp = header["timestamp"]
+            self.hostnames.add(header["hostname"])
+            self.log_paths.add(header["log_path"])
+        except KeyError:
+            self.unknown = True
+            return
+        if self.min_timestamp is None or timestamp < self.min_timestamp:
+            self.min_timestamp = timestamp
+        if self.max_timestamp is None or timestamp > self.max_timestamp:
+            self.max_timestamp = timestamp
+
+    @property
+    def indexed(self):
+        """
+        True if the block holds records a reader may want: a block of
+        string tables alone is not worth an index entry
+        """
+        return self.unknown or self.min_timestamp is not None
+
+    def to_dict(self):
+        return {"offset"        : self.offset,
+                "size"          : self.size,
+                "record_count"  : self.record_count,
+                "min_timestamp" : self.min_timestamp,
+                "max_timestamp" : self.max_timestamp,
+                "hostnames"     : sorted(self.hostnames),
+                "log_paths"     : sorted(self.log_paths),
+                "unknown"       : self.unknown, }
+
+def _message_data_size(headers, is_batch):
+    """
+    return the size of the uncompressed data (body, or body block) of a
+    message, from its uncompressed headers, or None if they don't all say
+    """
+    body_sizes = [header_body_size(header) for header in headers]
+    if None in body_sizes:
+        return None
+    if is_batch:
+        return batch_block_size(body_sizes)
+    return body_sizes[0]
+
+class _BlockEncoder(object):
+    """
+    write records as frames into one block (gzip member), 
+    putting the string table of each binary header producer ahead of 
+    its first record in the block
+    """
+    def __init__(self, output_gzip_file, string_tables, header_decoder,
+                 index_block=None):
+        """
+        string_tables
+            a dict of the string tables of binary header producers,
+            keyed by uuid, shared with other blocks
+        """
+        self._output_gzip_file = output_gzip_file
+        self._string_tables = string_tables
+        self._string_tables_written = set()
+        # the tables of the string table records in the block, and the
+        # producers with a record in the block whose table we didn't have
+        self.learned_string_tables = dict()
+        self.missing_string_tables = set()
+        self._header_decoder = header_decoder
+        self.index_block = index_block
+        self.record_count = 0
+        # header and data bytes of the records we wrote, uncompressed
+        self.raw_bytes = 0
+
+    def write_record(self, header, data):
+        """
+        return False if we dropped the record (a string table already
+        in the block)
+        """
+        encoding = header_encoding(header)
+        if not self._place_string_table(encoding, header, True):
+            return False
+        self._write_frame(encoding, header, data)
+        self.raw_bytes += len(header) + len(data)
+        return True
+
+    def write_compressed_message(self, frames, decompress):
+        """
+        write a message (topic excluded) as it came off the wire, 
+        in a single version 3 frame. 
+        return the number of records in it, or 0 if we dropped it
+        (a string table already in the block)
+        """
+        compressed_header, compressed_data = frames[-2:]
+        # we need the header to place string tables and to index it,
+        # but the data only if the header doesn't give its size
+        header = decompress(compressed_header)
+        is_batch = is_batch_marker(frames[0])
+        if is_batch:
+            headers = unpack_batch_block(header)
+        else:
+            headers = [header, ]
+        data_size = _message_data_size(headers, is_batch)
+        if data_size is None:
+            data = decompress(compressed_data)
+            if is_batch:
+                body_count = len(unpack_batch_block(data))
+                if body_count != len(headers):
+                    raise LogBatchError("{0} headers but {1} bodies".format(
+                        len(headers), body_count))
+            data_size = len(data)
+
+        if is_batch:
+            flags = _compressed_frame_batch_flag
+            encoding = header_encoding_json
+            for item in headers:
+                self._place_string_table(header_encoding(item), item, False)
+        else:
+            flags = 0
+            encoding = header_encoding(header)
+            if not self._place_string_table(encoding, header, True):
+                return 0
+
+        for item in headers:
+            self._count_record(item)
+
+        frame = struct.pack(_compressed_frame_format,
+                            _compressed_frame_protocol_version,
+                            encoding,
+                            flags,
+                            len(compressed_header),
+                            len(header),
+                            len(compressed_data),
+                            data_size)
+        self._output_gzip_file.write(
+            b"".join([frame, compressed_header, compressed_data, ]))
+        self.raw_bytes += len(header) + data_size
+        return len(headers)
+
+    def _place_string_table(self, encoding, header, droppable):
+        """
+        keep track of the string tables in the block: 
+        write the table of a binary header producer ahead of its first 
+        record in the block.
+        return False if the header is a string table already in the block
+        (and droppable)
+        """
+        if encoding == header_encoding_string_table:
+            uuid_bytes = header_uuid_bytes(header)
+            if droppable and \
+                self._string_tables.get(uuid_bytes) == header and \
+                uuid_bytes in self._string_tables_written:
+                return False
+            self._string_tables[uuid_bytes] = header
+            self._string_tables_written.add(uuid_bytes)
+            self.learned_string_tables[uuid_bytes] = header
+
+        elif encoding == header_encoding_binary:
+            uuid_bytes = header_uuid_bytes(header)
+            string_table = self._string_tables.get(uuid_bytes)
+            if uuid_bytes in self._string_tables_written:
+                pass
+            elif string_table is None:
+                self.missing_string_tables.add(uuid_bytes)
+            else:
+                self._write_frame(header_encoding_string_table,
+                                  string_table,
+                                  b"")
+                self._string_tables_written.add(uuid_bytes)
+
+        return True
+
+    def _count_record(self, header):
+        self.record_count += 1
+        if self.index_block is not None:
+            self.index_block.record_count += 1
+            try:
+                decoded_header = self._header_decoder.decode(header)
+            except (ValueError, LogHeaderError):
+                if header_encoding(header) == header_encoding_binary and \
+                    header_uuid_bytes(header) in self.missing_string_tables:
+                    self.index_block.deferred_headers.append(header)
+                else:
+                    self.index_block.add_header(None)
+            else:
+                # string tables are not indexed
+                if decoded_header is not None:
+                    self.index_block.add_header(decoded_header)
+
+    def _write_frame(self, encoding, header, data):
+        self._count_record(header)
+        frame = struct.pack(_frame_format, 
+                            _frame_protocol_version, 
+                            encoding,
+                            len(header),
+                            len(data))
+        self._output_gzip_file.write(b"".join([frame, header, data, ]))
+
+class LogStreamBlock(object):
+    """
+    a finished block (gzip member) ready for LogStreamWriter.append_block
+
+    string_tables
+        the string tables the block's string table records set, by uuid
+
+    missing_string_tables
+        the uuids of binary header producers with records in the block
+        whose string table the encoder didn't know: the writer puts the
+        tables it knows ahead of the block
+    """
+    def __init__(self, data, record_count, index_block,
+                 string_tables=None,
+                 missing_string_tables=None,
+                 raw_bytes=0):
+        self.data = data
+        self.record_count = record_count
+        self.index_block = index_block
+        self.raw_bytes = raw_bytes
+        self.string_tables = string_tables or dict()
+        self.missing_string_tables = missing_string_tables or set()
+
+def encode_log_stream_block(records, string_tables, index=False):
+    """
+    records
+        a sequence of (header, data) tuples
+
+    string_tables
+        a dict of the string tables of binary header producers, keyed by 
+        uuid, which we read and add to. Blocks encoded in parallel should
+        each have their own (see LogStreamBlock.missing_string_tables).
+
+    index
+        if True, gather the index entry for the block
+
+    return a LogStreamBlock
+    
+    This does all the compression work of writing the records, away from
+    the LogStreamWriter, so it can run in a worker thread.
+    """
+    output_file = io.BytesIO()
+    output_gzip_file = GzipFile(mode="wb", fileobj=output_file)
+    block_encoder = _BlockEncoder(output_gzip_file, 
+                                  string_tables, 
+                                  HeaderDecoder(),
+                                  _IndexBlock(None) if index else None)
+    for header, data in records:
+        block_encoder.write_record(header, data)
+    output_gzip_file.close()
+    return LogStreamBlock(output_file.getvalue(), 
+                          block_encoder.record_count,
+                          block_encoder.index_block,
+                          block_encoder.learned_string_tables,
+                          block_encoder.missing_string_tables,
+                          block_encoder.raw_bytes)
+
 class LogStreamWriter(object):
-    def __init__(self, prefix, suffix, granularity, work_dir, complete_dir):
+    def __init__(self, prefix, suffix, granularity, work_dir, complete_dir,
+                 index_block_records=None,
+                 flush_records=None,
+                 flush_interval=None,
+                 durability=durability_flush,
+                 passthrough=False,
+                 metrics=None,
+                 clock=time.time,
+                 max_file_bytes=None,
+                 max_file_records=None):
+        """
+        index_block_records
+            if not None, write the file in blocks of this many records,
+            with a sidecar index
+
+        flush_records
+            commit after this many records (None for no limit).
+            With flush_records and flush_interval both None, we flush the
+            file, not the compressor, after each write.
+
+        flush_interval
+            commit when the oldest uncommitted record is this many seconds
+            old (None for no limit). The caller must call check_for_flush
+            now and then for this to happen while no records arrive.
+
+        durability
+            one of durabilities: what a commit does
+
+        passthrough
+            if True, we expect messages as they came off the wire 
+            (see write_messages), and store them without compressing 
+            them again
+
+        metrics
+            a MetricsRegistry to count our work in
+
+        clock
+            the function that gives us the (epoch) time when the caller
+            doesn't, for testing
+
+        max_file_bytes
+            if not None, complete a file once it has this many (compressed)
+            bytes, and go on in a new segment of the time slot
+
+        max_file_records
+            if not None, complete a file once it has this many records,
+            and go on in a new segment of the time slot
+        """
+        if not durability in durabilities:
+            raise ValueError("Invalid durability {0}".format(durability))
         self._prefix = prefix
         self._suffix = suffix
 
@@ -55,115 +540,1248 @@ class LogStreamWriter(object):
             (3600 % granularity != 0):
             raise ValueError("Invalid granularity {0}".format(granularity))
 
-        self._granularity = timedelta(seconds=granularity)
+        self._granularity = granularity
+        self._clock = clock
 
         self._work_dir = work_dir
         self._complete_dir = complete_dir
 
         self._output_timestamp = None
         self._output_file_name = None
+        self._rollover_deadline = None
+
+        self._max_file_bytes = max_file_bytes
+        self._max_file_records = max_file_records
+        self._segmented = max_file_bytes is not None or \
+            max_file_records is not None
+        self._file_record_count = 0
+        self._segment_timestamp = None
+        self._segment_number = 0
 
         self._output_file = None
         self._output_gzip_file = None
 
+        # string tables of binary header producers, keyed by uuid
+        self._string_tables = dict()
+        self._header_decoder = HeaderDecoder()
+        self._block_encoder = None
+
+        self._index_block_records = index_block_records
+        self._index_blocks = None
+
+        self._flush_records = flush_records
+        self._flush_interval = flush_interval
+        self._group_commit = flush_records is not None or \
+            flush_interval is not None
+        self._durability = durability
+        self._uncommitted_count = 0
+        self._uncommitted_time = None
+
+        # stored frames are already compressed
+        self._compresslevel = 0 if passthrough else 9
+
+        if metrics is None:
+            metrics = MetricsRegistry()
+        self._records_counter = metrics.counter(
+            "records_written_total", "records written to log streams")
+        self._raw_bytes_counter = metrics.counter(
+            "raw_bytes_written_total",
+            "uncompressed header and data bytes of records written")
+        self._file_bytes_counter = metrics.counter(
+            "file_bytes_written_total",
+            "bytes of completed log stream files, compressed")
+        self._commit_histogram = metrics.histogram(
+            "commit_seconds", "time taken to commit records")
+        self._rollover_histogram = metrics.histogram(
+            "rollover_seconds", "time taken to complete a log stream file")
+
+    @property
+    def rollover_deadline(self):
+        """
+        the (epoch) time the current file is completed,
+        None if no file is open
+        """
+        return self._rollover_deadline
+
+    def poll_timeout(self, timeout, current_time=None):
+        """
+        return the poll timeout (seconds) that wakes the caller by the end
+        of the current file's time slot, for check_for_rollover
+        """
+        if self._rollover_deadline is None:
+            return timeout
+        if current_time is None:
+            current_time = self._clock()
+        return max(0.0, min(timeout, self._rollover_deadline - current_time))
+
+    @property
+    def index_block_records(self):
+        """
+        the number of records in an indexed block, 
+        None if we don't write a sidecar index
+        """
+        return self._index_block_records
+
     def write(self, header, data):
         """
         write header and data to the stream in a formatted frame
         both header and data must be of type bytes
         """
-        timestamp = self._compute_current_timestamp()
-        self.check_for_rollover(timestamp)
+        self.write_records([(header, data, ), ])
+
+    def write_records(self, records, current_time=None):
+        """
+        write a sequence of (header, data) tuples to the stream,
+        checking for rollover once for all of them
+        """
+        if current_time is None:
+            current_time = self._clock()
+        self.check_for_rollover(current_time)
+
+        if len(records) == 0:
+            self.check_for_flush(current_time)
+            return
+
+        for header, data in records:
+            if self._output_timestamp is None:
+                self._open_output_file(current_time)
+            self._write_record(header, data)
+            self._check_for_segment()
+
+        self.check_for_flush(current_time)
+
+    def write_messages(self, messages, decompressor, current_time=None):
+        """
+        write a sequence of messages, as they came off the wire, to the 
+        stream in version 3 frames, checking for rollover once for all 
+        of them.
+
+        messages
+            a sequence of lists of frames (topic excluded): 
+            compressed header, compressed body, 
+            or batch marker, compressed header block, compressed body block
+
+        decompressor
+            a ZlibDecompressor, we need to see the headers (and the bodies
+            whose size the headers don't give)
+
+        return a list of (message, exception) for the messages we could
+        not decompress
+        """
+        if current_time is None:
+            current_time = self._clock()
+        self.check_for_rollover(current_time)
+
+        errors = list()
+        for frames in messages:
+            if self._output_timestamp is None:
+                self._open_output_file(current_time)
+            if self._block_encoder is None:
+                self._open_block()
+            raw_bytes = self._block_encoder.raw_bytes
+            try:
+                record_count = self._block_encoder.write_compressed_message(
+                    frames, decompressor.decompress)
+            except (ZlibDictionaryError, zlib.error, LogBatchError):
+                errors.append((frames, sys.exc_info()[1], ))
+                continue
+            self._raw_bytes_counter.increment(self._block_encoder.raw_bytes -
+                                              raw_bytes)
+            self._record_written(record_count)
+            self._check_for_segment()
+
+        self.check_for_flush(current_time)
+        return errors
+
+    def append_block(self, block, current_time=None):
+        """
+        append a finished block from encode_log_stream_block to the stream
+        """
+        if current_time is None:
+            current_time = self._clock()
+        self.check_for_rollover(current_time)
+
+        if block.record_count == 0:
+            self.check_for_flush(current_time)
+            return
 
         if self._output_timestamp is None:
-            self._open_output_file(timestamp)
+            self._open_output_file(current_time)
 
-        frame = struct.pack(_frame_format, 
-                            _frame_protocol_version, 
-                            len(header),
-                            len(data))
-        self._output_gzip_file.write(frame)
-        self._output_gzip_file.write(header)
-        self._output_gzip_file.write(data)
-        self._output_file.flush()
+        self._close_block()
+        offset = self._output_file.tell()
+        # the tables the block needs from blocks before it go in a member
+        # of their own, which the block's index entry takes in
+        table_block = self._missing_string_table_block(block)
+        if table_block is not None:
+            self._output_file.write(table_block.data)
+        self._output_file.write(block.data)
+        record_count = block.record_count
+        raw_bytes = block.raw_bytes
+        if table_block is not None:
+            record_count += table_block.record_count
+            raw_bytes += table_block.raw_bytes
+        if self._index_blocks is not None:
+            index_block = block.index_block
+            if index_block is None:
+                # a block encoded without an index entry: we can't say
+                # what is in it
+                index_block = _IndexBlock(offset)
+                index_block.unknown = True
+            self._index_deferred_headers(index_block)
+            index_block.record_count = record_count
+            index_block.offset = offset
+            index_block.size = self._output_file.tell() - offset
+            if index_block.indexed:
+                self._index_blocks.append(index_block.to_dict())
+        self._string_tables.update(block.string_tables)
+
+        self._raw_bytes_counter.increment(raw_bytes)
+        self._add_uncommitted(record_count)
+        self._check_for_segment()
+        self.check_for_flush(current_time)
+
+    def _missing_string_table_block(self, block):
+        """
+        return a block of the string tables we know that block was
+        encoded without, None if there are none
+        """
+        records = [(self._string_tables[uuid_bytes], b"", ) \
+                   for uuid_bytes in sorted(block.missing_string_tables) \
+                   if uuid_bytes in self._string_tables]
+        if len(records) == 0:
+            return None
+        return encode_log_stream_block(records, dict())
+
+    def _index_deferred_headers(self, index_block):
+        """
+        index the headers the block's encoder couldn't decode,
+        with the string tables we had before the block
+        """
+        for header in index_block.deferred_headers:
+            string_table = self._string_tables.get(header_uuid_bytes(header))
+            decoded_header = None
+            if string_table is not None:
+                self._header_decoder.add_string_table(string_table)
+                try:
+                    decoded_header = self._header_decoder.decode(header)
+                except (ValueError, LogHeaderError):
+                    pass
+            index_block.add_header(decoded_header)
+        index_block.deferred_headers = list()
+
+    def _write_record(self, header, data):
+        if self._block_encoder is None:
+            self._open_block()
+
+        if not self._block_encoder.write_record(header, data):
+            return
+
+        self._raw_bytes_counter.increment(len(header) + len(data))
+        self._record_written(1)
+
+    def _record_written(self, count):
+        if count == 0:
+            return
+
+        if self._index_block_records is not None and \
+            self._block_encoder.record_count >= self._index_block_records:
+            self._close_block()
+
+        self._add_uncommitted(count)
+
+    def _add_uncommitted(self, count):
+        self._records_counter.increment(count)
+        self._file_record_count += count
+        if self._uncommitted_count == 0:
+            self._uncommitted_time = self._clock()
+        self._uncommitted_count += count
+        if self._flush_records is not None and \
+            self._uncommitted_count >= self._flush_records:
+            self.flush()
+
+    def check_for_flush(self, current_time=None):
+        """
+        commit the uncommitted records (if any) if the oldest of them 
+        has waited flush_interval seconds, or at once without group commit
+        """
+        if self._uncommitted_count == 0:
+            return
+
+        if not self._group_commit:
+            self.flush()
+            return
 
-    def check_for_rollover(self, timestamp=None):
+        if self._flush_interval is None:
+            return
+
+        if current_time is None:
+            current_time = self._clock()
+
+        if current_time - self._uncommitted_time >= self._flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        commit the uncommitted records (if any) according to durability
         """
-        check the timestamp on the currently open file (if any)
+        if self._uncommitted_count == 0:
+            return
+        self._uncommitted_count = 0
+        self._uncommitted_time = None
+
+        if self._durability == durability_none:
+            return
+
+        with Timer(self._commit_histogram):
+            if self._output_gzip_file is not None and self._group_commit:
+                self._output_gzip_file.flush(zlib.Z_SYNC_FLUSH)
+            else:
+                self._output_file.flush()
+            if self._durability == durability_fsync:
+                os.fsync(self._output_file.fileno())
+
+    def check_for_rollover(self, current_time=None):
+        """
+        check the currently open file (if any)
         and close it if it has aged out
         """
         if self._output_timestamp is None:
             return
 
-        if timestamp is None:
-            timestamp = self._compute_current_timestamp()
+        if current_time is None:
+            current_time = self._clock()
 
-        if timestamp != self._output_timestamp:
-            self._close_current_file()
+        if current_time >= self._rollover_deadline:
+            with Timer(self._rollover_histogram):
+                self._close_current_file()
 
-    def _compute_current_timestamp(self):
+    def _check_for_segment(self):
         """
-        return the timestamp for the current moment
+        complete the current file if it has reached a segment limit
         """
-        return _compute_timestamp(self._granularity, datetime.utcnow())
+        if not self._segmented or self._output_timestamp is None:
+            return
+        if (self._max_file_records is not None and \
+            self._file_record_count >= self._max_file_records) or \
+           (self._max_file_bytes is not None and \
+            self._output_file.tell() >= self._max_file_bytes):
+            with Timer(self._rollover_histogram):
+                self._close_current_file()
 
     def _close_current_file(self):
-        self._output_gzip_file.close()
-        self._output_gzip_file = None
+        self._close_block()
 
+        # closing the block flushed the compressor
+        if self._uncommitted_count > 0 and \
+            self._durability == durability_fsync:
+            self._output_file.flush()
+            os.fsync(self._output_file.fileno())
+        self._uncommitted_count = 0
+        self._uncommitted_time = None
+
+        self._file_bytes_counter.increment(self._output_file.tell())
         self._output_file.close()
         self._output_file = None
 
+        complete_file_name = self._complete_file_name(self._output_file_name)
+        if self._index_blocks is not None:
+            self._write_index(complete_file_name)
+            self._index_blocks = None
+
         work_path = os.path.join(self._work_dir, self._output_file_name)
-        complete_path = os.path.join(self._complete_dir, 
-                                     self._output_file_name)
+        complete_path = os.path.join(self._complete_dir, complete_file_name)
         os.rename(work_path, complete_path)
 
         self._output_timestamp = None
         self._output_file_name = None
+        self._rollover_deadline = None
+
+    def _open_output_file(self, current_time):
+        # granularity divides an hour, so the slots line up with the epoch,
+        # and the slot's start gives the timestamp _compute_timestamp would
+        slot_start = current_time - (current_time % self._granularity)
+        self._rollover_deadline = slot_start + self._granularity
+        timestamp = time.strftime("%Y%m%d%H%M%S", time.gmtime(slot_start))
 
-    def _open_output_file(self, timestamp):
         self._output_timestamp = timestamp
-        self._output_file_name = \
-            "".join([self._prefix, timestamp, self._suffix, ])
+        self._file_record_count = 0
+        if self._segmented:
+            self._output_file_name = self._segment_file_name(timestamp)
+        else:
+            self._output_file_name = \
+                "".join([self._prefix, timestamp, self._suffix, ])
         work_path = os.path.join(self._work_dir, self._output_file_name)
         self._output_file = open(work_path, "wb")
-        self._output_gzip_file = GzipFile(fileobj=self._output_file)
+        if self._index_block_records is not None:
+            self._index_blocks = list()
+
+    def _segment_file_name(self, timestamp):
+        """
+        return the name of the next segment of the time slot: the one after
+        the last we wrote, and after any already in the complete directory
+        (from before a restart, say)
+        """
+        if timestamp != self._segment_timestamp:
+            self._segment_timestamp = timestamp
+            self._segment_number = 0
+        while True:
+            self._segment_number += 1
+            file_name = "".join([self._prefix,
+                                 timestamp,
+                                 ".{0:04}".format(self._segment_number),
+                                 self._suffix, ])
+            if not os.path.exists(os.path.join(self._complete_dir,
+                                               file_name)):
+                return file_name
+
+    def _open_block(self):
+        """
+        start a new gzip member in the current file
+        """
+        offset = self._output_file.tell()
+        self._output_gzip_file = GzipFile(mode="wb", 
+                                          fileobj=self._output_file,
+                                          compresslevel=self._compresslevel)
+        index_block = None
+        if self._index_blocks is not None:
+            index_block = _IndexBlock(offset)
+        self._block_encoder = _BlockEncoder(self._output_gzip_file,
+                                            self._string_tables,
+                                            self._header_decoder,
+                                            index_block)
 
-def generate_log_stream_from_file(path):
+    def _close_block(self):
+        """
+        finish the current gzip member (if any)
+        """
+        if self._block_encoder is None:
+            return
+        self._output_gzip_file.close()
+        self._output_gzip_file = None
+        index_block = self._block_encoder.index_block
+        if index_block is not None and index_block.indexed:
+            index_block.size = self._output_file.tell() - index_block.offset
+            self._index_blocks.append(index_block.to_dict())
+        self._block_encoder = None
+
+    def _write_index(self, complete_file_name):
+        """
+        write the sidecar index to the complete directory, ahead of the
+        file it describes
+        """
+        work_path = os.path.join(
+            self._work_dir, log_stream_index_name(self._output_file_name))
+        complete_path = os.path.join(
+            self._complete_dir, log_stream_index_name(complete_file_name))
+        index = {"version"      : _index_version,
+                 "file_name"    : complete_file_name,
+                 "blocks"       : self._index_blocks, }
+        with open(work_path, "w") as output_file:
+            json.dump(index, output_file)
+        os.rename(work_path, complete_path)
+
+    def _complete_file_name(self, file_name):
+        """
+        return the name to give file_name in the complete directory:
+        its own, or if a file (or index) there has that, the first free
+        one of <prefix>YYYYMMDDHHMMSS_NN<suffix>
+        """
+        def _taken(name):
+            return os.path.exists(os.path.join(self._complete_dir, name)) or \
+                os.path.exists(os.path.join(self._complete_dir,
+                                            log_stream_index_name(name)))
+
+        stem = file_name[:len(file_name)-len(self._suffix)]
+        complete_file_name = file_name
+        collision_count = 0
+        while _taken(complete_file_name):
+            collision_count += 1
+            complete_file_name = "{0}_{1:02}{2}".format(stem,
+                                                        collision_count,
+                                                        self._suffix)
+        return complete_file_name
+
+    def recover_work_dir(self):
+        """
+        salvage the files a writer that was killed left in the work
+        directory: write the complete frames of each to a valid gzip file
+        in the complete directory, and remove the original.
+        A file left whole is moved as it is, with its index (if any).
+        Call this before writing anything.
+
+        return a list of (file name, name in the complete directory
+        (None if it had no complete frames), frames salvaged,
+        True if the file was whole)
+        """
+        assert self._output_file is None
+        file_names = sorted(os.listdir(self._work_dir))
+        for file_name in file_names:
+            if file_name.endswith(_salvage_suffix):
+                # a salvage of our own that was cut short
+                os.unlink(os.path.join(self._work_dir, file_name))
+
+        recovered = list()
+        for file_name in file_names:
+            work_path = os.path.join(self._work_dir, file_name)
+            if file_name.endswith(_salvage_suffix) or \
+                is_log_stream_index_name(file_name) or \
+                not file_name.startswith(self._prefix) or \
+                not file_name.endswith(self._suffix):
+                continue
+
+            salvage_path = "".join([work_path, _salvage_suffix, ])
+            frame_count, whole = salvage_log_stream_file(work_path,
+                                                         salvage_path,
+                                                         self._compresslevel)
+            index_path = log_stream_index_name(work_path)
+            index = None
+            if whole:
+                os.unlink(salvage_path)
+                if os.path.exists(index_path):
+                    with open(index_path, "r") as input_file:
+                        index = json.load(input_file)
+            else:
+                os.rename(salvage_path, work_path)
+            if os.path.exists(index_path):
+                os.unlink(index_path)
+
+            if frame_count == 0:
+                os.unlink(work_path)
+                recovered.append((file_name, None, 0, whole, ))
+                continue
+
+            complete_file_name = self._complete_file_name(file_name)
+            if index is not None:
+                index["file_name"] = complete_file_name
+                index_work_path = os.path.join(
+                    self._work_dir, log_stream_index_name(complete_file_name))
+                with open(index_work_path, "w") as output_file:
+                    json.dump(index, output_file)
+                os.rename(index_work_path,
+                          os.path.join(self._complete_dir,
+                                       log_stream_index_name(
+                                           complete_file_name)))
+            os.rename(work_path,
+                      os.path.join(self._complete_dir, complete_file_name))
+            recovered.append((file_name,
+                              complete_file_name,
+                              frame_count,
+                              whole, ))
+        return recovered
+
+def generate_log_stream_from_file(path, decompress=zlib.decompress,
+                                  tolerant=False, bad_frames=None):
     """
     yield a sequence of (header, data) tuples from a named file
+
+    decompress
+        the function that decompresses version 3 frames, for example
+        the decompress method of a ZlibDecompressor that knows the 
+        producers' preset dictionaries
+
+    tolerant
+        if True, a file that is torn (its gzip member or frame cut short,
+        as a writer that is killed leaves it) or damaged ends quietly
+        after the last frame we can read
+
+    bad_frames
+        if given, a list we add the error of each version 3 frame we skip
+        to: one whose header or data won't decompress (to the size the
+        frame gives) or unpack. We skip such frames in any case.
     """
     input_gzip_file = GzipFile(filename=path)
+    try:
+        for header, data in \
+            _generate_log_stream_from_gzip_file(input_gzip_file,
+                                                decompress,
+                                                bad_frames):
+            yield header, data
+    except (EOFError, IOError, OSError, zlib.error, LogStreamError):
+        if not tolerant:
+            raise
+
+def _read_exactly(input_gzip_file, size, name):
+    value = input_gzip_file.read(size)
+    if len(value) != size:
+        raise LogStreamError("Invalid {0} read {1} expected {2}".format(
+            name, len(value), size))
+    return value
+
+def _decompress_exactly(decompress, compressed_value, size, name):
+    value = decompress(compressed_value)
+    if len(value) != size:
+        raise LogStreamError("Invalid {0} size {1} expected {2}".format(
+            name, len(value), size))
+    return value
 
+def _unpack_compressed_frame(decompress,
+                             flags,
+                             compressed_header,
+                             header_size,
+                             compressed_data,
+                             data_size):
+    """
+    return the list of (header, data) tuples in a version 3 frame
+    """
+    header = _decompress_exactly(decompress,
+                                 compressed_header,
+                                 header_size,
+                                 "header")
+    data = _decompress_exactly(decompress,
+                               compressed_data,
+                               data_size,
+                               "data")
+
+    if not flags & _compressed_frame_batch_flag:
+        return [(header, data, ), ]
+
+    headers = unpack_batch_block(header)
+    bodies = unpack_batch_block(data)
+    if len(headers) != len(bodies):
+        raise LogStreamError("{0} headers but {1} bodies".format(
+            len(headers), len(bodies)))
+    return list(zip(headers, bodies))
+
+def _generate_log_stream_from_gzip_file(input_gzip_file, decompress,
+                                        bad_frames=None):
     while True:
-        packed_frame = input_gzip_file.read(_frame_size)
-        if len(packed_frame) < _frame_size:
-            raise StopIteration()
+        packed_version = input_gzip_file.read(1)
+        if len(packed_version) == 0:
+            return
 
-        protocol_version, header_size, data_size = struct.unpack(_frame_format,
-                                                                 packed_frame)
-        if protocol_version != _frame_protocol_version:
+        protocol_version = packed_version[0]
+        if not protocol_version in _frame_body_formats:
             raise LogStreamError("Invalid protocol {0} expected {1}".format(
                 protocol_version, _frame_protocol_version))
 
-        header = input_gzip_file.read(header_size)
-        if len(header) != header_size:
-            raise LogStreamError("Invalid header read {0} expected {1}".format(
-                len(header), header_size))
+        frame_body_size = _frame_body_sizes[protocol_version]
+        packed_frame_body = input_gzip_file.read(frame_body_size)
+        if len(packed_frame_body) < frame_body_size:
+            return
+
+        if protocol_version == 1:
+            header_size, data_size = \
+                struct.unpack(_frame_body_formats[1], packed_frame_body)
+        elif protocol_version == 2:
+            encoding, header_size, data_size = \
+                struct.unpack(_frame_body_formats[2], packed_frame_body)
+        else:
+            encoding, flags, compressed_header_size, header_size, \
+                compressed_data_size, data_size = \
+                struct.unpack(_frame_body_formats[3], packed_frame_body)
+
+        if protocol_version > 1 and not encoding in header_encodings:
+            raise LogStreamError("Invalid header encoding {0}".format(
+                encoding))
+
+        if protocol_version < 3:
+            header = _read_exactly(input_gzip_file, header_size, "header")
+            data = _read_exactly(input_gzip_file, data_size, "data")
+            yield header, data
+            continue
+
+        compressed_header = _read_exactly(input_gzip_file, 
+                                          compressed_header_size, 
+                                          "compressed header")
+        compressed_data = _read_exactly(input_gzip_file, 
+                                        compressed_data_size, 
+                                        "compressed data")
+        try:
+            frame_records = _unpack_compressed_frame(decompress,
+                                                     flags,
+                                                     compressed_header,
+                                                     header_size,
+                                                     compressed_data,
+                                                     data_size)
+        except _bad_frame_errors:
+            # we know where the next frame starts: skip this one
+            if bad_frames is not None:
+                bad_frames.append(sys.exc_info()[1])
+            continue
+        for header, data in frame_records:
+            yield header, data
+
+def _generate_gzip_chunks(input_file, size, chunk_size):
+    """
+    yield the decompressed contents of the gzip members in the next size
+    bytes of input_file (or the rest of it, if size is None), in chunks of
+    no more than chunk_size bytes
+    """
+    read_buffer = bytearray(chunk_size)
+    read_view = memoryview(read_buffer)
+    decompressor = None
+    unused_data = b""
+    while True:
+        if len(unused_data) > 0:
+            # the start of the next member, read with the end of the last
+            data = unused_data
+            unused_data = b""
+        else:
+            read_size = chunk_size if size is None else min(chunk_size, size)
+            if read_size == 0:
+                break
+            read_count = input_file.readinto(read_view[:read_size])
+            if read_count == 0:
+                break
+            if size is not None:
+                size -= read_count
+            data = read_view[:read_count]
+
+        if decompressor is None:
+            # gzip files may be padded with zeros between (or after) members
+            if data[0] == 0:
+                data = bytes(data).lstrip(b"\x00")
+                if len(data) == 0:
+                    continue
+            decompressor = zlib.decompressobj(_gzip_wbits)
+
+        while True:
+            chunk = decompressor.decompress(data, chunk_size)
+            if len(chunk) > 0:
+                yield chunk
+            # at the end of a member, the rest of the input is unused_data
+            # (unconsumed_tail may hold it too)
+            if decompressor.eof:
+                break
+            data = decompressor.unconsumed_tail
+            if len(data) == 0 and len(chunk) < chunk_size:
+                break
+
+        if decompressor.eof:
+            unused_data = decompressor.unused_data
+            decompressor = None
 
-        data = input_gzip_file.read(data_size)
-        if len(data) != data_size:
-            raise LogStreamError("Invalid data read {0} expected {1}".format(
-                len(data), data_size))
+    if decompressor is not None:
+        raise EOFError("Compressed file ended before the "
+                       "end-of-stream marker was reached")
 
+def _parse_log_stream_frames(buffer, decompress, views, records,
+                             bad_frames=None):
+    """
+    parse the complete frames at the start of buffer, adding their
+    (header, data) tuples to records, and the errors of the version 3
+    frames we skip to bad_frames (if given)
+
+    return a tuple of (offset of the first incomplete frame,
+    size that frame needs to be complete (0 if not yet known))
+    """
+    buffer_view = memoryview(buffer)
+    source = buffer_view if views else buffer
+    end = len(buffer)
+    offset = 0
+    frame_body_structs = _frame_body_structs
+    frame_body_sizes = _frame_body_sizes
+    while offset < end:
+        protocol_version = buffer[offset]
+        if not protocol_version in frame_body_structs:
+            raise LogStreamError("Invalid protocol {0} expected {1}".format(
+                protocol_version, _frame_protocol_version))
+
+        body_offset = offset + 1 + frame_body_sizes[protocol_version]
+        if body_offset > end:
+            return offset, 0
+
+        if protocol_version == 1:
+            encoding = None
+            header_size, data_size = \
+                frame_body_structs[1].unpack_from(buffer, offset + 1)
+        elif protocol_version == 2:
+            encoding, header_size, data_size = \
+                frame_body_structs[2].unpack_from(buffer, offset + 1)
+        else:
+            encoding, flags, compressed_header_size, header_size, \
+                compressed_data_size, data_size = \
+                frame_body_structs[3].unpack_from(buffer, offset + 1)
+
+        if encoding is not None and not encoding in header_encodings:
+            raise LogStreamError("Invalid header encoding {0}".format(
+                encoding))
+
+        if protocol_version < 3:
+            data_offset = body_offset + header_size
+            frame_end = data_offset + data_size
+            if frame_end > end:
+                return offset, frame_end - offset
+            records.append((source[body_offset:data_offset],
+                            source[data_offset:frame_end], ))
+            offset = frame_end
+            continue
+
+        data_offset = body_offset + compressed_header_size
+        frame_end = data_offset + compressed_data_size
+        if frame_end > end:
+            return offset, frame_end - offset
+        offset = frame_end
+        try:
+            records.extend(
+                _unpack_compressed_frame(decompress,
+                                         flags,
+                                         buffer_view[body_offset:data_offset],
+                                         header_size,
+                                         buffer_view[data_offset:frame_end],
+                                         data_size))
+        except _bad_frame_errors:
+            if bad_frames is not None:
+                bad_frames.append(sys.exc_info()[1])
+
+    return offset, 0
+
+def _check_incomplete_frame(buffer):
+    """
+    raise LogStreamError for a frame cut short in its header or data,
+    as generate_log_stream_from_file would. A frame cut short before
+    then ends the stream quietly.
+    """
+    protocol_version = buffer[0]
+    body_offset = 1 + _frame_body_sizes[protocol_version]
+    if len(buffer) < body_offset:
+        return
+    frame_body = _frame_body_structs[protocol_version].unpack_from(buffer, 1)
+    if protocol_version < 3:
+        names = ["header", "data", ]
+        sizes = frame_body[-2:]
+    else:
+        names = ["compressed header", "compressed data", ]
+        sizes = [frame_body[2], frame_body[4], ]
+    available = len(buffer) - body_offset
+    for name, size in zip(names, sizes):
+        if available < size:
+            raise LogStreamError("Invalid {0} read {1} expected {2}".format(
+                name, available, size))
+        available -= size
+
+def _generate_log_stream_batches(chunks, decompress, views, bad_frames):
+    # the start of a frame that runs on into the next chunk(s)
+    pending = list()
+    pending_size = 0
+    needed_size = 0
+    for chunk in chunks:
+        if len(pending) > 0:
+            pending.append(chunk)
+            pending_size += len(chunk)
+            if pending_size < needed_size:
+                continue
+            chunk = b"".join(pending)
+            pending = list()
+
+        records = list()
+        try:
+            offset, needed_size = \
+                _parse_log_stream_frames(chunk,
+                                         decompress,
+                                         views,
+                                         records,
+                                         bad_frames)
+        except Exception:
+            # hand over the records ahead of the bad frame first
+            if len(records) > 0:
+                yield records
+            raise
+        if len(records) > 0:
+            yield records
+        if offset < len(chunk):
+            pending.append(chunk[offset:])
+            pending_size = len(chunk) - offset
+
+    if len(pending) > 0:
+        _check_incomplete_frame(b"".join(pending))
+
+def generate_log_stream_batches_from_file(path,
+                                          blocks=None,
+                                          decompress=zlib.decompress,
+                                          chunk_size=_default_read_chunk_size,
+                                          views=False,
+                                          bad_frames=None):
+    """
+    yield a sequence of lists of (header, data) tuples from a named file,
+    or from the listed blocks of it (see load_log_stream_index)
+
+    chunk_size
+        the number of bytes we read, and decompress, at a time
+
+    views
+        if True, uncompressed headers and data are memoryviews of the
+        decompressed chunk rather than bytes. They stay valid after we
+        move on.
+
+    bad_frames
+        as for generate_log_stream_from_file
+    """
+    with open(path, "rb") as input_file:
+        if blocks is None:
+            for records in _generate_log_stream_batches(
+                _generate_gzip_chunks(input_file, None, chunk_size),
+                decompress,
+                views,
+                bad_frames):
+                yield records
+            return
+
+        file_size = os.fstat(input_file.fileno()).st_size
+        for block in blocks:
+            if file_size < block["offset"] + block["size"]:
+                raise LogStreamError(
+                    "Invalid block read {0} expected {1}".format(
+                        max(0, file_size - block["offset"]),
+                        block["size"]))
+            input_file.seek(block["offset"])
+            for records in _generate_log_stream_batches(
+                _generate_gzip_chunks(input_file, block["size"], chunk_size),
+                decompress,
+                views,
+                bad_frames):
+                yield records
+
+def _complete_frames_size(buffer):
+    """
+    return a tuple of (size of the complete frames at the start of buffer,
+    number of them, True if what follows them is a frame we can't read
+    rather than one that is incomplete)
+    """
+    end = len(buffer)
+    offset = 0
+    frame_count = 0
+    while offset < end:
+        protocol_version = buffer[offset]
+        if not protocol_version in _frame_body_structs:
+            return offset, frame_count, True
+        body_offset = offset + 1 + _frame_body_sizes[protocol_version]
+        if body_offset > end:
+            break
+        frame_body = \
+            _frame_body_structs[protocol_version].unpack_from(buffer,
+                                                              offset + 1)
+        if protocol_version > 1 and not frame_body[0] in header_encodings:
+            return offset, frame_count, True
+        if protocol_version < 3:
+            frame_end = body_offset + frame_body[-2] + frame_body[-1]
+        else:
+            frame_end = body_offset + frame_body[2] + frame_body[4]
+        if frame_end > end:
+            break
+        offset = frame_end
+        frame_count += 1
+    return offset, frame_count, False
+
+def salvage_log_stream_file(path,
+                            output_path,
+                            compresslevel=9,
+                            chunk_size=_default_read_chunk_size):
+    """
+    write the complete frames of a log stream file, which may be torn
+    (see generate_log_stream_from_file), to output_path as one gzip
+    member. We read up to the first frame we can't read, or the first
+    gzip data we can't decompress.
+
+    return a tuple of (number of frames written, True if the file was
+    whole: we read all of it and it ended with a complete frame)
+    """
+    frame_count = 0
+    whole = True
+    pending = b""
+    with open(path, "rb") as input_file:
+        with GzipFile(filename=output_path,
+                      mode="wb",
+                      compresslevel=compresslevel) as output_gzip_file:
+            try:
+                for chunk in _generate_gzip_chunks(input_file,
+                                                   None,
+                                                   chunk_size):
+                    buffer = pending + chunk if len(pending) > 0 else chunk
+                    size, count, unreadable = _complete_frames_size(buffer)
+                    output_gzip_file.write(memoryview(buffer)[:size])
+                    frame_count += count
+                    pending = buffer[size:]
+                    if unreadable:
+                        whole = False
+                        break
+            except (EOFError, zlib.error):
+                whole = False
+    if len(pending) > 0:
+        whole = False
+    return frame_count, whole
+
+def load_log_stream_index(path):
+    """
+    return the sidecar index for a log stream file, 
+    or None if the file has no index
+    """
+    index_path = log_stream_index_name(path)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path, "r") as input_file:
+        index = json.load(input_file)
+    if index["version"] != _index_version:
+        raise LogStreamError("Invalid index version {0} expected {1}".format(
+            index["version"], _index_version))
+    return index
+
+def select_log_stream_index_blocks(index, 
+                                   hostname_pred=None, 
+                                   log_path_pred=None,
+                                   low_timestamp=None,
+                                   high_timestamp=None):
+    """
+    return the blocks from an index which may hold matching records
+
+    hostname_pred, log_path_pred
+        functions of a hostname or log_path string, returning True for 
+        a match. A block matches if any of its values match.
+
+    low_timestamp, high_timestamp
+        epoch times bounding the header timestamps we want
+    """
+    selected = list()
+    for block in index["blocks"]:
+        if block["unknown"]:
+            selected.append(block)
+            continue
+        # a block of string tables alone (from an older writer)
+        # has no timestamps to match
+        if block["min_timestamp"] is None and \
+            (low_timestamp is not None or high_timestamp is not None):
+            continue
+        if low_timestamp is not None and \
+            block["max_timestamp"] < low_timestamp:
+            continue
+        if high_timestamp is not None and \
+            block["min_timestamp"] > high_timestamp:
+            continue
+        if hostname_pred is not None and \
+            not any(hostname_pred(h) for h in block["hostnames"]):
+            continue
+        if log_path_pred is not None and \
+            not any(log_path_pred(p) for p in block["log_paths"]):
+            continue
+        selected.append(block)
+    return selected
+
+def generate_log_stream_from_blocks(path, blocks, 
+                                    decompress=zlib.decompress,
+                                    bad_frames=None):
+    """
+    yield a sequence of (header, data) tuples from the listed blocks 
+    of a named file (see load_log_stream_index)
+
+    bad_frames
+        as for generate_log_stream_from_file
+    """
+    with open(path, "rb") as input_file:
+        for block in blocks:
+            input_file.seek(block["offset"])
+            member = input_file.read(block["size"])
+            if len(member) != block["size"]:
+                raise LogStreamError(
+                    "Invalid block read {0} expected {1}".format(
+                        len(member), block["size"]))
+            input_gzip_file = GzipFile(fileobj=io.BytesIO(member))
+            for header, data in \
+                _generate_log_stream_from_gzip_file(input_gzip_file, 
+                                                    decompress,
+                                                    bad_frames):
+                yield header, data
+
+def generate_log_stream_from_indexed_file(path, 
+                                          hostname_pred=None, 
+                                          log_path_pred=None,
+                                          low_timestamp=None,
+                                          high_timestamp=None,
+                                          decompress=zlib.decompress,
+                                          bad_frames=None):
+    """
+    yield a sequence of (header, data) tuples from a named file, 
+    reading only the blocks which may hold matching records 
+    (see select_log_stream_index_blocks). 
+    If the file has no index, we read all of it.
+    bad_frames is as for generate_log_stream_from_file.
+    """
+    index = load_log_stream_index(path)
+    if index is None:
+        log_stream = generate_log_stream_from_file(path,
+                                                   decompress,
+                                                   bad_frames=bad_frames)
+    else:
+        blocks = select_log_stream_index_blocks(index,
+                                                hostname_pred, 
+                                                log_path_pred,
+                                                low_timestamp,
+                                                high_timestamp)
+        log_stream = generate_log_stream_from_blocks(path, blocks, 
+                                                     decompress,
+                                                     bad_frames)
+    for header, data in log_stream:
         yield header, data
 
-def generate_log_stream_from_directory(directory_name):
+def _log_stream_file_paths(directory_name):
+    """
+    return the paths of the log stream files in a directory, in name order
+    (skipping sidecar indices)
+    """
+    return [os.path.join(directory_name, file_name) \
+            for file_name in sorted(os.listdir(directory_name)) \
+            if not is_log_stream_index_name(file_name)]
+
+def generate_log_stream_from_directory(directory_name, 
+                                       decompress=zlib.decompress,
+                                       bad_frames=None):
     """
     yield a sequence of (header, data) tuples from the files in a directory
+    (skipping sidecar indices).
+    bad_frames is as for generate_log_stream_from_file.
     """
-    for file_name in sorted(os.listdir(directory_name)):
-        path = os.path.join(directory_name, file_name)
+    for path in _log_stream_file_paths(directory_name):
         # this could be 'yield from' in Python 3.3
-        for header, data in generate_log_stream_from_file(path):
+        for header, data in generate_log_stream_from_file(
+            path, decompress, bad_frames=bad_frames):
             yield  header, data       
+
+def _log_stream_read_units(path, unit_bytes):
+    """
+    return the (offset, size) byte ranges to read a file in, as separate
+    units of work: runs of whole blocks of at least unit_bytes (the last
+    may be less), cut at the block offsets of its index. A file without
+    an index is read whole.
+    """
+    file_size = os.path.getsize(path)
+    index = load_log_stream_index(path)
+    if index is None:
+        return [(0, file_size, ), ]
+    units = list()
+    start = 0
+    for block in index["blocks"]:
+        if block["offset"] - start >= unit_bytes:
+            units.append((start, block["offset"] - start, ))
+            start = block["offset"]
+    units.append((start, file_size - start, ))
+    return units
+
+def _read_log_stream_unit(path, offset, size, decompress,
+                          record_filter, record_map):
+    """
+    return a tuple of (the list of records in a byte range of a file that
+    pass record_filter, passed through record_map, the list of errors of
+    the bad frames we skipped) (in a worker process)
+    """
+    records = list()
+    bad_frames = list()
+    blocks = [{"offset" : offset, "size" : size, }, ]
+    for batch in generate_log_stream_batches_from_file(path,
+                                                       blocks,
+                                                       decompress=decompress,
+                                                       bad_frames=bad_frames):
+        for header, data in batch:
+            if record_filter is not None and not record_filter(header, data):
+                continue
+            if record_map is None:
+                records.append((header, data, ))
+            else:
+                records.append(record_map(header, data))
+    return records, bad_frames
+
+def generate_log_stream_from_directory_parallel(directory_name,
+                                                decompress=zlib.decompress,
+                                                record_filter=None,
+                                                record_map=None,
+                                                workers=None,
+                                                ordered=True,
+                                                unit_bytes=\
+                                                    _default_read_unit_bytes,
+                                                lookahead_bytes=None,
+                                                bad_frames=None):
+    """
+    yield the records of the files in a directory (skipping sidecar
+    indices), reading the files in a pool of worker processes
+
+    record_filter
+        a function of (header, data), returning True for a record we want
+        (default all of them)
+
+    record_map
+        a function of (header, data), returning what we yield for a record
+        (default the (header, data) tuple)
+
+    The filter and map run in the workers, so only the records we want are
+    sent back. They, and decompress, must pickle: module level functions,
+    or methods of objects that pickle, such as a ZlibDecompressor.
+
+    workers
+        the number of worker processes (default one for each cpu)
+
+    ordered
+        if True, yield the records of the files in file name order,
+        as generate_log_stream_from_directory does. If False, yield the
+        records of each unit of work as soon as it has been read.
+
+    unit_bytes
+        the (compressed) bytes of a file a worker reads as one unit,
+        cut at the blocks of the file's index. A file without an index
+        is one unit, however big it is.
+
+    lookahead_bytes
+        the most (compressed) bytes of units being read, or waiting to be
+        yielded, at any one time (default two units for each worker),
+        though we always read at least one unit. The records of a unit
+        are held in memory uncompressed, so we hold about this many bytes
+        times the compression ratio (less what record_filter drops).
+
+    bad_frames
+        as for generate_log_stream_from_file
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if lookahead_bytes is None:
+        lookahead_bytes = \
+            _default_lookahead_units_per_worker * max(workers, 1) * unit_bytes
+
+    units = deque()
+    paths = deque(_log_stream_file_paths(directory_name))
+
+    # (future, size) of units, in file name and offset order
+    pending = deque()
+    pending_bytes = 0
+
+    executor = ProcessPoolExecutor(max_workers=max(workers, 1))
+    try:
+        while len(paths) > 0 or len(units) > 0 or len(pending) > 0:
+            while len(units) > 0 or len(paths) > 0:
+                if len(units) == 0:
+                    path = paths.popleft()
+                    units.extend((path, offset, size, ) for (offset, size) \
+                                 in _log_stream_read_units(path, unit_bytes))
+                    continue
+                path, offset, size = units[0]
+                if len(pending) > 0 and \
+                    pending_bytes + size > lookahead_bytes:
+                    break
+                units.popleft()
+                pending.append((executor.submit(_read_log_stream_unit,
+                                                path,
+                                                offset,
+                                                size,
+                                                decompress,
+                                                record_filter,
+                                                record_map),
+                                size, ))
+                pending_bytes += size
+
+            if ordered:
+                future, size = pending.popleft()
+            else:
+                done, _ = wait([f for (f, _) in pending],
+                               return_when=FIRST_COMPLETED)
+                future, size = next(p for p in pending if p[0] in done)
+                pending.remove((future, size, ))
+            pending_bytes -= size
+
+            records, unit_bad_frames = future.result()
+            if bad_frames is not None:
+                bad_frames.extend(unit_bad_frames)
+            # this could be 'yield from' in Python 3.3
+            for record in records:
+                yield record
+    finally:
+        # if the caller stops early, don't read the units it won't see
+        for future, _ in pending:
+            future.cancel()
+        executor.shutdown()
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+log_stream_merge.py
+
+Streaming merge of log streams that are roughly in time order, such as the
+archives that several aggregators wrote for the same time slot.
+
+Each stream passes through a reorder window: a heap of at most window
+records, from which we release the earliest each time a new record comes in.
+A record that arrives up to window records late still comes out in order.
+The reordered streams are then merged through a second heap, one entry per
+stream, and duplicate records (the same record archived by more than one
+aggregator) are dropped as they come out.
+
+Memory depends on the window and the number of streams, not on the number of
+records.
+"""
+from collections import deque
+import heapq
+
+_default_window = 1000
+
+def header_merge_key(header):
+    """
+    the key we order and de-duplicate decoded headers by
+    """
+    return (header["timestamp"], header["uuid"], header.get("sequence", 0), )
+
+def generate_reordered(items, key, window=_default_window):
+    """
+    yield the items of a sequence in key order, as far as a reorder window
+    of window items can put them in order
+    """
+    heap = list()
+    for count, item in enumerate(items):
+        # count breaks ties, so we never compare the items themselves
+        entry = (key(item), count, item, )
+        if len(heap) < window:
+            heapq.heappush(heap, entry)
+            continue
+        _, _, item = heapq.heappushpop(heap, entry)
+        yield item
+
+    while len(heap) > 0:
+        _, _, item = heapq.heappop(heap)
+        yield item
+
+def generate_merged(streams, key):
+    """
+    yield the items of several sequences, each in key order, in key order
+    """
+    heap = list()
+    iterators = [iter(stream) for stream in streams]
+    for index, iterator in enumerate(iterators):
+        for item in iterator:
+            heap.append((key(item), index, item, ))
+            break
+    heapq.heapify(heap)
+
+    while len(heap) > 0:
+        _, index, item = heap[0]
+        yield item
+        for next_item in iterators[index]:
+            heapq.heapreplace(heap, (key(next_item), index, next_item, ))
+            break
+        else:
+            heapq.heappop(heap)
+
+def generate_deduplicated(items, key, window=_default_window):
+    """
+    yield the items of a sequence in key order, dropping any item whose key
+    is among the last window keys we have seen
+    """
+    recent_keys = set()
+    recent_key_queue = deque()
+    for item in items:
+        item_key = key(item)
+        if item_key in recent_keys:
+            continue
+        yield item
+        recent_keys.add(item_key)
+        recent_key_queue.append(item_key)
+        if len(recent_key_queue) > window:
+            recent_keys.discard(recent_key_queue.popleft())
+
+def generate_merged_log_records(streams, key, window=_default_window):
+    """
+    streams
+        sequences of records, each roughly in key order
+
+    return a generator of the records of all the streams, in key order 
+    (as far as a reorder window of window records per stream allows), 
+    without duplicates
+    """
+    reordered_streams = [generate_reordered(stream, key, window) \
+                         for stream in streams]
+    merged = generate_merged(reordered_streams, key)
+    return generate_deduplicated(merged, key, window)
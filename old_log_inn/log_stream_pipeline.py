@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+log_stream_pipeline.py
+
+A pipelined write path for zmq_log_stream_writer, to spread the zlib work
+over several cores.
+
+    the caller (the receive thread) submits batches of messages,
+    still compressed as they came off the wire
+
+    a pool of worker threads decompresses each batch and compresses its
+    records into finished blocks (gzip members), see encode_log_stream_block.
+    zlib releases the GIL while it works, so the workers run in parallel.
+
+    a single writer thread takes the finished blocks in the order the
+    batches were submitted and appends them to the LogStreamWriter
+
+A worker knows only the string tables of its own batch: the batch that
+holds a producer's table may not have been encoded yet. Each block lists
+the producers it has records of but no table for, and the writer thread,
+which sees the blocks in order, puts their tables ahead of it.
+
+The output is the same concatenated-gzip log stream the LogStreamWriter
+writes on its own. Once the pipeline is started, the LogStreamWriter belongs
+to the writer thread: the caller must not use it until close() returns.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import sys
+import threading
+import time
+
+from old_log_inn.log_batch import unpack_message
+from old_log_inn.log_stream import encode_log_stream_block
+from old_log_inn.zlib_dictionary import ZlibDictionaryError
+
+_queue_poll_interval = 1.0
+
+class LogStreamPipelineError(Exception):
+    pass
+
+def _encode_messages(messages, decompressor, index, block_records):
+    """
+    return a tuple of (list of LogStreamBlock, discarded message count)
+    for a batch of messages
+    """
+    string_tables = dict()
+    records = list()
+    discarded_count = 0
+    for frames in messages:
+        try:
+            records.extend(unpack_message(frames, decompressor.decompress))
+        except ZlibDictionaryError:
+            discarded_count += 1
+
+    if block_records is None:
+        block_records = max(len(records), 1)
+
+    blocks = list()
+    for offset in range(0, len(records), block_records):
+        blocks.append(
+            encode_log_stream_block(records[offset:offset+block_records],
+                                    string_tables,
+                                    index))
+    return blocks, discarded_count
+
+class LogStreamPipeline(object):
+    """
+    decompress and compress batches of messages in a pool of worker
+    threads, appending the finished blocks in order to a LogStreamWriter
+    """
+    def __init__(self, stream_writer, decompressor, worker_count,
+                 polling_interval=_queue_poll_interval,
+                 queue_size=None,
+                 rollover_timer=False):
+        """
+        each batch becomes a block, or if the stream writer writes an index,
+        blocks of its index_block_records
+
+        polling_interval
+            how often the idle writer thread checks for rollover and flush
+
+        queue_size
+            most batches in flight before submit blocks
+            (default twice the worker count)
+
+        rollover_timer
+            if True, the idle writer thread also wakes at the end of the
+            current file's time slot, to complete the file on time
+        """
+        self._stream_writer = stream_writer
+        self._decompressor = decompressor
+        self._polling_interval = polling_interval
+        self._rollover_timer = rollover_timer
+
+        self._counters = {"submitted"   : 0,
+                          "written"     : 0,
+                          "discarded"   : 0, }
+
+        self._executor = ThreadPoolExecutor(max_workers=worker_count)
+        self._pending = queue.Queue(maxsize=queue_size or 2 * worker_count)
+        self._writer_thread = threading.Thread(target=self._write_blocks,
+                                               name="LogStreamPipeline")
+        self._writer_thread.daemon = True
+        self._writer_error = None
+
+    def counters(self):
+        """
+        return a dict of the pipeline's counters
+        """
+        return dict(self._counters)
+
+    def start(self):
+        self._writer_thread.start()
+
+    def submit(self, messages, current_time=None):
+        """
+        messages
+            a list of messages, each a list of frames (topic excluded)
+            as they came off the wire
+
+        current_time
+            the time the messages were received, which decides the file
+            they go to
+
+        blocks while the pipeline is full
+        """
+        if current_time is None:
+            current_time = time.time()
+        index_block_records = self._stream_writer.index_block_records
+        future = self._executor.submit(_encode_messages,
+                                       messages,
+                                       self._decompressor,
+                                       index_block_records is not None,
+                                       index_block_records)
+        self._counters["submitted"] += len(messages)
+        while True:
+            self._check_writer()
+            try:
+                self._pending.put((future, current_time, ),
+                                  timeout=self._polling_interval)
+            except queue.Full:
+                continue
+            break
+
+    def close(self):
+        """
+        write out everything submitted, flush the LogStreamWriter and
+        stop the threads
+        """
+        while self._writer_thread.is_alive():
+            try:
+                self._pending.put(None, timeout=self._polling_interval)
+            except queue.Full:
+                continue
+            break
+        self._writer_thread.join()
+        self._executor.shutdown()
+        self._check_writer()
+
+    def _check_writer(self):
+        if self._writer_error is not None:
+            raise LogStreamPipelineError("writer thread failed: {0}".format(
+                self._writer_error))
+
+    def _write_blocks(self):
+        try:
+            self._write_blocks_until_closed()
+        except Exception:
+            self._writer_error = sys.exc_info()[1]
+
+    def _write_blocks_until_closed(self):
+        while True:
+            timeout = self._polling_interval
+            if self._rollover_timer:
+                timeout = self._stream_writer.poll_timeout(timeout)
+            try:
+                item = self._pending.get(timeout=timeout)
+            except queue.Empty:
+                self._stream_writer.check_for_rollover()
+                self._stream_writer.check_for_flush()
+                continue
+
+            if item is None:
+                self._stream_writer.flush()
+                break
+
+            future, current_time = item
+            blocks, discarded_count = future.result()
+            self._counters["discarded"] += discarded_count
+            for block in blocks:
+                self._stream_writer.append_block(block, current_time)
+                self._counters["written"] += block.record_count
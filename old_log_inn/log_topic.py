@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+log_topic.py
+
+The topic frame of published log messages.
+
+A forwarder publishes each message under a topic that says where its records
+come from:
+
+    hostname/nodename/log_path
+
+(nodename empty if the producer has none). ZMQ filters subscriptions by
+topic prefix at the PUB side, so a subscriber that only wants some hosts or
+log files can subscribe to a prefix such as "host01/" and the rest of the
+traffic is never sent to it.
+
+A batch whose records come from more than one producer is split into one
+batch per topic, each published under its own full topic, so a subscriber
+gets the records of the topics it wants and no others. A message we can't
+decode is published under the empty topic, which only the subscribers to
+everything get.
+
+subscription_prefix turns the regular expressions of a subscriber's header
+filter (see header_filter.py) into the longest topic prefix that every
+matching record must have.
+"""
+import zlib
+
+from old_log_inn.log_batch import is_batch_marker, pack_batch, \
+    unpack_batch_block
+from old_log_inn.log_header import header_encoding, \
+    header_encoding_string_table, \
+    header_uuid_bytes
+
+topic_separator = "/"
+
+# characters with a meaning in a regular expression
+_regexp_special = set(".^$*+?{}[]|()\\")
+
+# characters that may follow a backslash to stand for themselves
+_regexp_escapable = set(".^$*+?{}[]|()\\/-")
+
+def log_topic(header):
+    """
+    return the topic (bytes) of a decoded header (or string table values)
+    """
+    return topic_separator.join([header["hostname"],
+                                 header.get("nodename", ""),
+                                 header["log_path"], ]).encode("utf-8")
+
+def _record_topic(raw_header, header_decoder):
+    if header_encoding(raw_header) == header_encoding_string_table:
+        header_decoder.add_string_table(raw_header)
+        return log_topic(
+            header_decoder.string_table_values(header_uuid_bytes(raw_header)))
+    return log_topic(header_decoder.decode(raw_header))
+
+def message_topics(frames, decompress, header_decoder, compress=zlib.compress):
+    """
+    frames
+        the frames of a log message (topic excluded)
+
+    decompress
+        the function that decompresses each frame
+
+    header_decoder
+        a HeaderDecoder, which remembers the string tables of the binary
+        producers
+
+    compress
+        the function that compresses the blocks of the batches we split
+
+    return a list of tuples of (topic (bytes), frames) to publish:
+    the message under its topic, or, for a batch whose records have
+    different topics, one batch per topic, in the order the topics first
+    appear
+
+    We only decompress the header (or header block) of a message, and the
+    body block of a batch we split.
+    Raises what decompress and HeaderDecoder.decode raise.
+    """
+    if not is_batch_marker(frames[0]):
+        return [(_record_topic(decompress(frames[0]), header_decoder),
+                 frames, ), ]
+
+    raw_headers = unpack_batch_block(decompress(frames[1]))
+    topics = [_record_topic(raw_header, header_decoder) \
+              for raw_header in raw_headers]
+    if len(set(topics)) <= 1:
+        return [(topics[0] if topics else b"", frames, ), ]
+
+    bodies = unpack_batch_block(decompress(frames[2]))
+    topic_list = list()
+    topic_records = dict()
+    for topic, raw_header, body in zip(topics, raw_headers, bodies):
+        if topic not in topic_records:
+            topic_list.append(topic)
+            topic_records[topic] = (list(), list(), )
+        topic_headers, topic_bodies = topic_records[topic]
+        topic_headers.append(raw_header)
+        topic_bodies.append(body)
+
+    return [(topic, pack_batch(topic_records[topic][0],
+                               topic_records[topic][1],
+                               compress), ) \
+            for topic in topic_list]
+
+def _literal_prefix(regexp):
+    """
+    return a tuple of (literal, complete)
+
+    literal
+        the text every string that regexp matches (re.match) begins with
+
+    complete
+        True if regexp matches exactly literal and nothing else
+    """
+    if "|" in regexp:
+        return "", False
+
+    if regexp.startswith("^"):
+        regexp = regexp[1:]
+
+    accum = list()
+    index = 0
+    while index < len(regexp):
+        char = regexp[index]
+        if char == "\\":
+            if index + 1 < len(regexp) and \
+                regexp[index+1] in _regexp_escapable:
+                char = regexp[index+1]
+                index += 2
+            else:
+                break
+        elif char in _regexp_special:
+            break
+        else:
+            index += 1
+
+        # a quantifier may repeat or leave out the character before it
+        if index < len(regexp) and regexp[index] in "*+?{":
+            return "".join(accum), False
+        accum.append(char)
+
+    literal = "".join(accum)
+    rest = regexp[index:]
+    return literal, rest in ["$", "\\Z", ]
+
+def subscription_prefix(host_regexp=None,
+                        node_regexp=None,
+                        log_path_regexp=None):
+    """
+    return the topic prefix (bytes) to subscribe to for the records whose
+    headers match (re.match) the regular expressions.
+    None or "" matches anything.
+    """
+    regexps = [host_regexp, node_regexp, log_path_regexp, ]
+    accum = list()
+    for index, regexp in enumerate(regexps):
+        literal, complete = _literal_prefix(regexp or "")
+        if index < len(regexps) - 1 and topic_separator in literal:
+            # no hostname or nodename holds the separator
+            literal = literal[:literal.index(topic_separator)]
+            complete = False
+        accum.append(literal)
+        if not complete:
+            break
+        if index < len(regexps) - 1:
+            accum.append(topic_separator)
+    return "".join(accum).encode("utf-8")
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+metrics.py
+
+Counters, gauges and histograms for the pipeline processes, in the
+Prometheus text format.
+
+A process creates a MetricsRegistry, asks it for the metrics it keeps, and
+updates them as it works. Updating a metric is an attribute increment, or
+for a histogram a bisect and an increment, so they can stay on in
+production. Metrics are not locked: update each one from a single thread
+(reading them from another thread is fine).
+
+start_metrics serves the registry over HTTP (GET /metrics) from a daemon
+thread, if given an address, and dumps it on SIGUSR1, to a file or stderr.
+"""
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import signal
+import sys
+import threading
+import time
+
+# seconds
+default_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                   1.0, 5.0, 10.0, )
+
+_content_type = "text/plain; version=0.0.4; charset=utf-8"
+_proc_fd_dir = "/proc/self/fd"
+
+class MetricsError(Exception):
+    pass
+
+def _format_labels(labels):
+    if len(labels) == 0:
+        return ""
+    return "{{{0}}}".format(",".join('{0}="{1}"'.format(k, v) \
+                                     for (k, v) in labels))
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class Counter(object):
+    """
+    a value that only goes up,
+    incremented here or read from a function when we render
+    """
+    metric_type = "counter"
+
+    def __init__(self, name, labels, function=None):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self._function = function
+
+    def increment(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        if self._function is not None:
+            self.value = self._function()
+        return [(self.name, self.labels, self.value, ), ]
+
+class Gauge(object):
+    """
+    a value that goes up and down,
+    set directly or read from a function when we render
+    """
+    metric_type = "gauge"
+
+    def __init__(self, name, labels, function=None):
+        self.name = name
+        self.labels = labels
+        self.value = 0
+        self._function = function
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        if self._function is not None:
+            self.value = self._function()
+        return [(self.name, self.labels, self.value, ), ]
+
+class Histogram(object):
+    """
+    counts of observed values in buckets, with their sum
+    """
+    metric_type = "histogram"
+
+    def __init__(self, name, labels, buckets=default_buckets):
+        self.name = name
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        # the last count is for values above the largest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        samples = list()
+        cumulative_count = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative_count += count
+            samples.append(("{0}_bucket".format(self.name),
+                            self.labels + (("le", repr(float(bound)), ), ),
+                            cumulative_count, ))
+        samples.append(("{0}_bucket".format(self.name),
+                        self.labels + (("le", "+Inf", ), ),
+                        self.count, ))
+        samples.append(("{0}_sum".format(self.name), self.labels, self.sum, ))
+        samples.append(("{0}_count".format(self.name),
+                        self.labels,
+                        self.count, ))
+        return samples
+
+class MetricsRegistry(object):
+    """
+    the metrics of a process, by name and labels
+    """
+    def __init__(self, prefix="old_log_inn_"):
+        self._prefix = prefix
+        self._metrics = dict()
+        self._help = dict()
+        self._lock = threading.Lock()
+
+    def counter(self, name, help_text, labels=None, function=None):
+        return self._get(Counter, name, help_text, labels, function=function)
+
+    def gauge(self, name, help_text, labels=None, function=None):
+        return self._get(Gauge, name, help_text, labels, function=function)
+
+    def histogram(self, name, help_text, labels=None,
+                  buckets=default_buckets):
+        return self._get(Histogram, name, help_text, labels, buckets=buckets)
+
+    def render(self):
+        """
+        return the metrics in the Prometheus text format
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+
+        lines = list()
+        last_name = None
+        for (name, _), metric in metrics:
+            if name != last_name:
+                lines.append("# HELP {0} {1}".format(name, self._help[name]))
+                lines.append("# TYPE {0} {1}".format(name,
+                                                     metric.metric_type))
+                last_name = name
+            for sample_name, labels, value in metric.samples():
+                lines.append("{0}{1} {2}".format(sample_name,
+                                                 _format_labels(labels),
+                                                 _format_value(value)))
+        lines.append("")
+        return "\n".join(lines)
+
+    def _get(self, metric_class, name, help_text, labels, **kwargs):
+        name = self._prefix + name
+        labels = tuple(sorted((labels or dict()).items()))
+        with self._lock:
+            metric = self._metrics.get((name, labels, ))
+            if metric is None:
+                metric = metric_class(name, labels, **kwargs)
+                self._metrics[(name, labels, )] = metric
+                self._help[name] = help_text
+            elif not isinstance(metric, metric_class):
+                raise MetricsError("{0} is a {1}".format(name,
+                                                         metric.metric_type))
+            return metric
+
+def count_open_files():
+    """
+    return the number of file descriptors the process has open,
+    or -1 if we can't tell
+    """
+    try:
+        return len(os.listdir(_proc_fd_dir))
+    except OSError:
+        return -1
+
+class Timer(object):
+    """
+    observe the seconds a with block takes in a histogram
+    """
+    def __init__(self, histogram):
+        self._histogram = histogram
+        self._start_time = None
+
+    def __enter__(self):
+        self._start_time = time.time()
+        return self
+
+    def __exit__(self, *_):
+        self._histogram.observe(time.time() - self._start_time)
+        return False
+
+def _create_request_handler(registry):
+    class _MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", _content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_):
+            # requests are not worth a line in our logs
+            pass
+
+    return _MetricsRequestHandler
+
+def parse_metrics_address(address):
+    """
+    return (host, port) for an address of the form [host:]port
+    """
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port), )
+
+class MetricsServer(object):
+    """
+    serve a registry over HTTP from a daemon thread
+    """
+    def __init__(self, registry, address):
+        self._server = HTTPServer(parse_metrics_address(address),
+                                  _create_request_handler(registry))
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        name="MetricsServer")
+        self._thread.daemon = True
+
+    @property
+    def server_address(self):
+        return self._server.server_address
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+def _create_dump_handler(registry, dump_path):
+    def cb_handler(*_):
+        if dump_path is None:
+            sys.stderr.write(registry.render())
+            sys.stderr.flush()
+            return
+        with open(dump_path, "w") as output_file:
+            output_file.write(registry.render())
+    return cb_handler
+
+def add_metrics_arguments(parser):
+    """
+    add the metrics options to a program's argparse parser
+    """
+    parser.add_argument("--metrics-address", dest="metrics_address",
+                        default=None,
+                        help="serve metrics over HTTP on [host:]port")
+    parser.add_argument("--metrics-dump-path", dest="metrics_dump_path",
+                        default=None,
+                        help="dump metrics here on SIGUSR1 (default stderr)")
+
+def start_metrics(registry, address=None, dump_path=None):
+    """
+    serve the registry on address ([host:]port), if we have one,
+    and dump it to dump_path (default stderr) on SIGUSR1
+
+    return the MetricsServer, or None
+    """
+    registry.gauge("open_files",
+                   "file descriptors the process has open",
+                   function=count_open_files)
+    signal.signal(signal.SIGUSR1, _create_dump_handler(registry, dump_path))
+    if address is None:
+        return None
+    server = MetricsServer(registry, address)
+    server.start()
+    return server
@@ -11,21 +11,30 @@ retrieval.
 
 Archives are then grouped by timestamp. 
 For example, all the archives having the timestamp "20130101000000" would be 
-retrieved locally. They would each be processed by sorting their contents by 
-timestamp header and then deduplicating records using the log_event_id header, 
-producing a unified sequence of unduplicated records.
+retrieved locally. Their contents would be merged as they are read, in order
+of the timestamp, uuid and sequence headers, deduplicating records as they 
+come out, producing a unified sequence of unduplicated records. Each archive 
+is already roughly in time order; we hold --reorder-window records from each 
+one to put them in order (see log_stream_merge.py).
 
 Those records would be filtered and output according to the directions 
 described by the command line arguments. 
 
-Then any local data files would be removed and the next grouped-by-timestamp 
+Then the retrieved archives would be removed and the next grouped-by-timestamp
 set of archives would be processed.
+
+If an archive has a sidecar index (see log_stream.py) we retrieve the index 
+first, and read only the blocks whose hostnames and log_paths can match. 
+If no block can match, we don't retrieve the archive at all.
+
+While one group is being processed, the archives of the next 
+--prefetch-groups groups are retrieved in --prefetch-workers threads 
+(see archive_retrieval.py). Archives are read a chunk of records at a time
+(see generate_log_stream_batches_from_file in log_stream.py).
 """
 import argparse
-from collections import defaultdict
 from datetime import datetime, timedelta
-from itertools import groupby
-import json
+from itertools import chain
 import logging
 import os
 import os.path
@@ -34,7 +43,14 @@ import sys
 
 import motoboto
 
-from old_log_inn.log_stream import generate_log_stream_from_file
+from old_log_inn.zlib_dictionary import create_zlib_decompressor
+from old_log_inn.log_header import HeaderDecoder, UnknownStringTableError
+from old_log_inn.header_filter import HeaderFilter
+from old_log_inn.log_stream import generate_log_stream_batches_from_file
+from old_log_inn.archive_retrieval import collect_archive_keys, \
+    generate_retrieved_groups
+from old_log_inn.log_stream_merge import generate_merged_log_records, \
+    header_merge_key
 
 _log_format_template = '%(asctime)s %(levelname)-8s %(name)-20s: %(message)s'
 _log = logging.getLogger("main") 
@@ -81,6 +97,23 @@ def _parse_commandline():
    # you probably want to give a temporary directory for output since you are 
    # making a specific search.
 
+    # archives written in passthrough mode hold the producers' compressed
+    # messages, which may need their preset dictionaries
+    parser.add_argument("--zdict", dest="zdict_paths", action="append",
+                        help="zlib dictionary file, may be repeated")
+
+    parser.add_argument("--prefetch-workers", dest="prefetch_workers",
+                        type=int, default=4,
+                        help="number of archives to retrieve at once")
+    parser.add_argument("--prefetch-groups", dest="prefetch_groups",
+                        type=int, default=2,
+                        help="number of timestamp groups to retrieve ahead")
+
+    parser.add_argument("--reorder-window", dest="reorder_window",
+                        type=int, default=1000,
+                        help="number of records from each archive we hold "
+                        "to put them in order")
+
     parser.add_argument("--identity", dest="identity_path",
                        help="/path/to/motoboto_identity")
     parser.add_argument("--collection", dest="collection_name",
@@ -186,145 +219,131 @@ def _organize_timestamps(args):
 
     return start_timestamp, stop_timestamp
 
-def _construct_keep_header_pred(args):
+def _construct_header_filter(args):
     """
-    return a function that runs all the regular expression tests that
-    determine whether we process a header
+    return a HeaderFilter that runs all the regular expression tests that
+    determine whether we process a record
     """
-    host_regexp = re.compile(args.host_regexp)
-    node_regexp = re.compile(args.node_regexp)
-    log_filename_regexp = re.compile(args.log_filename_regexp)
-
-    host_pred = lambda x: host_regexp.match(x["hostname"]) is not None
-    node_pred = \
-        lambda x: not "nodename" in x or \
-        node_regexp.match(x["nodename"]) is not None
-    log_filename_pred = \
-        lambda x: log_filename_regexp.match(x["log_path"]) is not None
-
-    predicates = [host_pred, node_pred, log_filename_pred, ]
-
-    def __keep_header_pred(header):
-        return all([pred(header) for pred in predicates])
-
-    return __keep_header_pred
+    return HeaderFilter(host_regexp=args.host_regexp,
+                        node_regexp=args.node_regexp,
+                        log_path_regexp=args.log_filename_regexp,
+                        content_regexp=args.content_regexp,
+                        missing_nodename_passes=True)
 
-def _construct_keep_content_pred(args):
+def _construct_index_block_preds(header_filter):
     """
-    return a function that runs the regular expression test that
-    determines whether we process an event content block
+    return a tuple of functions (hostname_pred, log_path_pred) that 
+    determine whether we read a block of an indexed archive
     """
-    content_regexp = re.compile(args.content_regexp)
+    return header_filter.hostname_pred, header_filter.log_path_pred
 
-    return lambda x: content_regexp.match(x) is not None
+def _record_key_function(record):
+    header, _ = record
+    return header_merge_key(header)
 
-def _iterate_keys(bucket, 
-                  prefix=None, 
-                  suffix=None, 
-                  low_timestamp=None, 
-                  high_timestamp=None):
+def _generate_archive_records(retrieved_archive, 
+                              header_decoder,
+                              header_filter,
+                              decompressor):
     """
-    fetch keys from nimbus.io
-    return a tuple of timestamp, key
+    yield the (header, data) tuples of a retrieved archive whose 
+    headers we want to keep, with the headers decoded
     """
-    timestamp_length = len("YYYYMMDDHHMMSS")
-
-    if prefix is None:
-        prefix = ""
-    prefix_length = len(prefix)
-
-    if suffix is None:
-        suffix = ""
-
-    marker = ""
-    while True:
-        key_list = bucket.get_all_keys(marker=marker)
-        for key in key_list:
-            key_name = key.name
-            marker = key_name
-            if not key_name.startswith(prefix):
-                continue
-            if not key_name.endswith(suffix):
-                continue
-            timestamp = key_name[prefix_length:timestamp_length+prefix_length]
-            if low_timestamp is not None and timestamp < low_timestamp:
-                continue
-            if high_timestamp is not None and timestamp > high_timestamp:
-                continue
-            yield timestamp, key
-        if not key_list.truncated:
-            raise StopIteration()
-
-def _header_key_function(header):
-    return (header["timestamp"], header["uuid"], )
+    bad_frames = list()
+    log_stream = chain.from_iterable(generate_log_stream_batches_from_file(
+        retrieved_archive.path,
+        retrieved_archive.blocks,
+        decompressor.decompress,
+        bad_frames=bad_frames))
+
+    for raw_header, data in log_stream:
+        try:
+            header = header_filter.decode_header(raw_header, header_decoder)
+        except UnknownStringTableError:
+            instance = sys.exc_info()[1]
+            _log.warning("skipping record: {0}".format(instance))
+            continue
+
+        # a string table, or a record we don't want
+        if header is None:
+            continue
+
+        yield header, data
+
+    for instance in bad_frames:
+        _log.warning("skipped bad frame in {0}: {1}".format(
+            retrieved_archive.path, instance))
 
 def _iterate_timestamp_content(work_dir,
-                               keep_header_pred,
-                               keep_content_pred,
-                               timestamp_key_dict):
+                               header_filter,
+                               timestamp_key_dict,
+                               index_key_dict=None,
+                               index_block_preds=(None, None, ),
+                               decompressor=None,
+                               prefetch_workers=4,
+                               prefetch_groups=2,
+                               reorder_window=1000):
+    """
+    header_filter
+        a HeaderFilter for the headers and content of the records we want
+
+    index_key_dict
+        the keys of sidecar indices, keyed by the name of the archive key
 
-    # put the retrieved timestamps in order
-    timestamps = sorted(timestamp_key_dict.keys())
+    decompressor
+        a ZlibDecompressor for archives written in passthrough mode
 
-    for timestamp in timestamps:
+    reorder_window
+        the number of records from each archive we hold to put them 
+        in order
+    """
+    if decompressor is None:
+        decompressor = create_zlib_decompressor(None)
+
+    # headers may be JSON or binary, binary headers need the string tables
+    # written ahead of them
+    header_decoder = HeaderDecoder()
+
+    # the groups come out in timestamp order
+    retrieved_groups = generate_retrieved_groups(work_dir,
+                                                 timestamp_key_dict,
+                                                 index_key_dict,
+                                                 index_block_preds,
+                                                 prefetch_workers,
+                                                 prefetch_groups)
+
+    for timestamp, retrieved_archives in retrieved_groups:
         _log.info("timestamp {0}".format(timestamp))
 
-        header_list = list()
-        data_file_paths = list()
-
-        for index, key in enumerate(timestamp_key_dict[timestamp]):
-            _log.info("    key {0}".format(key.name))
-            retrieve_path = os.path.join(work_dir, key.name)
-
-            # retrieve the key from nimbus.io to a disk file
-            with open(retrieve_path, "wb") as output_file:
-                key.get_contents_to_file(output_file)
-                     
-            # write uncompressed data blocks to a file while maintaining 
-            # a sortable list of headers
-            data_file_name = "{0:08}".format(index)
-            data_file_path = os.path.join(work_dir, data_file_name)
-            data_file_paths.append(data_file_path)
-            with open(data_file_path, "wb") as data_file:            
-                for header_json, data in \
-                    generate_log_stream_from_file(retrieve_path):
-                    header = json.loads(header_json.decode("utf-8"))
-
-                    if not keep_header_pred(header):
-                        continue
-
-                    header["data_file_path"] = data_file_path
-                    header["data_offset"] = data_file.tell()
-                    header["data_size"] = len(data)
-                    header_list.append(header)
-                    data_file.write(data)
-
-            # we don't need the retrieved file anymore
-            os.unlink(retrieve_path)
-
-        # sort the combined header_list on timestamp and uuid
-        header_list.sort(key=_header_key_function)
-
-        # de-dupe the headers and retrieve the data
-        data_files = dict()
-        for _, group in groupby(header_list, key=_header_key_function):
-            group_list = list(group)
-            header = group_list[0]
-            if not header["data_file_path"] in data_files:
-                data_files[header["data_file_path"]] = \
-                    open(header["data_file_path"])
-            data_file = data_files[header["data_file_path"]]
-            data_file.seek(header["data_offset"])
-            data = data_file.read(header["data_size"])
-            if not keep_content_pred(data):
+        record_streams = list()
+        for retrieved_archive in retrieved_archives:
+            _log.info("    key {0}".format(retrieved_archive.key.name))
+
+            blocks = retrieved_archive.blocks
+            if blocks is not None:
+                _log.info("    {0} matching blocks".format(len(blocks)))
+                if len(blocks) == 0:
+                    continue
+
+            record_streams.append(
+                _generate_archive_records(retrieved_archive,
+                                          header_decoder,
+                                          header_filter,
+                                          decompressor))
+
+        # merge the archives on timestamp, uuid and sequence, 
+        # dropping the duplicates as they come out
+        for _, data in generate_merged_log_records(record_streams,
+                                                   _record_key_function,
+                                                   reorder_window):
+            data = data.decode("utf-8")
+            if not header_filter.match_content(data):
                 continue
             yield data
 
-        for data_file in data_files.values():
-            data_file.close()
-
-        for data_file_path in data_file_paths:
-            os.unlink(data_file_path)
+        # we don't need the retrieved files anymore
+        for retrieved_archive in retrieved_archives:
+            retrieved_archive.remove()
 
 def main():
     """
@@ -361,21 +380,26 @@ def main():
 
     # load all keys whose names fit our extract criteria
     bucket = motoboto.s3.bucket.Bucket(nimbusio_identity, args.collection_name)
-    timestamp_key_dict = defaultdict(list)
-    for timestamp, key in _iterate_keys(bucket, 
-                                        prefix=args.archive_name_prefix,
-                                        suffix=args.archive_name_suffix,
-                                        low_timestamp=low_timestamp,
-                                        high_timestamp=high_timestamp):
-        timestamp_key_dict[timestamp].append(key)
+    timestamp_key_dict, index_key_dict = \
+        collect_archive_keys(bucket, 
+                             prefix=args.archive_name_prefix,
+                             suffix=args.archive_name_suffix,
+                             low_timestamp=low_timestamp,
+                             high_timestamp=high_timestamp)
 
-    keep_header_pred = _construct_keep_header_pred(args)
-    keep_content_pred = _construct_keep_content_pred(args)
+    header_filter = _construct_header_filter(args)
+    index_block_preds = _construct_index_block_preds(header_filter)
+    decompressor = create_zlib_decompressor(args.zdict_paths)
 
     content_generator = _iterate_timestamp_content(args.work_dir,
-                                                   keep_header_pred,
-                                                   keep_content_pred,
-                                                   timestamp_key_dict)
+                                                   header_filter,
+                                                   timestamp_key_dict,
+                                                   index_key_dict,
+                                                   index_block_preds,
+                                                   decompressor,
+                                                   args.prefetch_workers,
+                                                   args.prefetch_groups,
+                                                   args.reorder_window)
     for content in content_generator:
         print(content)
 
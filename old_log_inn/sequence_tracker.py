@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+sequence_tracker.py
+
+Loss accounting from the uuid and sequence every producer stamps on its
+records (see log_line_pusher.py).
+
+For each producer (uuid) we keep the highest sequence we have seen, and the
+gaps below it: the sequences we haven't seen yet, as a short sorted list of
+intervals. A record that extends the highest sequence by one is the common
+case and costs a dict lookup and a compare. A record further ahead opens a
+gap. A record behind the highest is either a late arrival, which closes (part
+of) a gap and counts its reorder distance (how far behind the highest it
+came), or a duplicate.
+
+    missing     sequences skipped over when a gap opened
+    recovered   late arrivals that filled a gap
+    lost        missing - recovered: the gaps still open
+    duplicates  sequences we had already seen
+
+We start a producer at the first sequence we see from it, so records lost
+before then are not counted. State is bounded: a producer keeps no more than
+max_gaps gaps (the oldest is given up, and a record arriving for it later
+counts as a duplicate), and we forget producers idle for idle_seconds, or the
+least recently seen once we have max_producers.
+"""
+from bisect import bisect_right
+from collections import OrderedDict
+import json
+import os
+import sys
+import time
+import uuid
+import zlib
+
+from old_log_inn.log_batch import LogBatchError, unpack_message_headers
+from old_log_inn.log_header import LogHeaderError, header_sequence
+from old_log_inn.zlib_dictionary import ZlibDictionaryError
+
+_default_max_producers = 10000
+_default_max_gaps = 1000
+_default_idle_seconds = 3600.0
+_reorder_buckets = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000,
+                    100000, )
+_summary_version = 1
+
+class _ProducerSequence(object):
+    """
+    what we know of one producer's sequence
+    """
+    def __init__(self, sequence, current_time):
+        self.high = sequence
+        # sorted, non-overlapping (start, end) intervals, end exclusive
+        self.gaps = list()
+        self.records = 1
+        self.missing = 0
+        self.recovered = 0
+        self.duplicates = 0
+        self.max_reorder = 0
+        self.first_sequence = sequence
+        self.last_seen = current_time
+
+    def to_dict(self, uuid_bytes):
+        return {"uuid"          : uuid.UUID(bytes=uuid_bytes).hex,
+                "first"         : self.first_sequence,
+                "highest"       : self.high,
+                "records"       : self.records,
+                "missing"       : self.missing,
+                "recovered"     : self.recovered,
+                "lost"          : self.missing - self.recovered,
+                "duplicates"    : self.duplicates,
+                "max_reorder"   : self.max_reorder,
+                "open_gaps"     : [list(gap) for gap in self.gaps],
+                "last_seen"     : self.last_seen, }
+
+class SequenceTracker(object):
+    """
+    count the gaps, duplicates and reordering in the sequences of the
+    records we receive
+    """
+    def __init__(self, metrics=None,
+                 max_producers=_default_max_producers,
+                 max_gaps=_default_max_gaps,
+                 idle_seconds=_default_idle_seconds):
+        """
+        metrics
+            a MetricsRegistry to report our totals in
+        """
+        self._max_producers = max_producers
+        self._max_gaps = max_gaps
+        self._idle_seconds = idle_seconds
+        # least recently seen first
+        self._producers = OrderedDict()
+
+        self.records = 0
+        self.missing = 0
+        self.recovered = 0
+        self.duplicates = 0
+        self.evicted = 0
+        self.errors = 0
+
+        self._reorder_histogram = None
+        if metrics is not None:
+            self._register_metrics(metrics)
+
+    @property
+    def producer_count(self):
+        return len(self._producers)
+
+    def observe(self, uuid_bytes, sequence, current_time=None):
+        """
+        count one record
+        """
+        if current_time is None:
+            current_time = time.time()
+        self.records += 1
+
+        producer = self._producers.get(uuid_bytes)
+        if producer is None:
+            self._producers[uuid_bytes] = \
+                _ProducerSequence(sequence, current_time)
+            if len(self._producers) > self._max_producers:
+                self._producers.popitem(last=False)
+                self.evicted += 1
+            return
+
+        self._producers.move_to_end(uuid_bytes)
+        producer.last_seen = current_time
+        producer.records += 1
+
+        if sequence == producer.high + 1:
+            producer.high = sequence
+            return
+
+        if sequence > producer.high:
+            missing_count = sequence - producer.high - 1
+            producer.gaps.append((producer.high + 1, sequence, ))
+            if len(producer.gaps) > self._max_gaps:
+                del producer.gaps[0]
+            producer.missing += missing_count
+            self.missing += missing_count
+            producer.high = sequence
+            return
+
+        index = bisect_right(producer.gaps, (sequence, sys.maxsize, )) - 1
+        if index < 0 or producer.gaps[index][1] <= sequence:
+            producer.duplicates += 1
+            self.duplicates += 1
+            return
+
+        start, end = producer.gaps[index]
+        remainder = list()
+        if start < sequence:
+            remainder.append((start, sequence, ))
+        if sequence + 1 < end:
+            remainder.append((sequence + 1, end, ))
+        producer.gaps[index:index+1] = remainder
+        producer.recovered += 1
+        self.recovered += 1
+        reorder_distance = producer.high - sequence
+        producer.max_reorder = max(producer.max_reorder, reorder_distance)
+        if self._reorder_histogram is not None:
+            self._reorder_histogram.observe(reorder_distance)
+
+    def observe_headers(self, raw_headers, current_time=None):
+        """
+        count the records of a sequence of uncompressed headers
+        (string tables are skipped)
+        """
+        if current_time is None:
+            current_time = time.time()
+        for raw_header in raw_headers:
+            try:
+                uuid_sequence = header_sequence(raw_header)
+            except (LogHeaderError, ValueError, KeyError):
+                self.errors += 1
+                continue
+            if uuid_sequence is not None:
+                self.observe(uuid_sequence[0], uuid_sequence[1], current_time)
+
+    def observe_messages(self, messages, decompress, current_time=None):
+        """
+        count the records of a sequence of messages as they came off the
+        wire (lists of frames, topic excluded), decompressing only their
+        headers
+        """
+        if current_time is None:
+            current_time = time.time()
+        for frames in messages:
+            try:
+                raw_headers = unpack_message_headers(frames, decompress)
+            except (ZlibDictionaryError, zlib.error, LogBatchError):
+                self.errors += 1
+                continue
+            self.observe_headers(raw_headers, current_time)
+
+    def evict_idle(self, current_time=None):
+        """
+        forget the producers we haven't heard from in idle_seconds
+
+        return the number we forgot
+        """
+        if current_time is None:
+            current_time = time.time()
+        evicted_count = 0
+        while len(self._producers) > 0:
+            uuid_bytes, producer = next(iter(self._producers.items()))
+            if current_time - producer.last_seen < self._idle_seconds:
+                break
+            del self._producers[uuid_bytes]
+            evicted_count += 1
+        self.evicted += evicted_count
+        return evicted_count
+
+    def summary(self, current_time=None):
+        """
+        return a dict of our totals, and of the state of each producer
+        """
+        if current_time is None:
+            current_time = time.time()
+        producers = [producer.to_dict(uuid_bytes) for (uuid_bytes, producer) \
+                     in self._producers.items()]
+        producers.sort(key=lambda p: (p["lost"], p["duplicates"], ),
+                       reverse=True)
+        return {"version"       : _summary_version,
+                "time"          : current_time,
+                "records"       : self.records,
+                "missing"       : self.missing,
+                "recovered"     : self.recovered,
+                "lost"          : self.missing - self.recovered,
+                "duplicates"    : self.duplicates,
+                "evicted"       : self.evicted,
+                "errors"        : self.errors,
+                "producers"     : producers, }
+
+    def save_summary(self, path, current_time=None):
+        """
+        write the summary to path (json), replacing it whole
+        """
+        work_path = "{0}.tmp".format(path)
+        with open(work_path, "w") as output_file:
+            json.dump(self.summary(current_time), output_file, indent=1)
+        os.rename(work_path, path)
+
+    def _register_metrics(self, metrics):
+        for name, attribute, help_text in [
+            ("sequence_records_total", "records",
+             "records whose sequence we tracked"),
+            ("sequence_missing_total", "missing",
+             "sequences skipped over in gaps"),
+            ("sequence_recovered_total", "recovered",
+             "late records that filled a gap"),
+            ("sequence_duplicates_total", "duplicates",
+             "records whose sequence we had already seen"),
+            ("sequence_evicted_total", "evicted",
+             "producers forgotten"),
+            ("sequence_errors_total", "errors",
+             "headers or messages we could not read a sequence from"), ]:
+            metrics.counter(name,
+                            help_text,
+                            function=lambda a=attribute: getattr(self, a))
+        metrics.gauge("sequence_lost",
+                      "sequences in gaps still open",
+                      function=lambda: self.missing - self.recovered)
+        metrics.gauge("sequence_producers",
+                      "producers whose sequence we track",
+                      function=lambda: len(self._producers))
+        self._reorder_histogram = metrics.histogram(
+            "sequence_reorder_distance",
+            "how far behind the highest sequence late records arrived",
+            buckets=_reorder_buckets)
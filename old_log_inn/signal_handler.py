@@ -20,3 +20,12 @@ def set_signal_handler():
     halt_event = Event()
     signal.signal(signal.SIGTERM, _create_signal_handler(halt_event))
     return halt_event
+
+def set_reload_signal_handler():
+    """
+    set a signal handler to set reload_event when SIGHUP is raised
+    return reload_event
+    """
+    reload_event = Event()
+    signal.signal(signal.SIGHUP, _create_signal_handler(reload_event))
+    return reload_event
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+sub_list.py
+
+The list of addresses a subscriber connects to (--sub-list), kept up to date
+while the program runs.
+
+A SubListWatcher notices when the file changes (by polling its mtime and
+size), or when we are asked to reload it (SIGHUP, see signal_handler.py),
+and returns the new list.
+
+A SubSocketSet holds a SUB socket for each address. Given a new list, it
+closes the sockets of the addresses that are gone, and connects the new
+ones, leaving the rest alone, so nothing in flight on them is lost.
+New connections are rate limited (--connect-rate per second), so a
+subscriber starting up, or a long new list, doesn't make every node take
+a connection at once.
+"""
+import os
+import time
+
+import zmq
+
+from old_log_inn.zmq_util import is_ipc_protocol, prepare_ipc_path
+
+_default_check_interval = 5.0
+_default_connect_rate = 10.0
+
+def load_sub_list(sub_list_path):
+    """
+    load a list of socket addresses to subscribe to
+    """
+    with open(sub_list_path) as input_file:
+        return [line.strip() for line in input_file if line.strip() != ""]
+
+def _file_signature(path):
+    try:
+        stat_result = os.stat(path)
+    except OSError:
+        return None
+    return (stat_result.st_mtime, stat_result.st_size, )
+
+class SubListWatcher(object):
+    """
+    watch a sub list file for changes
+    """
+    def __init__(self, path, check_interval=_default_check_interval,
+                 reload_event=None):
+        """
+        check_interval
+            seconds between looks at the file's mtime
+
+        reload_event
+            a threading.Event which, when set, makes us reload the file
+            at the next check, changed or not
+        """
+        self._path = path
+        self._check_interval = check_interval
+        self._reload_event = reload_event
+        self._signature = _file_signature(path)
+        self._next_check_time = time.time() + check_interval
+
+    def load(self):
+        """
+        return the list of addresses in the file
+        """
+        self._signature = _file_signature(self._path)
+        return load_sub_list(self._path)
+
+    def check(self, current_time=None):
+        """
+        return the new list of addresses if the file has changed,
+        or we were asked to reload it; otherwise None
+        """
+        if current_time is None:
+            current_time = time.time()
+
+        if self._reload_event is not None and self._reload_event.is_set():
+            self._reload_event.clear()
+        elif current_time < self._next_check_time:
+            return None
+        else:
+            self._next_check_time = current_time + self._check_interval
+            if _file_signature(self._path) == self._signature:
+                return None
+
+        try:
+            return self.load()
+        except (IOError, OSError):
+            # the file is being replaced, we'll see it next time
+            self._signature = None
+            return None
+
+class SubSocketSet(object):
+    """
+    a SUB socket for each of a list of addresses, registered with a poller
+    """
+    def __init__(self, context, poller, subscriptions=None,
+                 connect_rate=_default_connect_rate):
+        """
+        subscriptions
+            a list of topic prefixes to subscribe to (default: everything)
+
+        connect_rate
+            the most new connections we make in a second, 0 for no limit
+        """
+        self._context = context
+        self._poller = poller
+        self._subscriptions = subscriptions or ["", ]
+        self._connect_rate = float(connect_rate)
+        self._sockets = dict()
+        self._pending = list()
+        self._allowance = max(self._connect_rate, 1.0)
+        self._last_connect_check = None
+
+    @property
+    def addresses(self):
+        """
+        the addresses we are connected to, or will connect to
+        """
+        return sorted(list(self._sockets.keys()) + self._pending)
+
+    @property
+    def pending_count(self):
+        """
+        the number of addresses waiting for a connection
+        """
+        return len(self._pending)
+
+    def update(self, address_list, current_time=None):
+        """
+        connect to the addresses in address_list we don't have yet,
+        disconnect from those we have that are not in it
+
+        return a tuple of (list of added addresses, list of removed ones)
+        """
+        wanted = set(address_list)
+        removed = [a for a in self.addresses if not a in wanted]
+        for address in removed:
+            if address in self._pending:
+                self._pending.remove(address)
+                continue
+            sub_socket = self._sockets.pop(address)
+            self._poller.unregister(sub_socket)
+            sub_socket.close(linger=0)
+
+        current = set(self.addresses)
+        added = list()
+        for address in address_list:
+            if not address in current and not address in added:
+                added.append(address)
+        self._pending.extend(added)
+
+        self.connect_pending(current_time)
+        return added, removed
+
+    def connect_pending(self, current_time=None):
+        """
+        connect as many of the waiting addresses as the connect rate allows
+
+        return the number of addresses we connected
+        """
+        if current_time is None:
+            current_time = time.time()
+
+        if self._connect_rate <= 0.0:
+            self._allowance = float(len(self._pending))
+        elif self._last_connect_check is not None:
+            elapsed = max(current_time - self._last_connect_check, 0.0)
+            self._allowance = min(self._allowance + \
+                                      elapsed * self._connect_rate,
+                                  max(self._connect_rate, 1.0))
+        self._last_connect_check = current_time
+
+        connected_count = 0
+        while len(self._pending) > 0 and self._allowance >= 1.0:
+            self._connect(self._pending.pop(0))
+            self._allowance -= 1.0
+            connected_count += 1
+        return connected_count
+
+    def poll_timeout(self, timeout):
+        """
+        return the poll timeout (seconds) that lets us connect the next
+        waiting address on time
+        """
+        if len(self._pending) == 0 or self._connect_rate <= 0.0:
+            return timeout
+        return min(timeout, 1.0 / self._connect_rate)
+
+    def close(self):
+        for sub_socket in self._sockets.values():
+            self._poller.unregister(sub_socket)
+            sub_socket.close()
+        self._sockets.clear()
+        self._pending = list()
+
+    def _connect(self, address):
+        if is_ipc_protocol(address):
+            prepare_ipc_path(address)
+        sub_socket = self._context.socket(zmq.SUB)
+        for subscription in self._subscriptions:
+            sub_socket.setsockopt(zmq.SUBSCRIBE, subscription.encode("utf-8"))
+        try:
+            sub_socket.connect(address)
+        except zmq.ZMQError:
+            # don't leave a socket behind to block context.term()
+            sub_socket.close(linger=0)
+            raise
+        self._poller.register(sub_socket, zmq.POLLIN)
+        self._sockets[address] = sub_socket
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+subscription_shard.py
+
+Sharded fan-in for zmq_subscription_aggregator.
+
+The sub addresses are dealt out to worker threads (shards). Each shard has
+its own SUB sockets and poller, and relays every message it receives,
+unchanged, to an inproc PUSH socket. The main thread relays from the PULL
+end to the single PUB socket, so subscribers see exactly what a single
+thread aggregator would publish.
+
+ZMQ releases the GIL while it waits and while it moves frames, so the shards
+overlap their socket work with each other and with the main thread.
+
+Each shard counts the messages (and bytes) it relayed, and the main thread
+those it published: the difference is the depth of the inproc queue between
+them.
+
+With a hop_trace_every, each shard stamps the hop trailers of the messages
+it relays (see hop_trace.py).
+
+When the sub list changes, the addresses we already have stay with their
+shards, and the new ones go to the shards with the fewest. Each shard
+connects its new addresses at its share of the connect rate
+(see sub_list.py).
+
+A shard that dies (on an exception) keeps the exception. The main thread
+checks the shards each time it relays: if one has died, it sets the halt
+event, so the others stop too, and raises SubscriptionShardError.
+"""
+import sys
+import threading
+
+import zmq
+
+from old_log_inn.hop_trace import HopStamper, hop_aggregator, \
+    split_hop_trailer
+from old_log_inn.log_batch import message_frame_count
+from old_log_inn.sub_list import SubSocketSet
+
+_shard_address = "inproc://old_log_inn.subscription_shards"
+_poll_interval = 1.0
+_connect_rate = 10.0
+
+class SubscriptionShardError(Exception):
+    pass
+
+def relay_message(input_socket, output_socket, hop_stamper=None):
+    """
+    relay one message (topic included), without copying its frames
+    (other than a hop trailer we stamp)
+
+    return the number of bytes in the message
+    """
+    # we expect topic, compressed header, compressed body
+    # or topic, batch marker, compressed headers, compressed bodies
+    # perhaps followed by a hop trailer
+    frames = input_socket.recv_multipart(copy=False)
+    assert len(frames) > 1
+    expected_count = 1 + message_frame_count(frames[1].buffer)
+    assert len(split_hop_trailer(frames, expected_count)[0]) == \
+        expected_count, len(frames)
+
+    if hop_stamper is not None:
+        frames = hop_stamper.stamp(frames, expected_count)
+
+    # send out what we got in
+    output_socket.send_multipart(frames, copy=False)
+
+    return sum(len(frame) for frame in frames)
+
+def shard_addresses(address_list, shard_count):
+    """
+    return a list of shard_count lists of addresses, dealt out in turn
+    """
+    return [address_list[index::shard_count] \
+            for index in range(shard_count)]
+
+class SubscriptionShard(threading.Thread):
+    """
+    subscribe to some of the sub addresses,
+    relay their messages to the inproc queue
+    """
+    def __init__(self, context, shard_index, address_list, subscriptions,
+                 hwm, halt_event, poll_interval=_poll_interval,
+                 connect_rate=_connect_rate, hop_trace_every=0):
+        super(SubscriptionShard, self).__init__(
+            name="SubscriptionShard-{0}".format(shard_index))
+        self.daemon = True
+        self._context = context
+        self._shard_index = shard_index
+        self._address_list = list(address_list)
+        self._subscriptions = subscriptions
+        self._hwm = hwm
+        self._halt_event = halt_event
+        self._poll_interval = poll_interval
+        self._connect_rate = connect_rate
+        self._hop_stamper = HopStamper(hop_aggregator, hop_trace_every)
+        self._relayed_count = 0
+        self._relayed_bytes = 0
+        # the exception the shard died of, if it did
+        self.error = None
+
+        # a new address list, handed to us by another thread
+        self._lock = threading.Lock()
+        self._new_address_list = None
+
+    @property
+    def address_list(self):
+        return list(self._address_list)
+
+    def counters(self):
+        """
+        return a dict of the shard's counters
+        """
+        return {"shard"     : self._shard_index,
+                "addresses" : len(self._address_list),
+                "relayed"   : self._relayed_count,
+                "bytes"     : self._relayed_bytes, }
+
+    def set_addresses(self, address_list):
+        """
+        change the addresses we subscribe to (from any thread)
+        """
+        with self._lock:
+            self._address_list = list(address_list)
+            self._new_address_list = list(address_list)
+
+    def run(self):
+        push_socket = self._context.socket(zmq.PUSH)
+        push_socket.setsockopt(zmq.SNDHWM, self._hwm)
+        push_socket.connect(_shard_address)
+
+        poller = zmq.Poller()
+        sub_socket_set = SubSocketSet(self._context,
+                                      poller,
+                                      self._subscriptions,
+                                      self._connect_rate)
+        sub_socket_set.update(self._address_list)
+
+        try:
+            while not self._halt_event.is_set():
+                with self._lock:
+                    new_address_list = self._new_address_list
+                    self._new_address_list = None
+                if new_address_list is not None:
+                    sub_socket_set.update(new_address_list)
+                sub_socket_set.connect_pending()
+
+                timeout = sub_socket_set.poll_timeout(self._poll_interval)
+                for sub_socket, event in poller.poll(timeout * 1000):
+                    assert event == zmq.POLLIN, event
+                    self._relayed_bytes += relay_message(sub_socket,
+                                                         push_socket,
+                                                         self._hop_stamper)
+                    self._relayed_count += 1
+        except Exception:
+            self.error = sys.exc_info()[1]
+        finally:
+            sub_socket_set.close()
+            push_socket.close(linger=0)
+
+class ShardedSubscriber(object):
+    """
+    relay the messages of all the shards to a pub socket
+    """
+    def __init__(self, context, address_list, subscriptions, shard_count,
+                 hwm, halt_event, poll_interval=_poll_interval,
+                 connect_rate=_connect_rate, hop_trace_every=0):
+        self._pull_socket = context.socket(zmq.PULL)
+        self._pull_socket.setsockopt(zmq.RCVHWM, hwm)
+        self._pull_socket.bind(_shard_address)
+        self._poller = zmq.Poller()
+        self._poller.register(self._pull_socket, zmq.POLLIN)
+        self._poll_interval_ms = int(poll_interval * 1000)
+        self._published_count = 0
+        self._halt_event = halt_event
+
+        self._shards = [SubscriptionShard(context,
+                                          shard_index,
+                                          shard_address_list,
+                                          subscriptions,
+                                          hwm,
+                                          halt_event,
+                                          poll_interval,
+                                          connect_rate / shard_count,
+                                          hop_trace_every) \
+                        for (shard_index, shard_address_list) in \
+                            enumerate(shard_addresses(address_list,
+                                                      shard_count))]
+
+    def counters(self):
+        """
+        return a dict of counters: the messages we published,
+        the messages waiting between the shards and us,
+        and the counters of each shard
+        """
+        shard_counters = [shard.counters() for shard in self._shards]
+        relayed_count = sum(c["relayed"] for c in shard_counters)
+        return {"published"     : self._published_count,
+                "queue_depth"   : relayed_count - self._published_count,
+                "shards"        : shard_counters, }
+
+    def start(self):
+        for shard in self._shards:
+            shard.start()
+
+    def update_addresses(self, address_list):
+        """
+        change the addresses we subscribe to, moving none of those we
+        already have to another shard
+
+        return a tuple of (list of added addresses, list of removed ones)
+        """
+        wanted = set(address_list)
+        shard_address_lists = \
+            [[a for a in shard.address_list if a in wanted] \
+             for shard in self._shards]
+        current = set()
+        for shard_address_list in shard_address_lists:
+            current.update(shard_address_list)
+
+        removed = sorted(a for shard in self._shards \
+                         for a in shard.address_list if not a in wanted)
+        added = list()
+        for address in address_list:
+            if address in current or address in added:
+                continue
+            added.append(address)
+            min(shard_address_lists, key=len).append(address)
+
+        for shard, shard_address_list in zip(self._shards,
+                                             shard_address_lists):
+            if shard_address_list != shard.address_list:
+                shard.set_addresses(shard_address_list)
+        return added, removed
+
+    def relay(self, pub_socket, budget):
+        """
+        wait (up to the poll interval) for messages from the shards,
+        relay up to budget of them to pub_socket
+
+        return the number of messages relayed
+
+        If a shard has died, we set the halt event
+        and raise SubscriptionShardError.
+        """
+        self._check_shards()
+        if len(self._poller.poll(self._poll_interval_ms)) == 0:
+            return 0
+        relayed_count = 0
+        while relayed_count < budget:
+            try:
+                frames = self._pull_socket.recv_multipart(zmq.NOBLOCK,
+                                                          copy=False)
+            except zmq.Again:
+                break
+            pub_socket.send_multipart(frames, copy=False)
+            relayed_count += 1
+        self._published_count += relayed_count
+        return relayed_count
+
+    def _check_shards(self):
+        for shard in self._shards:
+            if shard.ident is None or shard.is_alive():
+                continue
+            if self._halt_event.is_set() and shard.error is None:
+                continue
+            self._halt_event.set()
+            raise SubscriptionShardError("{0} died: {1!r}".format(
+                shard.name, shard.error))
+
+    def close(self):
+        """
+        wait for the shards to halt, and close the queue
+        """
+        for shard in self._shards:
+            if shard.ident is not None:
+                shard.join()
+        self._pull_socket.close(linger=0)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+train_zlib_dictionary.py
+
+A program to build a preset zlib dictionary from a directory of log stream
+files, as written by zmq_log_stream_writer.
+
+We take a random sample of the records in the directory and count, for every
+segment of --segment-length bytes, the number of headers and bodies it
+appears in. The dictionary is made of the segments that appear most widely,
+chained together where they overlap, with the most common at the end,
+where zlib can reach them most cheaply.
+
+Give --workers to read the files of the directory in that many worker
+processes.
+
+Give the dictionary to producers through the ENV variable PYTHON_ZMQ_LOG_ZDICT
+and to the receiving programs with --zdict.
+"""
+import argparse
+from collections import Counter
+import logging
+import random
+import sys
+
+from old_log_inn.log_stream import generate_log_stream_from_directory, \
+    generate_log_stream_from_directory_parallel
+from old_log_inn.zlib_dictionary import create_zlib_decompressor, \
+    zlib_dictionary_id
+
+_log_format_template = '%(asctime)s %(levelname)-8s %(name)-20s: %(message)s'
+_log = logging.getLogger("main")
+
+def _parse_commandline():
+    parser = argparse.ArgumentParser(description='train_zlib_dictionary')
+    parser.add_argument("--input-dir", dest="input_dir",
+                        help="directory of completed log stream files")
+    parser.add_argument("--output", dest="output_path",
+                        help="path of the dictionary file to write")
+    parser.add_argument("--dictionary-size", dest="dictionary_size",
+                        type=int, default=16 * 1024)
+    parser.add_argument("--sample-size", dest="sample_size",
+                        type=int, default=5000,
+                        help="number of records to sample")
+    parser.add_argument("--segment-length", dest="segment_length",
+                        type=int, default=8)
+    parser.add_argument("--zdict", dest="zdict_paths", action="append",
+                        help="zlib dictionary file needed to read the "
+                        "input, may be repeated")
+    parser.add_argument("--workers", dest="workers", type=int, default=1,
+                        help="number of processes reading the input")
+    parser.add_argument("--verbose", dest="verbose", action="store_true",
+                        default=False)
+
+    return parser.parse_args()
+
+def _initialize_logging(verbose):
+    """
+    log to stdout for debugging
+    """
+    handler = logging.StreamHandler(stream=sys.stdout)
+    formatter = logging.Formatter(_log_format_template)
+    handler.setFormatter(formatter)
+    logging.root.addHandler(handler)
+    log_level = (logging.DEBUG if verbose else logging.WARN)
+    logging.root.setLevel(log_level)
+
+def sample_log_stream(log_stream, sample_size):
+    """
+    return a uniform random sample (reservoir sample) of the
+    (header, data) tuples in a log stream
+    """
+    sample = list()
+    for count, record in enumerate(log_stream):
+        if count < sample_size:
+            sample.append(record)
+        else:
+            index = random.randint(0, count)
+            if index < sample_size:
+                sample[index] = record
+    return sample
+
+def train_zlib_dictionary(samples, dictionary_size, segment_length):
+    """
+    samples
+        a list of bytes objects (headers and bodies)
+
+    return a dictionary (bytes) of at most dictionary_size bytes
+    """
+    counter = Counter()
+    for sample in samples:
+        segments = set()
+        for offset in range(len(sample) - segment_length + 1):
+            segments.add(sample[offset:offset+segment_length])
+        counter.update(segments)
+
+    # a segment found in only one sample is not worth its space
+    selected = dict()
+    for segment, count in counter.most_common(dictionary_size):
+        if count < 2:
+            break
+        selected[segment] = count
+
+    # chain overlapping segments into runs: 'hostnam' followed by 
+    # 'ostname' makes 'hostname'
+    overlap = segment_length - 1
+    by_prefix = dict()
+    for segment in selected:
+        by_prefix.setdefault(segment[:overlap], list()).append(segment)
+
+    runs = list()
+    used = set()
+    for segment in sorted(selected, key=selected.get, reverse=True):
+        if segment in used:
+            continue
+        used.add(segment)
+        run = segment
+        while True:
+            candidates = [c for c in by_prefix.get(run[-overlap:], []) \
+                          if not c in used]
+            if len(candidates) == 0:
+                break
+            successor = max(candidates, key=selected.get)
+            used.add(successor)
+            run += successor[overlap:]
+        runs.append((selected[segment], run, ))
+
+    # the most common runs go last, within reach of the data
+    accum = list()
+    accum_size = 0
+    for _, run in sorted(runs, key=lambda r: r[0], reverse=True):
+        if accum_size + len(run) > dictionary_size:
+            continue
+        accum.append(run)
+        accum_size += len(run)
+    accum.reverse()
+
+    return b"".join(accum)
+
+def main():
+    """
+    main entry point
+    """
+    args = _parse_commandline()
+
+    _initialize_logging(args.verbose)
+
+    decompressor = create_zlib_decompressor(args.zdict_paths)
+    bad_frames = list()
+    if args.workers > 1:
+        # the sample is random, so we can take records in any order
+        log_stream = generate_log_stream_from_directory_parallel(
+            args.input_dir,
+            decompressor.decompress,
+            workers=args.workers,
+            ordered=False,
+            bad_frames=bad_frames)
+    else:
+        log_stream = generate_log_stream_from_directory(
+            args.input_dir, decompressor.decompress, bad_frames)
+    records = sample_log_stream(log_stream, args.sample_size)
+    _log.info("sampled {0} records".format(len(records)))
+    if len(bad_frames) > 0:
+        _log.warning("skipped {0} bad frames, the first: {1}".format(
+            len(bad_frames), bad_frames[0]))
+    if len(records) == 0:
+        _log.error("no records found in {0}".format(args.input_dir))
+        return 1
+
+    samples = list()
+    for header, data in records:
+        samples.append(header)
+        samples.append(data)
+
+    zdict = train_zlib_dictionary(samples,
+                                  args.dictionary_size,
+                                  args.segment_length)
+
+    with open(args.output_path, "wb") as output_file:
+        output_file.write(zdict)
+
+    _log.info("wrote {0} byte dictionary {1:08x} to {2}".format(
+        len(zdict), zlib_dictionary_id(zdict), args.output_path))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
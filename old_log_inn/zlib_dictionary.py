@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+zlib_dictionary.py
+
+Preset dictionary (zdict) support for the zlib compression of log headers
+and bodies.
+
+Every header carries the same JSON keys, and much of every body repeats from
+one log line to the next, yet each is compressed on its own with no shared
+context. A preset dictionary, built from a sample of real traffic
+(see train_zlib_dictionary.py), gives zlib that context.
+
+A zlib stream compressed with a preset dictionary carries the Adler-32
+checksum of the dictionary (DICTID) in its own header. We use that checksum as
+the version of the dictionary: every message says which dictionary it needs,
+and a receiver can hold several dictionaries while producers change over.
+Streams compressed without a dictionary decompress just as before.
+"""
+import struct
+import zlib
+
+_zlib_header_size = 2
+_fdict_flag = 0x20
+_dictid_format = "!I"
+_dictid_size = struct.calcsize(_dictid_format)
+
+class ZlibDictionaryError(Exception):
+    pass
+
+def load_zlib_dictionary(path):
+    """
+    return the contents of a dictionary file
+    """
+    with open(path, "rb") as input_file:
+        return input_file.read()
+
+def zlib_dictionary_id(zdict):
+    """
+    return the id (version) of a dictionary, as zlib records it
+    """
+    return zlib.adler32(zdict) & 0xffffffff
+
+def compressed_dictionary_id(data):
+    """
+    return the id of the dictionary needed to decompress a zlib stream,
+    or None if it was compressed without a dictionary
+    """
+    if len(data) < _zlib_header_size + _dictid_size:
+        return None
+    if not data[1] & _fdict_flag:
+        return None
+    (dictionary_id, ) = struct.unpack_from(_dictid_format,
+                                           data,
+                                           _zlib_header_size)
+    return dictionary_id
+
+class ZlibCompressor(object):
+    """
+    compress independent messages, with a preset dictionary if we have one
+    """
+    def __init__(self, zdict=None, level=zlib.Z_DEFAULT_COMPRESSION):
+        self._zdict = zdict
+        self._level = level
+
+    @property
+    def dictionary_id(self):
+        if self._zdict is None:
+            return None
+        return zlib_dictionary_id(self._zdict)
+
+    def compress(self, data):
+        if self._zdict is None:
+            return zlib.compress(data, self._level)
+        compressor = zlib.compressobj(self._level,
+                                      zlib.DEFLATED,
+                                      zlib.MAX_WBITS,
+                                      8,
+                                      zlib.Z_DEFAULT_STRATEGY,
+                                      self._zdict)
+        return compressor.compress(data) + compressor.flush()
+
+class ZlibDecompressor(object):
+    """
+    decompress messages, choosing the preset dictionary by the id
+    recorded in each message
+    """
+    def __init__(self, zdicts=None):
+        self._zdicts = dict()
+        for zdict in (zdicts or []):
+            self.add_dictionary(zdict)
+
+    def add_dictionary(self, zdict):
+        self._zdicts[zlib_dictionary_id(zdict)] = zdict
+
+    def decompress(self, data):
+        dictionary_id = compressed_dictionary_id(data)
+        if dictionary_id is None:
+            return zlib.decompress(data)
+
+        try:
+            zdict = self._zdicts[dictionary_id]
+        except KeyError:
+            raise ZlibDictionaryError(
+                "unknown zlib dictionary {0:08x}".format(dictionary_id))
+
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS, zdict)
+        return decompressor.decompress(data) + decompressor.flush()
+
+def create_zlib_decompressor(zdict_paths):
+    """
+    return a ZlibDecompressor that knows the dictionaries in the files
+    """
+    return ZlibDecompressor([load_zlib_dictionary(path) \
+                             for path in (zdict_paths or [])])
@@ -6,40 +6,55 @@ A Logging to regular rotating log files.
 
 In many situations it is convienient to keep a small amount of regular local 
 disk files avaliable for inspecting very recent logs. 
-Log events are flushed to files as they are received (no buffering.)
+Log events are buffered for each file, and written once a file has
+--logfile-flush-bytes of them, or the oldest is --logfile-flush-interval
+seconds old. Files rotate at --logfile-max-size, keeping --logfile-keep
+backups, with the backups renamed in a background thread
+(see log_file_writer.py).
+
+The host, node and log filename regular expressions are turned into a
+subscription to the topic prefix their records must have (see log_topic.py),
+so the publisher doesn't send us what we would throw away.
+Use --no-topic-subscription with publishers that use a fixed topic.
+
+We track the sequence of each producer (uuid), counting gaps, duplicates and
+late arrivals in metrics, and write a summary to --sequence-summary-path
+every --sequence-summary-interval seconds, as messages arrive
+(see sequence_tracker.py). Only the producers our topic subscription
+takes in are tracked.
+
+Throughput, the time to write each record, and open files are counted in
+metrics (see metrics.py).
 """
 import argparse
 import errno
-import json
 import logging
 import logging.handlers
 import os
 import os.path
-import re
 import socket
 import sys
-import zlib 
+import time
 
 import zmq
 
+from old_log_inn.hop_trace import is_hop_trailer
+from old_log_inn.log_batch import message_frame_count, unpack_message
+from old_log_inn.log_file_writer import LogFileWriter
+from old_log_inn.log_header import HeaderDecoder, UnknownStringTableError
+from old_log_inn.header_filter import HeaderFilter
+from old_log_inn.log_topic import subscription_prefix
+from old_log_inn.metrics import MetricsRegistry, Timer, \
+    add_metrics_arguments, start_metrics
+from old_log_inn.sequence_tracker import SequenceTracker
+from old_log_inn.zlib_dictionary import ZlibDictionaryError, \
+    create_zlib_decompressor
 from old_log_inn.zmq_util import is_ipc_protocol, prepare_ipc_path
 from old_log_inn.signal_handler import set_signal_handler
 
 _log_format_template = '%(asctime)s %(levelname)-8s %(name)-20s: %(message)s'
 _hostname = os.environ.get("HOSTNAME", socket.gethostname())
 
-class DummyLogRecord(object):
-    """
-    This gives the log handler what it wants to see
-    """
-    def __init__(self, log_line):
-        self._log_line = log_line
-        self.exc_info = None
-        self.exc_text = None
-        self.stack_info = None
-    def getMessage(self):
-        return self._log_line
-
 def _parse_commandline():
     parser = \
         argparse.ArgumentParser(description='subscription_aggregator')
@@ -58,29 +73,83 @@ def _parse_commandline():
                         type=int, default=1024 ** 2)
     parser.add_argument("--logfile-keep", dest="logfile_keep", 
                         type=int, default=100)
+    parser.add_argument("--logfile-flush-bytes", dest="logfile_flush_bytes",
+                        type=int, default=64 * 1024,
+                        help="write a file's buffered lines once there are "
+                        "this many bytes of them (0 for every line)")
+    parser.add_argument("--logfile-flush-interval",
+                        dest="logfile_flush_interval",
+                        type=float, default=1.0,
+                        help="write a file's buffered lines once the oldest "
+                        "is this many seconds old")
+    parser.add_argument("--zdict", dest="zdict_paths", action="append",
+                        help="zlib dictionary file, may be repeated")
+    parser.add_argument("--no-topic-subscription", dest="topic_subscription",
+                        action="store_false", default=True,
+                        help="subscribe to everything, not just the topics "
+                        "our regular expressions can match")
+    parser.add_argument("--sequence-summary-path",
+                        dest="sequence_summary_path", default=None,
+                        help="write a summary of sequence gaps here")
+    parser.add_argument("--sequence-summary-interval",
+                        dest="sequence_summary_interval",
+                        type=float, default=60.0,
+                        help="seconds between sequence summaries")
+    parser.add_argument("--sequence-idle-seconds",
+                        dest="sequence_idle_seconds",
+                        type=float, default=3600.0,
+                        help="forget the sequence of a producer we haven't "
+                        "heard from in this many seconds")
+    add_metrics_arguments(parser)
 
     return parser.parse_args()
 
-def _get_one_message(sub_socket):
+def _get_one_message(sub_socket, decompressor, header_decoder,
+                     header_filter, sequence_tracker=None, flags=0):
     """
-    retrieve a message (3 parts)
-    decompress the parts
-    decode the parts into unicode
-    parse the JSON header into python objects
+    retrieve a message (3 parts, or 4 parts for a batch)
+    dropping the hop trailer if it has one (see hop_trace.py)
+    decompress the parts (using a preset dictionary if the message needs it)
+    count the sequences of all its records with the sequence tracker
+    decode the JSON or binary header into python objects,
+    if it passes the header filter
+    decode the bodies into unicode
+    (string tables are remembered by the header decoder, not returned)
+
+    return a tuple of (list of (header, body) tuples, bytes received)
     """
-    _topic = sub_socket.recv()
-    assert sub_socket.rcvmore
-    compressed_header = sub_socket.recv()
+    _topic = sub_socket.recv(flags)
     assert sub_socket.rcvmore
-    compressed_body = sub_socket.recv()
+    frames = [sub_socket.recv(), ]
+    for _ in range(message_frame_count(frames[0]) - 1):
+        assert sub_socket.rcvmore
+        frames.append(sub_socket.recv())
+    if sub_socket.rcvmore:
+        trailer = sub_socket.recv()
+        assert is_hop_trailer(trailer)
     assert not sub_socket.rcvmore
+    received_bytes = sum(len(frame) for frame in frames)
 
-    raw_header = zlib.decompress(compressed_header)
-    header = json.loads(raw_header.decode("utf-8"))
-    raw_body = zlib.decompress(compressed_body)
-    body = raw_body.decode("utf-8")
+    records = unpack_message(frames, decompressor.decompress)
+    if sequence_tracker is not None:
+        sequence_tracker.observe_headers(raw_header for (raw_header, _) \
+                                         in records)
 
-    return header, body
+    messages = list()
+    for raw_header, raw_body in records:
+        try:
+            header = header_filter.decode_header(raw_header, header_decoder)
+        except UnknownStringTableError:
+            instance = sys.exc_info()[1]
+            logging.getLogger("main").debug("skipping record: {0}".format(
+                instance))
+            continue
+        if header is None:
+            continue
+        body = raw_body.decode("utf-8")
+        messages.append((header, body, ))
+
+    return messages, received_bytes
 
 def _compute_log_filename(args, header):
     log_filename = os.path.basename(header["log_path"])
@@ -113,35 +182,12 @@ def _initialize_log(args):
     logging.root.addHandler(handler)
     logging.root.setLevel(log_level)
 
-def _create_header_filters(args):
-    filters = list()
-    if args.host_regexp is None:
-        filters.append(lambda _: True)
-    else:
-        regex = re.compile(args.host_regexp)
-        filters.append(lambda h: regex.match(h["hostname"]) is not None)
-
-    if args.node_regexp is None:
-        filters.append(lambda _: True)
-    else:
-        regex = re.compile(args.node_regexp)
-        filters.append(lambda h: "nodename" in h and \
-                       regex.match(h["nodename"]) is not None)
-
-    if args.log_filename_regexp is None:
-        filters.append(lambda _: True)
-    else:
-        regex = re.compile(args.log_filename_regexp)
-        filters.append(lambda h: regex.match(h["log_path"]) is not None)
-
-    return filters
-
-def _create_body_filter(args):
-    if args.content_regexp is None:
-        return lambda _: True
-
-    regex = re.compile(args.content_regexp)
-    return lambda d: regex.match(d) is not None
+def _create_header_filter(args):
+    return HeaderFilter(host_regexp=args.host_regexp,
+                        node_regexp=args.node_regexp,
+                        log_path_regexp=args.log_filename_regexp,
+                        content_regexp=args.content_regexp,
+                        missing_nodename_passes=False)
 
 def main():
     """
@@ -156,57 +202,126 @@ def main():
     log = logging.getLogger("main")
     log.info("program starts")
 
-    header_filters = _create_header_filters(args)
-    body_filter = _create_body_filter(args)
+    header_filter = _create_header_filter(args)
+    decompressor = create_zlib_decompressor(args.zdict_paths)
+    header_decoder = HeaderDecoder()
 
     if is_ipc_protocol(args.zmq_sub_address):
         prepare_ipc_path(args.zmq_sub_address)
 
     identity_bytes = args.zmq_identity.encode("utf-8")
 
+    log_file_writer = LogFileWriter(args.log_dir,
+                                    args.logfile_max_size,
+                                    args.logfile_keep,
+                                    args.logfile_flush_bytes,
+                                    args.logfile_flush_interval)
+    registry = MetricsRegistry()
+    received_messages = registry.counter("messages_received_total",
+                                         "messages received",
+                                         {"socket" : "sub"})
+    received_bytes = registry.counter("bytes_received_total",
+                                      "bytes received, compressed",
+                                      {"socket" : "sub"})
+    written_records = registry.counter("records_written_total",
+                                       "records written to log files")
+    record_histogram = registry.histogram(
+        "record_seconds", "time taken to filter and write a record")
+    registry.gauge("log_files",
+                   "log files we hold open",
+                   function=lambda: log_file_writer.file_count)
+    registry.counter("log_file_rotation_errors_total",
+                     "backup renames that failed",
+                     function=lambda: log_file_writer.rotation_error_count)
+    sequence_tracker = \
+        SequenceTracker(registry, idle_seconds=args.sequence_idle_seconds)
+    next_sequence_summary_time = \
+        time.time() + args.sequence_summary_interval
+    metrics_server = start_metrics(registry,
+                                   args.metrics_address,
+                                   args.metrics_dump_path)
+
     context = zmq.Context()
 
     sub_socket = context.socket(zmq.SUB)
     sub_socket.connect(args.zmq_sub_address)
     sub_socket.setsockopt(zmq.IDENTITY, identity_bytes)
-    sub_socket.setsockopt(zmq.SUBSCRIBE, "".encode("utf-8"))
+    if args.topic_subscription:
+        topic_prefix = subscription_prefix(args.host_regexp,
+                                           args.node_regexp,
+                                           args.log_filename_regexp)
+    else:
+        topic_prefix = b""
+    log.info("subscribing to topic prefix {0}".format(topic_prefix))
+    sub_socket.setsockopt(zmq.SUBSCRIBE, topic_prefix)
 
-    log_handlers = dict()
     halt_event = set_signal_handler()
     while not halt_event.is_set():
+        current_time = time.time()
+        log_file_writer.check_for_flush(current_time)
 
         try:
-            header, body = _get_one_message(sub_socket)
+            messages, message_bytes = _get_one_message(sub_socket, 
+                                                       decompressor, 
+                                                       header_decoder,
+                                                       header_filter,
+                                                       sequence_tracker,
+                                                       zmq.NOBLOCK)
+        except zmq.Again:
+            # nothing waiting: sleep until there is, or a file is due
+            try:
+                sub_socket.poll(1000 * log_file_writer.poll_timeout(
+                    args.logfile_flush_interval, current_time))
+            except zmq.ZMQError:
+                instance = sys.exc_info()[1]
+                if instance.errno == errno.EINTR and halt_event.is_set():
+                    break
+                raise
+            continue
         except zmq.ZMQError:
             instance = sys.exc_info()[1]
             if instance.errno == errno.EINTR and halt_event.is_set():
                 break
             raise
-        log.debug("received {0}".format(header))
-
-        if not all([f(header) for f in header_filters]):
-            log.debug("header does not pass filters {0}".format(header))
+        except ZlibDictionaryError:
+            instance = sys.exc_info()[1]
+            log.error("discarding message: {0}".format(instance))
             continue
+        received_messages.increment()
+        received_bytes.increment(message_bytes)
 
-        if not body_filter(body):
-            log.debug("body does not pass filters {0}".format(body))
-            continue
+        if current_time >= next_sequence_summary_time:
+            sequence_tracker.evict_idle()
+            if args.sequence_summary_path is not None:
+                sequence_tracker.save_summary(args.sequence_summary_path)
+            next_sequence_summary_time = \
+                time.time() + args.sequence_summary_interval
+
+        for header, body in messages:
+            log.debug("received {0}".format(header))
+
+            with Timer(record_histogram):
+                if not header_filter.match_content(body):
+                    log.debug("body does not pass filters {0}".format(body))
+                    continue
 
-        log_filename = _compute_log_filename(args, header)
-        if not log_filename in log_handlers:
-            log_handlers[log_filename] = _create_log_handler(args, 
-                                                             log_filename)
-        log_handler = log_handlers[log_filename]
-        log_record = DummyLogRecord(body)
-        log_handler.emit(log_record)
-        log_handler.flush()
+                log_file_writer.write(_compute_log_filename(args, header),
+                                      body,
+                                      current_time)
+            written_records.increment()
 
     log.info("program shutting down")
+    if args.sequence_summary_path is not None:
+        sequence_tracker.save_summary(args.sequence_summary_path)
+    if metrics_server is not None:
+        metrics_server.close()
     sub_socket.close()
     context.term()
 
-    for log_handler in log_handlers.values():
-        log_handler.close()
+    log_file_writer.close()
+    if log_file_writer.rotation_error_count > 0:
+        log.error("{0} log file rotations failed".format(
+            log_file_writer.rotation_error_count))
 
     return 0
 
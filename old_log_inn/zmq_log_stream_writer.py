@@ -10,8 +10,59 @@ output files, yet that they can be aggregate and deduplicated later.
 
 An output file has a filename like maple1.YYYYMMDDHHMMSS.gz. 
 The contents are a stream of records, each containing one log event. 
-Files are always compressed with gzip as they are written, and the compressor 
-and the file are flushed as each record is added.
+Files are always compressed with gzip as they are written. By default the 
+file (but not the compressor) is flushed as records are added.
+--flush-records and --flush-interval commit records in groups instead,
+flushing the compressor so the records can be read at once, and
+--durability chooses between no flush, a flush, and a flush with fsync.
+The polling loop commits a waiting group once it is --flush-interval old,
+even when no more records arrive. An idle writer completes its file at the
+first wakeup after the end of the time slot; with --rollover-timer, it
+wakes at the end of the slot to do it then.
+
+Each time the poller wakes us, we drain every ready socket of up to 
+--drain-budget messages, then write all the records we got at once.
+
+With --pipeline-workers, the decompression of messages and the compression of
+records into blocks (gzip members) is done by a pool of worker threads, 
+and a writer thread appends the finished blocks to the file in order 
+(see log_stream_pipeline.py). Each batch of messages drained from the sockets
+becomes one block (or blocks of --index-block-records).
+
+With --passthrough, messages are stored as they came off the wire, still 
+compressed by their producers, in version 3 frames (see log_stream.py). 
+We decompress them only to look at the headers, and do not compress 
+them again. Readers need the same --zdict dictionaries we have.
+
+With --index-block-records, each file is written in blocks of that many 
+records, and a sidecar index (maple1.YYYYMMDDHHMMSS.gz.index) lets readers
+seek straight to the blocks they want (see log_stream.py).
+
+With --max-file-bytes or --max-file-records, a file that reaches the limit
+is completed before the end of its time slot, and the slot goes on in
+numbered segments (maple1.YYYYMMDDHHMMSS.0001.gz, ...), so a storm of
+records doesn't make one huge file (see log_stream.py).
+
+We watch the --sub-list file, and reload it when it changes or on SIGHUP,
+connecting to the new addresses (no more than --connect-rate a second) and
+disconnecting from the ones that are gone, while the others carry on
+(see sub_list.py).
+
+Messages traced by the relays (see hop_trace.py) are stamped once we have
+written them, and the latency of each hop goes into metrics and, by source
+host, into a rolling window we save every --hop-latency-save-interval
+seconds to --hop-latency-path, for hop_latency_report.py.
+(With --pipeline-workers, we stamp them as we hand them to the pipeline.)
+
+We track the sequence of each producer (uuid), counting gaps, duplicates and
+late arrivals in metrics, and write a summary to --sequence-summary-path
+every --sequence-summary-interval seconds (see sequence_tracker.py).
+
+Throughput, commit and rollover times, and open files are counted in metrics
+(see metrics.py).
+
+At startup we salvage the files a killed writer left in --output-work-dir,
+moving their complete frames to --output-complete-dir (see log_stream.py).
 
 When it's completed, it will be renamed using the --output-suffix command line 
 argument, to something like: maple1.YYYYMMDDHHMMSS.gz.complete
@@ -23,13 +74,25 @@ import os
 import os.path
 import socket
 import sys
-import zlib
+import time
 
 import zmq
 
-from old_log_inn.zmq_util import is_ipc_protocol, prepare_ipc_path
-from old_log_inn.signal_handler import set_signal_handler
-from old_log_inn.log_stream import LogStreamWriter
+from old_log_inn.hop_trace import HopLatencyTracker, HopLatencyWindow, \
+    is_hop_trailer
+from old_log_inn.log_batch import message_frame_count, unpack_message
+from old_log_inn.sequence_tracker import SequenceTracker
+from old_log_inn.metrics import MetricsRegistry, Timer, \
+    add_metrics_arguments, start_metrics
+from old_log_inn.zlib_dictionary import ZlibDictionaryError, \
+    create_zlib_decompressor
+from old_log_inn.signal_handler import set_signal_handler, \
+    set_reload_signal_handler
+from old_log_inn.sub_list import SubListWatcher, SubSocketSet
+from old_log_inn.log_stream_pipeline import LogStreamPipeline
+from old_log_inn.log_stream import LogStreamWriter, \
+    durabilities, \
+    durability_flush
 
 _log_format_template = '%(asctime)s %(levelname)-8s %(name)-20s: %(message)s'
 _log = logging.getLogger("main") 
@@ -38,10 +101,23 @@ _hostname = os.environ.get("HOSTNAME", socket.gethostname())
 def _parse_commandline():
     parser = argparse.ArgumentParser(description='log_stream_writer')
     parser.add_argument("--sub-list", dest="sub_list_path")
+    parser.add_argument("--sub-list-check-interval",
+                        dest="sub_list_check_interval", type=float,
+                        default=5.0,
+                        help="seconds between checks of the sub list "
+                        "for changes")
+    parser.add_argument("--connect-rate", dest="connect_rate", type=float,
+                        default=10.0,
+                        help="most new sub connections per second "
+                        "(0 for no limit)")
     parser.add_argument("--zmq-identity", dest="zmq_identity", 
                         default="log_aggregator.{0}".format(_hostname))
     parser.add_argument("--polling-interval", dest="polling_interval", 
                         type=float, default=1.0)
+    parser.add_argument("--rollover-timer", dest="rollover_timer",
+                        action="store_true", default=False,
+                        help="wake at the end of each time slot to "
+                        "complete the current file on time")
     parser.add_argument("--granularity", dest="granularity", type=int, 
                         default=300)
     parser.add_argument("--output-prefix", dest="output_prefix", 
@@ -50,8 +126,66 @@ def _parse_commandline():
                         default=".{0}.gz".format(_hostname))
     parser.add_argument("--output-work-dir", dest="output_work_dir") 
     parser.add_argument("--output-complete-dir", dest="output_complete_dir")
+    parser.add_argument("--zdict", dest="zdict_paths", action="append",
+                        help="zlib dictionary file, may be repeated")
+    parser.add_argument("--index-block-records", dest="index_block_records",
+                        type=int, default=None,
+                        help="write an indexed file in blocks of this many "
+                        "records")
+    parser.add_argument("--flush-records", dest="flush_records",
+                        type=int, default=None,
+                        help="commit after this many records, flushing "
+                        "the compressor")
+    parser.add_argument("--flush-interval", dest="flush_interval",
+                        type=float, default=None,
+                        help="commit records after this many seconds")
+    parser.add_argument("--max-file-bytes", dest="max_file_bytes",
+                        type=int, default=None,
+                        help="start a new segment of the time slot once a "
+                        "file has this many bytes")
+    parser.add_argument("--max-file-records", dest="max_file_records",
+                        type=int, default=None,
+                        help="start a new segment of the time slot once a "
+                        "file has this many records")
+    parser.add_argument("--durability", dest="durability",
+                        choices=durabilities, default=durability_flush)
+    parser.add_argument("--drain-budget", dest="drain_budget",
+                        type=int, default=1000,
+                        help="most messages to take from a socket "
+                        "for each poll")
+    parser.add_argument("--pipeline-workers", dest="pipeline_workers",
+                        type=int, default=0,
+                        help="compress in this many worker threads "
+                        "(0 for none)")
+    parser.add_argument("--passthrough", dest="passthrough",
+                        action="store_true", default=False,
+                        help="store messages without compressing them again")
+    parser.add_argument("--hop-latency-path", dest="hop_latency_path",
+                        default=None,
+                        help="save the hop latencies of traced messages "
+                        "here")
+    parser.add_argument("--hop-latency-window", dest="hop_latency_window",
+                        type=float, default=300.0,
+                        help="seconds of hop latencies to keep")
+    parser.add_argument("--hop-latency-save-interval",
+                        dest="hop_latency_save_interval",
+                        type=float, default=10.0,
+                        help="seconds between saves of the hop latencies")
+    parser.add_argument("--sequence-summary-path",
+                        dest="sequence_summary_path", default=None,
+                        help="write a summary of sequence gaps here")
+    parser.add_argument("--sequence-summary-interval",
+                        dest="sequence_summary_interval",
+                        type=float, default=60.0,
+                        help="seconds between sequence summaries")
+    parser.add_argument("--sequence-idle-seconds",
+                        dest="sequence_idle_seconds",
+                        type=float, default=3600.0,
+                        help="forget the sequence of a producer we haven't "
+                        "heard from in this many seconds")
     parser.add_argument("--verbose", dest="verbose", action="store_true", 
                         default=False)
+    add_metrics_arguments(parser)
 
     return parser.parse_args()
 
@@ -66,12 +200,73 @@ def _initialize_logging(verbose):
     log_level = (logging.DEBUG if verbose else logging.WARN)
     logging.root.setLevel(log_level)
 
-def _load_sub_list(sub_list_path):
+def _log_sub_list_changes(added, removed):
+    for address in added:
+        _log.info("connecting sub_socket to {0}".format(address))
+    for address in removed:
+        _log.info("disconnecting sub_socket from {0}".format(address))
+
+def _receive_one_message(sub_socket, flags=0):
+    """
+    return a tuple of (topic, frames of one message (topic excluded),
+    hop trailer or None)
+    """
+    # we expect topic, compressed header, compressed body
+    # or topic, batch marker, compressed headers, compressed bodies
+    # perhaps followed by a hop trailer
+    topic = sub_socket.recv(flags)
+    assert sub_socket.rcvmore
+    frames = [sub_socket.recv(), ]
+    for _ in range(message_frame_count(frames[0]) - 1):
+        assert sub_socket.rcvmore
+        frames.append(sub_socket.recv())
+    trailer = None
+    if sub_socket.rcvmore:
+        trailer = sub_socket.recv()
+        assert is_hop_trailer(trailer)
+    assert not sub_socket.rcvmore
+    return topic, frames, trailer
+
+def _drain_socket_messages(sub_socket, drain_budget, messages, traces=None):
+    """
+    receive up to drain_budget messages from a ready socket, 
+    without blocking, appending their frames to messages,
+    and (topic, frames, trailer) to traces for those with a hop trailer
+
+    return the number of bytes we received (topics excluded)
+    """
+    received_bytes = 0
+    for _ in range(drain_budget):
+        try:
+            topic, frames, trailer = \
+                _receive_one_message(sub_socket, zmq.NOBLOCK)
+        except zmq.Again:
+            break
+        messages.append(frames)
+        received_bytes += sum(len(frame) for frame in frames)
+        if trailer is not None and traces is not None:
+            traces.append((topic, frames, trailer, ))
+    return received_bytes
+
+def _drain_socket(sub_socket, decompressor, drain_budget, records,
+                  traces=None):
     """
-    load a list of socket addresses to subscribe to
+    receive up to drain_budget messages from a ready socket, 
+    without blocking, appending their (header, data) tuples to records,
+    and (topic, frames, trailer) to traces for those with a hop trailer
+
+    return a tuple of (messages received, bytes received)
     """
-    with open(sub_list_path) as input_file:
-        return [line[:-1] for line in input_file.readlines()]
+    messages = list()
+    received_bytes = \
+        _drain_socket_messages(sub_socket, drain_budget, messages, traces)
+    for frames in messages:
+        try:
+            records.extend(unpack_message(frames, decompressor.decompress))
+        except ZlibDictionaryError:
+            instance = sys.exc_info()[1]
+            _log.error("discarding message: {0}".format(instance))
+    return len(messages), received_bytes
 
 def main():
     """
@@ -81,71 +276,197 @@ def main():
 
     _initialize_logging(args.verbose)
 
-    sub_address_list = _load_sub_list(args.sub_list_path)
-    for address in sub_address_list:
-        if is_ipc_protocol(address):
-            prepare_ipc_path(address)
+    if args.passthrough and args.pipeline_workers > 0:
+        _log.error("--passthrough has no compression work for "
+                   "--pipeline-workers")
+        return 1
 
     for directory in [args.output_work_dir, args.output_complete_dir, ]:
         if not os.path.isdir(directory):
             _log.info("creating {0}".format(directory))
             os.makedirs(directory) 
 
-    context = zmq.Context()
+    decompressor = create_zlib_decompressor(args.zdict_paths)
 
-    poller = zmq.Poller()
-
-    sub_socket_list = list()
-    for sub_socket_address in sub_address_list:
-        sub_socket = context.socket(zmq.SUB)
-        sub_socket.setsockopt(zmq.SUBSCRIBE, "".encode("utf-8"))
-        _log.info("connecting sub_socket to {0}".format(sub_socket_address))
-        sub_socket.connect(sub_socket_address)
-        poller.register(sub_socket, zmq.POLLIN)
-        sub_socket_list.append(sub_socket)
+    registry = MetricsRegistry()
+    poll_count = registry.counter("poll_wakeups_total",
+                                  "times the poller returned")
+    received_messages = registry.counter("messages_received_total",
+                                         "messages received",
+                                         {"socket" : "sub"})
+    received_bytes = registry.counter("bytes_received_total",
+                                      "bytes received, compressed",
+                                      {"socket" : "sub"})
+    batch_histogram = registry.histogram(
+        "batch_seconds",
+        "time taken to decompress and write the messages of a poll")
+    hop_latency_window = HopLatencyWindow(args.hop_latency_window,
+                                          args.hop_latency_save_interval)
+    hop_latency_tracker = HopLatencyTracker(decompressor.decompress,
+                                            hop_latency_window,
+                                            registry)
+    registry.counter("hop_trace_errors_total",
+                     "traced messages we could not measure",
+                     function=lambda: hop_latency_tracker.error_count)
+    next_hop_latency_save_time = \
+        time.time() + args.hop_latency_save_interval
+    sequence_tracker = \
+        SequenceTracker(registry, idle_seconds=args.sequence_idle_seconds)
+    next_sequence_summary_time = \
+        time.time() + args.sequence_summary_interval
+    metrics_server = start_metrics(registry,
+                                   args.metrics_address,
+                                   args.metrics_dump_path)
 
     stream_writer = LogStreamWriter(args.output_prefix,
                                     args.output_suffix,
                                     args.granularity,
                                     args.output_work_dir,
-                                    args.output_complete_dir)
+                                    args.output_complete_dir,
+                                    args.index_block_records,
+                                    args.flush_records,
+                                    args.flush_interval,
+                                    args.durability,
+                                    args.passthrough,
+                                    registry,
+                                    max_file_bytes=args.max_file_bytes,
+                                    max_file_records=args.max_file_records)
+
+    # a writer that was killed left its current file in the work dir
+    for file_name, complete_file_name, frame_count, whole in \
+        stream_writer.recover_work_dir():
+        if complete_file_name is None:
+            _log.warning("removed {0}: no complete frames".format(file_name))
+        elif whole:
+            _log.info("recovered {0} as {1}: {2} frames".format(
+                file_name, complete_file_name, frame_count))
+        else:
+            _log.warning("salvaged {0} as {1}: {2} frames".format(
+                file_name, complete_file_name, frame_count))
+
+    context = zmq.Context()
+
+    poller = zmq.Poller()
+
+    sub_list_watcher = SubListWatcher(args.sub_list_path,
+                                      args.sub_list_check_interval,
+                                      set_reload_signal_handler())
+    sub_socket_set = SubSocketSet(context, poller, None, args.connect_rate)
+    _log_sub_list_changes(*sub_socket_set.update(sub_list_watcher.load()))
+    registry.gauge("sub_addresses",
+                   "sub addresses we are connected to, or will connect to",
+                   function=lambda: len(sub_socket_set.addresses))
+
+    # wake often enough to commit records within the flush interval
+    polling_interval = args.polling_interval
+    if args.flush_interval is not None:
+        polling_interval = min(polling_interval, args.flush_interval)
+
+    pipeline = None
+    if args.pipeline_workers > 0:
+        pipeline = LogStreamPipeline(stream_writer,
+                                     decompressor,
+                                     args.pipeline_workers,
+                                     polling_interval=polling_interval,
+                                     rollover_timer=args.rollover_timer)
+        pipeline.start()
+        for name in pipeline.counters().keys():
+            registry.counter("pipeline_messages_total",
+                             "messages through the compression pipeline",
+                             {"state" : name},
+                             function=lambda n=name: pipeline.counters()[n])
 
     halt_event = set_signal_handler()
-    polling_intgerval_milliseconds = args.polling_interval * 1000
     while not halt_event.is_set():
+        if args.hop_latency_path is not None and \
+            time.time() >= next_hop_latency_save_time:
+            hop_latency_window.save(args.hop_latency_path)
+            next_hop_latency_save_time = \
+                time.time() + args.hop_latency_save_interval
+
+        if time.time() >= next_sequence_summary_time:
+            sequence_tracker.evict_idle()
+            if args.sequence_summary_path is not None:
+                sequence_tracker.save_summary(args.sequence_summary_path)
+            next_sequence_summary_time = \
+                time.time() + args.sequence_summary_interval
 
+        sub_address_list = sub_list_watcher.check()
+        if sub_address_list is not None:
+            _log_sub_list_changes(*sub_socket_set.update(sub_address_list))
+        sub_socket_set.connect_pending()
+
+        timeout = sub_socket_set.poll_timeout(polling_interval)
+        if args.rollover_timer and pipeline is None:
+            timeout = stream_writer.poll_timeout(timeout)
         try:
-            result_list = poller.poll(polling_intgerval_milliseconds)
+            result_list = poller.poll(timeout * 1000)
         except zmq.ZMQError:
             instance = sys.exc_info()[1]
             if instance.errno == errno.EINTR and halt_event.is_set():
                 break
             raise
+        poll_count.increment()
 
         if len(result_list) == 0:
-            stream_writer.check_for_rollover()
+            # the pipeline's writer thread does this for itself
+            if pipeline is None:
+                stream_writer.check_for_rollover()
+                stream_writer.check_for_flush()
             continue
 
-        for sub_socket, event in result_list: 
-            assert event == zmq.POLLIN, event
-
-            # we expect topic, compressed header, compressed body
-            _topic = sub_socket.recv()
-            assert sub_socket.rcvmore
-            compressed_header = sub_socket.recv()
-            assert sub_socket.rcvmore
-            compressed_data = sub_socket.recv()
-            assert not sub_socket.rcvmore
+        traces = list()
+        if pipeline is not None or args.passthrough:
+            messages = list()
+            for sub_socket, event in result_list: 
+                assert event == zmq.POLLIN, event
+                received_bytes.increment(
+                    _drain_socket_messages(sub_socket, args.drain_budget, 
+                                           messages, traces))
+            received_messages.increment(len(messages))
+            sequence_tracker.observe_messages(messages,
+                                              decompressor.decompress)
+            if pipeline is not None:
+                pipeline.submit(messages)
+            else:
+                with Timer(batch_histogram):
+                    for _, instance in stream_writer.write_messages(
+                        messages, decompressor):
+                        _log.error("discarding message: {0}".format(
+                            instance))
+        else:
+            with Timer(batch_histogram):
+                records = list()
+                for sub_socket, event in result_list: 
+                    assert event == zmq.POLLIN, event
+                    message_count, message_bytes = \
+                        _drain_socket(sub_socket, decompressor, 
+                                      args.drain_budget, records, traces)
+                    received_messages.increment(message_count)
+                    received_bytes.increment(message_bytes)
 
-            # send out what we got in
-            header = zlib.decompress(compressed_header)
-            data = zlib.decompress(compressed_data)
+                # write out everything we got in, checking rollover once
+                stream_writer.write_records(records)
+            sequence_tracker.observe_headers(header for (header, _) \
+                                             in records)
 
-            stream_writer.write(header, data)
+        end_time = time.time()
+        for topic, frames, trailer in traces:
+            hop_latency_tracker.observe(topic, frames, trailer, end_time)
 
     _log.debug("shutting down")
-    for sub_socket in sub_socket_list:
-        sub_socket.close()
+    if pipeline is None:
+        stream_writer.flush()
+    else:
+        pipeline.close()
+        _log.info("pipeline {0}".format(pipeline.counters()))
+    if args.hop_latency_path is not None:
+        hop_latency_window.save(args.hop_latency_path)
+    if args.sequence_summary_path is not None:
+        sequence_tracker.save_summary(args.sequence_summary_path)
+    if metrics_server is not None:
+        metrics_server.close()
+    sub_socket_set.close()
     context.term()
     return 0
 
@@ -31,12 +31,25 @@ timestamp: time.time()
 
 log_filename: the filename that the program would log to if it were using 
 normal file based logging. This may include slashes to indicate directories.
+
+Optionally, log messages may be gathered into batches: many headers and 
+bodies in one multipart message (see log_batch.py). Batching always uses
+the background thread below, which sends a partial batch once it is
+batch_interval old, even if no more log messages come.
+
+Optionally, emit may only queue the log message, leaving the compression and 
+sending to a single background thread per process (see log_line_sender.py), 
+so the thread that logs does not block when a PUSH peer reaches its HWM.
 """
 import logging
 
 import zmq
 
 from old_log_inn.log_line_pusher import LogLinePusher
+from old_log_inn.log_line_sender import overflow_block, \
+    overflow_policies, \
+    acquire_log_line_sender, \
+    release_log_line_sender
 
 class ZMQPushLogHandler(logging.Handler):
     """
@@ -48,7 +61,10 @@ class ZMQPushLogHandler(logging.Handler):
 
     The body is the content of the log message.   
     """
-    def __init__(self, log_path, zmq_context=None, level=logging.NOTSET):
+    def __init__(self, log_path, zmq_context=None, level=logging.NOTSET,
+                 batch_size=None, batch_interval=0.1, 
+                 sender_thread=False, sender_capacity=None, 
+                 overflow_policy=overflow_block):
         """
         log_path
             The filename that the program would log to if it were using normal 
@@ -62,9 +78,30 @@ class ZMQPushLogHandler(logging.Handler):
 
         level
             minimum log level. This is usually set externally
+
+        batch_size, batch_interval
+            opt in to batching, see LogLinePusher. With batching we always
+            use the background thread, so a partial batch is sent on time.
+
+        sender_thread
+            If True, emit only queues the record. It is sent from the
+            background thread, see LogLineSender
+
+        sender_capacity
+            the number of records the background queue holds. 
+            The first handler to start the background thread sets this.
+
+        overflow_policy
+            what emit does when the background queue is full:
+            'block', 'drop-oldest' or 'drop-newest'
         """
         super(ZMQPushLogHandler, self).__init__(level)
 
+        if not overflow_policy in overflow_policies:
+            raise ValueError("Invalid overflow_policy {0}".format(
+                overflow_policy))
+        self._overflow_policy = overflow_policy
+
         # if the caller does not suppy a zeromq context (they really should)
         # we create our own and hold a reference to it so we can terminate it.
         if zmq_context is None:
@@ -73,7 +110,26 @@ class ZMQPushLogHandler(logging.Handler):
         else:
             self._zmq_context = None
 
-        self._log_line_pusher = LogLinePusher(zmq_context, log_path)
+        self._log_line_pusher = LogLinePusher(zmq_context, 
+                                              log_path,
+                                              batch_size=batch_size,
+                                              batch_interval=batch_interval)
+
+        # only the background thread sends a partial batch when it is due,
+        # rather than at the next emit
+        if sender_thread or batch_size is not None:
+            self._log_line_sender = \
+                acquire_log_line_sender(self._log_line_pusher, 
+                                        capacity=sender_capacity)
+        else:
+            self._log_line_sender = None
+
+    @property
+    def log_line_sender(self):
+        """
+        the background LogLineSender (None if we send from emit)
+        """
+        return self._log_line_sender
 
     def emit(self, record):
         """
@@ -84,15 +140,47 @@ class ZMQPushLogHandler(logging.Handler):
             we use only the string returned by record.getMessage()
         """
         formatted_record = self.format(record)
-        self._log_line_pusher.push_log_line(formatted_record)
+        if self._log_line_sender is None:
+            self._log_line_pusher.push_log_line(formatted_record, 
+                                                record.created)
+        else:
+            self._log_line_sender.push_log_line(self._log_line_pusher,
+                                                formatted_record,
+                                                record.created,
+                                                self._overflow_policy)
+
+    def flush(self):
+        """
+        send any records waiting in a partial batch 
+        or in the background queue
+        """
+        self.acquire()
+        try:
+            if self._log_line_pusher is None:
+                pass
+            elif self._log_line_sender is None:
+                self._log_line_pusher.flush()
+            else:
+                self._log_line_sender.flush_pusher(self._log_line_pusher)
+        finally:
+            self.release()
         
     def close(self):
         """
         Tidy up any resources used by the handler.
+        Everything already emitted is sent before the sockets are closed.
         """
         super(ZMQPushLogHandler, self).close()
 
-        self._log_line_pusher.close()
+        if self._log_line_pusher is None:
+            return
+
+        if self._log_line_sender is None:
+            self._log_line_pusher.close()
+        else:
+            release_log_line_sender(self._log_line_sender, 
+                                    self._log_line_pusher)
+        self._log_line_pusher = None
 
         if self._zmq_context is not None:
             self._zmq_context.term()
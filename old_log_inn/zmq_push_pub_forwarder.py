@@ -4,32 +4,67 @@ zmq_push_pub_forwarder.py
 
 A program to listen on a ZMQ Pull socket, 
 and re-publish every message on a ZMQ Pub socket.
+
+Each message is published under a topic of the form hostname/nodename/log_path
+taken from its header (see log_topic.py), so subscribers can filter by topic
+prefix, and messages they don't want are never sent to them.
+A batch whose records have different topics is split into one batch per
+topic.
+We decompress the header to find the topic, which may need the preset
+dictionaries the producers use (--zdict).
+Give --topic to publish everything under one fixed topic, as we used to.
+
+With --hop-trace-every N, we add a hop trailer, stamped with the time, to
+every Nth message, so the writer can measure its latency (see hop_trace.py).
+
+Throughput is counted in metrics (see metrics.py).
 """
 import argparse
 import errno
 import logging
-import os
-import socket
 import sys
+import zlib
 
 import zmq
 
+from old_log_inn.hop_trace import HopStamper, hop_forwarder, \
+    split_hop_trailer
+from old_log_inn.log_batch import LogBatchError, message_frame_count
+from old_log_inn.log_header import HeaderDecoder, LogHeaderError
+from old_log_inn.log_topic import message_topics
+from old_log_inn.metrics import MetricsRegistry, add_metrics_arguments, \
+    start_metrics
+from old_log_inn.zlib_dictionary import ZlibDictionaryError, \
+    create_zlib_decompressor
 from old_log_inn.zmq_util import is_ipc_protocol, prepare_ipc_path
 from old_log_inn.signal_handler import set_signal_handler
 
 _log_format_template = '%(asctime)s %(levelname)-8s %(name)-20s: %(message)s'
 _log = logging.getLogger("main") 
-_hostname = os.environ.get("HOSTNAME", socket.gethostname())
+_topic_errors = (ZlibDictionaryError,
+                 zlib.error,
+                 LogBatchError,
+                 LogHeaderError,
+                 ValueError,
+                 KeyError, )
 
 def _parse_commandline():
     parser = \
         argparse.ArgumentParser(description='push_pub_forwarder')
     parser.add_argument("--pull", dest="zmq_pull_socket_address")
     parser.add_argument("--pub", dest="zmq_pub_socket_address")
-    parser.add_argument("--topic", dest="topic", default=_hostname)
+    parser.add_argument("--topic", dest="topic", default=None,
+                        help="publish everything under this fixed topic")
+    parser.add_argument("--zdict", dest="zdict_paths", action="append",
+                        help="zlib dictionary file, may be repeated")
     parser.add_argument("--hwm", dest="hwm", type=int, default=20000)
+    parser.add_argument("--hop-trace-every", dest="hop_trace_every",
+                        type=int, default=0,
+                        help="add a hop trailer to every Nth message "
+                        "(0 for none)")
     parser.add_argument("--verbose", dest="verbose", action="store_true", 
                         default=False)
+    add_metrics_arguments(parser)
 
     return parser.parse_args()
 
@@ -44,6 +79,73 @@ def _initialize_logging(verbose):
     log_level = (logging.DEBUG if verbose else logging.WARN)
     logging.root.setLevel(log_level)
 
+def _topic_messages(frames, topic_bytes, decompressor, header_decoder):
+    """
+    return a list of tuples of (topic, frames) to publish a message as:
+    the message under the fixed topic if we have one, otherwise under its own
+    (split by topic if it is a batch of more than one), or under the empty
+    topic if we can't tell what that is
+    """
+    if topic_bytes is not None:
+        return [(topic_bytes, frames, ), ]
+    try:
+        return message_topics(frames,
+                              decompressor.decompress,
+                              header_decoder)
+    except _topic_errors:
+        instance = sys.exc_info()[1]
+        _log.debug("no topic for message: {0}".format(instance))
+        return [(b"", frames, ), ]
+
+def _forward_message(pull_socket,
+                     pub_socket,
+                     topic_bytes,
+                     decompressor,
+                     header_decoder,
+                     hop_stamper=None):
+    """
+    forward one message from the pull socket to the pub socket,
+    without copying its frames (other than a hop trailer we stamp),
+    unless we split it by topic
+
+    return a tuple of (bytes received, messages sent, bytes sent)
+    """
+    # we expect a compressed header followed by a compressed body
+    # or a batch: marker, compressed headers, compressed bodies
+    # perhaps followed by a hop trailer
+    frames = pull_socket.recv_multipart(copy=False)
+    buffers = [frame.buffer for frame in frames]
+    expected_count = message_frame_count(buffers[0])
+    message_buffers, _ = split_hop_trailer(buffers, expected_count)
+    assert len(message_buffers) == expected_count, len(frames)
+    received_bytes = sum(len(buffer) for buffer in buffers)
+
+    if hop_stamper is not None:
+        frames = hop_stamper.stamp(frames, expected_count)
+
+    # send out what we got in, preceded by the pub topic
+    topic_messages = _topic_messages(message_buffers,
+                                     topic_bytes,
+                                     decompressor,
+                                     header_decoder)
+    if len(topic_messages) == 1:
+        (topic, _), = topic_messages
+        outgoing_messages = [[topic, ] + frames, ]
+    else:
+        # the hop trailer (if any) goes with the first of the split batches
+        _, trailer = split_hop_trailer(frames, expected_count)
+        outgoing_messages = [[topic, ] + topic_frames \
+                             for topic, topic_frames in topic_messages]
+        if trailer is not None:
+            outgoing_messages[0].append(trailer)
+
+    sent_bytes = 0
+    for outgoing_message in outgoing_messages:
+        pub_socket.send_multipart(outgoing_message, copy=False)
+        sent_bytes += sum(len(frame) for frame in outgoing_message)
+
+    return received_bytes, len(outgoing_messages), sent_bytes
+
 def main():
     """
     main entry point
@@ -56,7 +158,32 @@ def main():
         if is_ipc_protocol(address):
             prepare_ipc_path(address)
 
-    topic_bytes = args.topic.encode("utf-8")
+    if args.topic is None:
+        topic_bytes = None
+    else:
+        topic_bytes = args.topic.encode("utf-8")
+    decompressor = create_zlib_decompressor(args.zdict_paths)
+    header_decoder = HeaderDecoder()
+    hop_stamper = HopStamper(hop_forwarder, args.hop_trace_every)
+
+    registry = MetricsRegistry()
+    poll_count = registry.counter("poll_wakeups_total",
+                                  "times the poller returned")
+    received_messages = registry.counter("messages_received_total",
+                                         "messages received",
+                                         {"socket" : "pull"})
+    received_bytes = registry.counter("bytes_received_total",
+                                      "bytes received, compressed",
+                                      {"socket" : "pull"})
+    sent_messages = registry.counter("messages_sent_total",
+                                     "messages sent",
+                                     {"socket" : "pub"})
+    sent_bytes = registry.counter("bytes_sent_total",
+                                  "bytes sent, compressed",
+                                  {"socket" : "pub"})
+    metrics_server = start_metrics(registry,
+                                   args.metrics_address,
+                                   args.metrics_dump_path)
 
     context = zmq.Context()
 
@@ -83,21 +210,25 @@ def main():
                 break
             raise
         _log.debug("poller received {0}".format(result))
+        poll_count.increment()
 
         if pull_socket in result and result[pull_socket] == zmq.POLLIN:
 
-            # we expect a compressed header followed by a compressed body
-            header = pull_socket.recv()
-            assert pull_socket.rcvmore
-            body = pull_socket.recv()
-            assert not pull_socket.rcvmore
-
-            # send out what we got in, preceded by the pub topic
-            pub_socket.send(topic_bytes, zmq.SNDMORE)
-            pub_socket.send(header, zmq.SNDMORE)
-            pub_socket.send(body)
+            message_bytes_in, message_count_out, message_bytes_out = \
+                _forward_message(pull_socket,
+                                 pub_socket,
+                                 topic_bytes,
+                                 decompressor,
+                                 header_decoder,
+                                 hop_stamper)
+            received_messages.increment()
+            received_bytes.increment(message_bytes_in)
+            sent_messages.increment(message_count_out)
+            sent_bytes.increment(message_bytes_out)
 
     _log.info("shutting down")
+    if metrics_server is not None:
+        metrics_server.close()
     pub_socket.close()
     pull_socket.close()
     context.term()
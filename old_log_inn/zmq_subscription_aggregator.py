@@ -5,19 +5,52 @@ zmq_subscription_aggregator.py
 A program to subscribe to the log streams from every node, and re-publish them 
 on a single local pub socket, using HWM to give subscribers some protection 
 against disconnects.
+
+Messages keep the topic the forwarders gave them (hostname/nodename/log_path,
+see log_topic.py), so our own subscribers can filter by topic prefix.
+The forwarders split a batch from more than one producer by topic, so every
+message we relay has the full topic of all of its records.
+--subscribe narrows what we take from the nodes in the same way.
+
+We watch the --sub-list file, and reload it when it changes or on SIGHUP,
+connecting to the new addresses (no more than --connect-rate a second) and
+disconnecting from the ones that are gone, while the others carry on
+(see sub_list.py).
+
+With --shards N, the sub addresses are spread over N threads, each with its
+own poller, feeding the pub socket through an inproc queue
+(see subscription_shard.py). Every --report-interval seconds we log how many
+messages each shard relayed, and how many are waiting in the queue.
+If a shard dies, we log why and halt.
+
+With --hop-trace-every N, we add a hop trailer to every Nth message, and
+stamp the trailers of the messages that have one, with the time we relay
+them, so the writer can measure their latency (see hop_trace.py).
+
+Throughput is counted in metrics (see metrics.py).
 """
 import argparse
 import errno
 import logging
 import sys
+import time
 
 import zmq
 
+from old_log_inn.hop_trace import HopStamper, hop_aggregator
+from old_log_inn.metrics import MetricsRegistry, add_metrics_arguments, \
+    start_metrics
+from old_log_inn.subscription_shard import ShardedSubscriber, \
+    SubscriptionShardError, \
+    relay_message
 from old_log_inn.zmq_util import is_ipc_protocol, prepare_ipc_path
-from old_log_inn.signal_handler import set_signal_handler
+from old_log_inn.signal_handler import set_signal_handler, \
+    set_reload_signal_handler
+from old_log_inn.sub_list import SubListWatcher, SubSocketSet
 
 _log_format_template = '%(asctime)s %(levelname)-8s %(name)-20s: %(message)s'
 _log = logging.getLogger("main") 
+_polling_interval = 1.0
 
 def _parse_commandline():
     parser = \
@@ -25,8 +58,35 @@ def _parse_commandline():
     parser.add_argument("--sub-list", dest="sub_list_path")
     parser.add_argument("--pub", dest="zmq_pub_socket_address")
     parser.add_argument("--hwm", dest="hwm", type=int, default=20000)
+    parser.add_argument("--subscribe", dest="subscriptions", action="append",
+                        help="topic prefix to subscribe to, may be repeated "
+                        "(default: everything)")
+    parser.add_argument("--sub-list-check-interval",
+                        dest="sub_list_check_interval", type=float,
+                        default=5.0,
+                        help="seconds between checks of the sub list "
+                        "for changes")
+    parser.add_argument("--connect-rate", dest="connect_rate", type=float,
+                        default=10.0,
+                        help="most new sub connections per second "
+                        "(0 for no limit)")
+    parser.add_argument("--shards", dest="shards", type=int, default=0,
+                        help="number of subscriber threads "
+                        "(default: subscribe in the main thread)")
+    parser.add_argument("--relay-budget", dest="relay_budget", type=int,
+                        default=1000,
+                        help="most messages we publish from the shards "
+                        "between checks for halt and report")
+    parser.add_argument("--report-interval", dest="report_interval",
+                        type=float, default=60.0,
+                        help="seconds between reports of the shard counters")
+    parser.add_argument("--hop-trace-every", dest="hop_trace_every",
+                        type=int, default=0,
+                        help="add a hop trailer to every Nth message "
+                        "(0 for none)")
     parser.add_argument("--verbose", dest="verbose", action="store_true", 
                         default=False)
+    add_metrics_arguments(parser)
 
     return parser.parse_args()
 
@@ -41,12 +101,99 @@ def _initialize_logging(verbose):
     log_level = (logging.DEBUG if verbose else logging.WARN)
     logging.root.setLevel(log_level)
 
-def _load_sub_list(sub_list_path):
+def _log_sub_list_changes(added, removed):
+    for address in added:
+        _log.info("connecting sub_socket to {0}".format(address))
+    for address in removed:
+        _log.info("disconnecting sub_socket from {0}".format(address))
+
+def _register_shard_metrics(registry, sharded_subscriber):
     """
-    load a list of socket addresses to subscribe to
+    read the shard counters into the registry when we render it
     """
-    with open(sub_list_path) as input_file:
-        return [line[:-1] for line in input_file.readlines()]
+    def _shard_counter(index, name):
+        return lambda: sharded_subscriber.counters()["shards"][index][name]
+
+    registry.gauge("queue_depth",
+                   "messages waiting between the shards and the pub socket",
+                   function=lambda: sharded_subscriber.counters()[
+                       "queue_depth"])
+    for index in range(len(sharded_subscriber.counters()["shards"])):
+        labels = {"shard" : index}
+        registry.counter("shard_messages_relayed_total",
+                         "messages a shard relayed to the pub socket",
+                         labels,
+                         function=_shard_counter(index, "relayed"))
+        registry.counter("shard_bytes_relayed_total",
+                         "bytes a shard relayed to the pub socket",
+                         labels,
+                         function=_shard_counter(index, "bytes"))
+        registry.gauge("shard_sub_addresses",
+                       "sub addresses a shard subscribes to",
+                       labels,
+                       function=_shard_counter(index, "addresses"))
+
+def _relay_sharded(args,
+                   context,
+                   pub_socket,
+                   sub_list_watcher,
+                   subscriptions,
+                   halt_event,
+                   registry):
+    """
+    relay the messages the shards receive until we are halted
+
+    return 0, or 1 if a shard died
+    """
+    sub_address_list = sub_list_watcher.load()
+    _log.info("spreading {0} sub addresses over {1} shards".format(
+        len(sub_address_list), args.shards))
+    _log_sub_list_changes(sub_address_list, [])
+    sharded_subscriber = \
+        ShardedSubscriber(context,
+                          sub_address_list,
+                          subscriptions,
+                          args.shards,
+                          args.hwm,
+                          halt_event,
+                          connect_rate=args.connect_rate,
+                          hop_trace_every=args.hop_trace_every)
+    sharded_subscriber.start()
+    _register_shard_metrics(registry, sharded_subscriber)
+    sent_messages = registry.counter("messages_sent_total",
+                                     "messages sent",
+                                     {"socket" : "pub"})
+
+    return_code = 0
+    next_report_time = time.time() + args.report_interval
+    while not halt_event.is_set():
+        sub_address_list = sub_list_watcher.check()
+        if sub_address_list is not None:
+            _log_sub_list_changes(
+                *sharded_subscriber.update_addresses(sub_address_list))
+
+        try:
+            sent_messages.increment(
+                sharded_subscriber.relay(pub_socket, args.relay_budget))
+        except zmq.ZMQError:
+            instance = sys.exc_info()[1]
+            if instance.errno == errno.EINTR and halt_event.is_set():
+                break
+            raise
+        except SubscriptionShardError:
+            instance = sys.exc_info()[1]
+            _log.error("halting: {0}".format(instance))
+            return_code = 1
+            break
+
+        if time.time() >= next_report_time:
+            _log.info("shards {0}".format(sharded_subscriber.counters()))
+            next_report_time = time.time() + args.report_interval
+
+    halt_event.set()
+    sharded_subscriber.close()
+    _log.info("shards {0}".format(sharded_subscriber.counters()))
+    return return_code
 
 def main():
     """
@@ -56,11 +203,6 @@ def main():
 
     _initialize_logging(args.verbose)
 
-    sub_address_list = _load_sub_list(args.sub_list_path)
-    for address in sub_address_list:
-        if is_ipc_protocol(address):
-            prepare_ipc_path(address)
-
     if is_ipc_protocol(args.zmq_pub_socket_address):
         prepare_ipc_path(args.zmq_pub_socket_address)
 
@@ -71,50 +213,92 @@ def main():
     pub_socket.bind(args.zmq_pub_socket_address)
     pub_socket.setsockopt(zmq.HWM, args.hwm)
 
+    registry = MetricsRegistry()
+    metrics_server = start_metrics(registry,
+                                   args.metrics_address,
+                                   args.metrics_dump_path)
+
+    subscriptions = args.subscriptions or ["", ]
+    halt_event = set_signal_handler()
+    sub_list_watcher = SubListWatcher(args.sub_list_path,
+                                      args.sub_list_check_interval,
+                                      set_reload_signal_handler())
+
+    if args.shards > 0:
+        return_code = _relay_sharded(args,
+                                     context,
+                                     pub_socket,
+                                     sub_list_watcher,
+                                     subscriptions,
+                                     halt_event,
+                                     registry)
+        if metrics_server is not None:
+            metrics_server.close()
+        pub_socket.close()
+        context.term()
+        return return_code
+
     poller = zmq.Poller()
+    sub_socket_set = SubSocketSet(context,
+                                  poller,
+                                  subscriptions,
+                                  args.connect_rate)
+    _log_sub_list_changes(*sub_socket_set.update(sub_list_watcher.load()))
 
-    sub_socket_list = list()
-    for sub_socket_address in sub_address_list:
-        sub_socket = context.socket(zmq.SUB)
-        sub_socket.setsockopt(zmq.SUBSCRIBE, "".encode("utf-8"))
-        _log.info("connecting sub_socket to {0}".format(sub_socket_address))
-        sub_socket.connect(sub_socket_address)
-        poller.register(sub_socket, zmq.POLLIN)
-        sub_socket_list.append(sub_socket)
+    hop_stamper = HopStamper(hop_aggregator, args.hop_trace_every)
+    poll_count = registry.counter("poll_wakeups_total",
+                                  "times the poller returned")
+    received_messages = registry.counter("messages_received_total",
+                                         "messages received",
+                                         {"socket" : "sub"})
+    received_bytes = registry.counter("bytes_received_total",
+                                      "bytes received, compressed",
+                                      {"socket" : "sub"})
+    sent_messages = registry.counter("messages_sent_total",
+                                     "messages sent",
+                                     {"socket" : "pub"})
+    sent_bytes = registry.counter("bytes_sent_total",
+                                  "bytes sent, compressed",
+                                  {"socket" : "pub"})
+    registry.gauge("sub_addresses",
+                   "sub addresses we are connected to, or will connect to",
+                   function=lambda: len(sub_socket_set.addresses))
+    registry.gauge("sub_addresses_pending",
+                   "sub addresses waiting for a connection",
+                   function=lambda: sub_socket_set.pending_count)
 
-    halt_event = set_signal_handler()
     while not halt_event.is_set():
+        sub_address_list = sub_list_watcher.check()
+        if sub_address_list is not None:
+            _log_sub_list_changes(*sub_socket_set.update(sub_address_list))
+        sub_socket_set.connect_pending()
 
+        timeout = sub_socket_set.poll_timeout(_polling_interval)
         try:
-            result_list = poller.poll()
+            result_list = poller.poll(timeout * 1000)
         except zmq.ZMQError:
             instance = sys.exc_info()[1]
             if instance.errno == errno.EINTR and halt_event.is_set():
                 break
             raise
+        poll_count.increment()
 
         for sub_socket, event in result_list: 
             assert event == zmq.POLLIN, event
 
             _log.debug("traffic on socket {0}".format(sub_socket))
 
-            # we expect topic, compressed header, compressed body
-            topic = sub_socket.recv()
-            assert sub_socket.rcvmore
-            header = sub_socket.recv()
-            assert sub_socket.rcvmore
-            body = sub_socket.recv()
-            assert not sub_socket.rcvmore
-
-            # send out what we got in
-            pub_socket.send(topic, zmq.SNDMORE)
-            pub_socket.send(header, zmq.SNDMORE)
-            pub_socket.send(body)
+            message_bytes = relay_message(sub_socket, pub_socket, hop_stamper)
+            received_messages.increment()
+            received_bytes.increment(message_bytes)
+            sent_messages.increment()
+            sent_bytes.increment(message_bytes)
 
     _log.debug("shutting down")
+    if metrics_server is not None:
+        metrics_server.close()
     pub_socket.close()
-    for sub_socket in sub_socket_list:
-        sub_socket.close()
+    sub_socket_set.close()
     context.term()
     return 0
 
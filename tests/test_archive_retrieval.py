@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+test_archive_retrieval.py
+"""
+import json
+import os
+import os.path
+import shutil
+import threading
+import time
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from old_log_inn.archive_retrieval import collect_archive_keys, \
+    generate_retrieved_groups
+
+_test_dir = "/tmp/test_archive_retrieval"
+
+class _FakeKeyList(list):
+    def __init__(self, keys, truncated):
+        super(_FakeKeyList, self).__init__(keys)
+        self.truncated = truncated
+
+class _FakeKey(object):
+    def __init__(self, bucket, name, contents):
+        self._bucket = bucket
+        self.name = name
+        self._contents = contents
+
+    def get_contents_to_file(self, output_file):
+        self._bucket.enter()
+        try:
+            time.sleep(0.05)
+            output_file.write(self._contents)
+        finally:
+            self._bucket.leave()
+
+class _FakeBucket(object):
+    """
+    a local stand in for a motoboto bucket,
+    which remembers how many retrievals ran at once
+    """
+    def __init__(self, contents_dict, page_size=3):
+        self._keys = [_FakeKey(self, name, contents_dict[name]) \
+                      for name in sorted(contents_dict.keys())]
+        self._page_size = page_size
+        self._lock = threading.Lock()
+        self._active = 0
+        self.retrieved = list()
+        self.max_active = 0
+
+    def get_all_keys(self, marker=""):
+        keys = [key for key in self._keys if key.name > marker]
+        return _FakeKeyList(keys[:self._page_size],
+                            len(keys) > self._page_size)
+
+    def enter(self):
+        with self._lock:
+            self._active += 1
+            self.max_active = max(self.max_active, self._active)
+
+    def leave(self):
+        with self._lock:
+            self._active -= 1
+
+def _archive_name(timestamp, hostname):
+    return "logs.{0}.{1}.gz".format(timestamp, hostname)
+
+class TestArchiveRetrieval(unittest.TestCase):
+    """
+    test retrieving archives from a bucket
+    """
+    def setUp(self):
+        self.tearDown()
+        os.mkdir(_test_dir)
+
+    def tearDown(self):
+        if os.path.isdir(_test_dir):
+            shutil.rmtree(_test_dir)
+
+    def test_prefetch_in_order(self):
+        """
+        test that groups come out in timestamp order, retrieved in parallel
+        """
+        timestamps = ["2013010112{0:02}00".format(m) for m in range(0, 50, 5)]
+        contents_dict = dict()
+        for timestamp in timestamps:
+            for hostname in ["agg1", "agg2", ]:
+                name = _archive_name(timestamp, hostname)
+                contents_dict[name] = name.encode("utf-8")
+        contents_dict["unrelated"] = b""
+        bucket = _FakeBucket(contents_dict)
+
+        timestamp_key_dict, index_key_dict = \
+            collect_archive_keys(bucket,
+                                 prefix="logs.",
+                                 low_timestamp=timestamps[1],
+                                 high_timestamp=timestamps[-2])
+        self.assertEqual(sorted(timestamp_key_dict.keys()), timestamps[1:-1])
+        self.assertEqual(index_key_dict, dict())
+
+        retrieved_groups = generate_retrieved_groups(_test_dir,
+                                                     timestamp_key_dict,
+                                                     index_key_dict,
+                                                     prefetch_workers=4,
+                                                     prefetch_groups=2)
+        expected_timestamps = timestamps[1:-1]
+        for timestamp, retrieved_archives in retrieved_groups:
+            self.assertEqual(timestamp, expected_timestamps.pop(0))
+            self.assertEqual(len(retrieved_archives), 2)
+            for retrieved_archive in retrieved_archives:
+                with open(retrieved_archive.path, "rb") as input_file:
+                    self.assertEqual(input_file.read(),
+                                     retrieved_archive.key.name.encode())
+                retrieved_archive.remove()
+
+            # no more than the prefetched groups are on disk
+            self.assertTrue(len(os.listdir(_test_dir)) <= 2 * 2)
+
+        self.assertEqual(expected_timestamps, [])
+        self.assertTrue(bucket.max_active > 1, bucket.max_active)
+        self.assertEqual(os.listdir(_test_dir), [])
+
+    def test_index(self):
+        """
+        test that we don't retrieve an archive whose index rules it out
+        """
+        timestamp = "20130101120000"
+        contents_dict = dict()
+        for hostname in ["agg1", "agg2", ]:
+            name = _archive_name(timestamp, hostname)
+            contents_dict[name] = b"data"
+            index = {"version"  : 1,
+                     "file_name": name,
+                     "blocks"   : [{"offset"        : 0,
+                                    "size"          : 4,
+                                    "record_count"  : 1,
+                                    "min_timestamp" : 0.0,
+                                    "max_timestamp" : 0.0,
+                                    "hostnames"     : [hostname, ],
+                                    "log_paths"     : ["test.log", ],
+                                    "unknown"       : False, }, ], }
+            contents_dict[name + ".index"] = json.dumps(index).encode()
+        bucket = _FakeBucket(contents_dict)
+
+        timestamp_key_dict, index_key_dict = \
+            collect_archive_keys(bucket, prefix="logs.", suffix=".gz")
+        self.assertEqual(len(timestamp_key_dict[timestamp]), 2)
+        self.assertEqual(len(index_key_dict), 2)
+
+        index_block_preds = (lambda x: x == "agg2", None, )
+        retrieved_groups = list(generate_retrieved_groups(_test_dir,
+                                                          timestamp_key_dict,
+                                                          index_key_dict,
+                                                          index_block_preds))
+        self.assertEqual(len(retrieved_groups), 1)
+        _, (agg1, agg2, ) = retrieved_groups[0]
+        self.assertEqual(agg1.path, None)
+        self.assertEqual(agg1.blocks, [])
+        self.assertEqual(len(agg2.blocks), 1)
+        self.assertTrue(os.path.exists(agg2.path))
+        self.assertEqual(sorted(os.listdir(_test_dir)), [agg2.key.name])
+
+    def test_segments(self):
+        """
+        test that the segments of a time slot are grouped under its
+        timestamp, in order
+        """
+        names = ["logs.20130101120000.0001.agg1.gz",
+                 "logs.20130101120000.0002.agg1.gz",
+                 "logs.20130101120000.agg2.gz",
+                 "logs.20130101120500.0001.agg1.gz", ]
+        bucket = _FakeBucket(dict((name, b"", ) for name in names))
+
+        timestamp_key_dict, _ = \
+            collect_archive_keys(bucket, prefix="logs.", suffix=".gz")
+        self.assertEqual(
+            [key.name for key in timestamp_key_dict["20130101120000"]],
+            names[:3])
+        self.assertEqual(
+            [key.name for key in timestamp_key_dict["20130101120500"]],
+            names[3:])
+
+if __name__ == "__main__":
+    unittest.main()
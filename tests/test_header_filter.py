@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+test_header_filter.py
+"""
+import json
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from old_log_inn.header_filter import HeaderFilter
+from old_log_inn.log_header import HeaderDecoder, \
+    UnknownStringTableError, \
+    encode_binary_header, \
+    encode_string_table
+
+_uuid_bytes = b"0123456789abcdef"
+
+def _json_header(hostname, log_path, nodename=None):
+    header = {"hostname"    : hostname,
+              "log_path"    : log_path,
+              "timestamp"   : 1357042500.0, }
+    if nodename is not None:
+        header["nodename"] = nodename
+    return json.dumps(header).encode("utf-8")
+
+class TestHeaderFilter(unittest.TestCase):
+    """
+    test HeaderFilter
+    """
+    def test_json_headers(self):
+        """
+        test filtering raw JSON headers
+        """
+        header_filter = HeaderFilter(host_regexp="host0",
+                                     log_path_regexp=r".*\.log$")
+        header_decoder = HeaderDecoder()
+
+        raw_header = _json_header("host01", "/var/log/a.log")
+        self.assertEqual(header_filter.decode_header(raw_header,
+                                                     header_decoder),
+                         json.loads(raw_header.decode("utf-8")))
+
+        for raw_header in [_json_header("host11", "/var/log/a.log"),
+                           _json_header("host01", "/var/log/a.txt"), ]:
+            self.assertEqual(header_filter.decode_header(raw_header,
+                                                         header_decoder),
+                             None)
+
+        # a value we can't read from the raw bytes is judged after decoding
+        raw_header = json.dumps({"log_path" : "/var/log/\"a\".log",
+                                 "hostname" : "host0é", }).encode("utf-8")
+        self.assertEqual(header_filter.decode_header(raw_header,
+                                                     header_decoder)
+                         ["hostname"],
+                         "host0é")
+
+        raw_header = json.dumps({"log_path" : "a.log",
+                                 "hostname" : "éhost0", }).encode("utf-8")
+        self.assertEqual(header_filter.decode_header(raw_header,
+                                                     header_decoder),
+                         None)
+
+    def test_binary_headers(self):
+        """
+        test filtering binary headers by their string table
+        """
+        header_filter = HeaderFilter(host_regexp="host0")
+        header_decoder = HeaderDecoder()
+        raw_header = encode_binary_header(_uuid_bytes, 1, 1, 1357042500.0)
+
+        self.assertRaises(UnknownStringTableError,
+                          header_filter.decode_header,
+                          raw_header,
+                          header_decoder)
+
+        string_table = encode_string_table(_uuid_bytes, "host01", None, "a")
+        self.assertEqual(header_filter.decode_header(string_table,
+                                                     header_decoder),
+                         None)
+        self.assertEqual(header_filter.decode_header(raw_header,
+                                                     header_decoder)
+                         ["hostname"],
+                         "host01")
+
+        # the producer's verdict changes with its string table
+        string_table = encode_string_table(_uuid_bytes, "host11", None, "a")
+        header_filter.decode_header(string_table, header_decoder)
+        self.assertEqual(header_filter.decode_header(raw_header,
+                                                     header_decoder),
+                         None)
+
+    def test_nodename(self):
+        """
+        test a header without a nodename
+        """
+        header_decoder = HeaderDecoder()
+        with_nodename = _json_header("host01", "a.log", "node01")
+        without_nodename = _json_header("host01", "a.log")
+
+        for missing_nodename_passes in [True, False, ]:
+            header_filter = HeaderFilter(
+                node_regexp="node0",
+                missing_nodename_passes=missing_nodename_passes)
+            self.assertNotEqual(header_filter.decode_header(with_nodename,
+                                                            header_decoder),
+                                None)
+            header = header_filter.decode_header(without_nodename,
+                                                 header_decoder)
+            self.assertEqual(header is not None, missing_nodename_passes)
+
+    def test_empty_filter(self):
+        """
+        test that an empty filter passes everything
+        """
+        header_filter = HeaderFilter(host_regexp="",
+                                     node_regexp=None,
+                                     log_path_regexp="")
+        self.assertEqual(header_filter.hostname_pred, None)
+        self.assertEqual(header_filter.log_path_pred, None)
+        self.assertTrue(header_filter.match_header({}))
+        self.assertTrue(header_filter.match_content("anything"))
+
+        header_filter = HeaderFilter(content_regexp="ERROR")
+        self.assertTrue(header_filter.match_content("ERROR: oops"))
+        self.assertFalse(header_filter.match_content("INFO: fine"))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+test_hop_trace.py
+"""
+import json
+import os
+import os.path
+import shutil
+import zlib
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import zmq
+
+from old_log_inn.hop_latency_report import summarize_hop_latency
+from old_log_inn.hop_trace import HopLatencyTracker, \
+    HopLatencyWindow, \
+    HopStamper, \
+    bucket_quantile, \
+    hop_aggregator, \
+    hop_forwarder, \
+    load_hop_latency_window, \
+    message_origin_time, \
+    split_hop_trailer, \
+    unpack_hop_trailer
+from old_log_inn.log_batch import pack_batch
+from old_log_inn.log_header import encode_binary_header, encode_string_table
+from old_log_inn.subscription_shard import relay_message
+
+_test_dir = "/tmp/test_hop_trace"
+_hop_latency_path = os.path.join(_test_dir, "hop_latency.json")
+_relay_in_address = "inproc://test_hop_trace.in"
+_relay_out_address = "inproc://test_hop_trace.out"
+
+def _json_message(timestamp):
+    header = {"hostname" : "host01",
+              "log_path" : "/var/log/a.log",
+              "timestamp" : timestamp, }
+    return [zlib.compress(json.dumps(header).encode("utf-8")),
+            zlib.compress(b"body"), ]
+
+class TestHopTrace(unittest.TestCase):
+    """
+    test stamping messages as they are relayed, and measuring their latency
+    """
+    def setUp(self):
+        self.tearDown()
+        os.mkdir(_test_dir)
+
+    def tearDown(self):
+        if os.path.isdir(_test_dir):
+            shutil.rmtree(_test_dir)
+
+    def test_stamper(self):
+        """
+        test that we start a trailer on every Nth message,
+        and stamp every message that has one
+        """
+        forwarder_stamper = HopStamper(hop_forwarder, 3)
+        aggregator_stamper = HopStamper(hop_aggregator)
+        traced_count = 0
+        for index in range(9):
+            frames = _json_message(100.0)
+            frames = forwarder_stamper.stamp(frames, 2, 100.5)
+            frames = aggregator_stamper.stamp(frames, 2, 101.0)
+            message_frames, trailer = split_hop_trailer(frames, 2)
+            self.assertEqual(message_frames, _json_message(100.0))
+            if index % 3 != 2:
+                self.assertEqual(trailer, None)
+                continue
+            traced_count += 1
+            self.assertEqual(unpack_hop_trailer(trailer),
+                             [(hop_forwarder, 100.5, ),
+                              (hop_aggregator, 101.0, ), ])
+        self.assertEqual(traced_count, 3)
+        self.assertEqual(forwarder_stamper.started_count, 3)
+        self.assertEqual(aggregator_stamper.started_count, 0)
+        self.assertEqual(aggregator_stamper.stamped_count, 3)
+
+    def test_relay(self):
+        """
+        test that a relay passes on a traced message with its stamp added
+        """
+        context = zmq.Context()
+        input_socket = context.socket(zmq.PULL)
+        input_socket.bind(_relay_in_address)
+        push_socket = context.socket(zmq.PUSH)
+        push_socket.connect(_relay_in_address)
+        output_socket = context.socket(zmq.PUSH)
+        output_socket.bind(_relay_out_address)
+        pull_socket = context.socket(zmq.PULL)
+        pull_socket.connect(_relay_out_address)
+
+        traced_frames = HopStamper(hop_forwarder, 1).stamp(
+            [b"topic", ] + _json_message(100.0), 3)
+        push_socket.send_multipart(traced_frames)
+        relay_message(input_socket, output_socket, HopStamper(hop_aggregator))
+        frames = pull_socket.recv_multipart()
+        self.assertEqual(frames[:3], [b"topic", ] + _json_message(100.0))
+        self.assertEqual([hop for (hop, _) in unpack_hop_trailer(frames[3])],
+                         [hop_forwarder, hop_aggregator, ])
+
+        for socket in [input_socket, push_socket,
+                       output_socket, pull_socket, ]:
+            socket.close(linger=0)
+        context.term()
+
+    def test_origin_time(self):
+        """
+        test finding the time of the first record of a message
+        """
+        self.assertEqual(message_origin_time(_json_message(100.0),
+                                             zlib.decompress),
+                         100.0)
+        uuid_bytes = b"u" * 16
+        batch = pack_batch([encode_string_table(uuid_bytes,
+                                                "host01",
+                                                None,
+                                                "/var/log/a.log"),
+                            encode_binary_header(uuid_bytes, 1, 1, 200.0),
+                            encode_binary_header(uuid_bytes, 1, 2, 201.0), ],
+                           [b"", b"a", b"b", ])
+        self.assertEqual(message_origin_time(batch, zlib.decompress), 200.0)
+
+    def test_window(self):
+        """
+        test that the window keeps, forgets and saves what it is told
+        """
+        window = HopLatencyWindow(window_seconds=60.0, slice_seconds=10.0)
+        tracker = HopLatencyTracker(zlib.decompress, window)
+        for index in range(1000):
+            trailer = HopStamper(hop_forwarder, 1).stamp(
+                _json_message(1000.0), 2, 1000.001)[-1]
+            tracker.observe(b"host01/node01//var/log/a.log",
+                            _json_message(1000.0),
+                            trailer,
+                            1000.0 + (0.5 if index == 999 else 0.01))
+        tracker.observe(b"host02", _json_message(1000.0), b"junk", 1000.0)
+        self.assertEqual(tracker.error_count, 1)
+
+        counts = window.counts(1000.0)
+        self.assertEqual(sorted(counts.keys()),
+                         [("forwarder-writer", "host01", ),
+                          ("origin-forwarder", "host01", ),
+                          ("total", "host01", ), ])
+        total_counts = counts[("total", "host01", )]
+        self.assertEqual(sum(total_counts), 1000)
+        p50 = bucket_quantile(window.to_dict(1000.0)["bounds"],
+                              total_counts,
+                              0.5)
+        self.assertTrue(0.01 <= p50 < 0.0113, p50)
+        p999 = bucket_quantile(window.to_dict(1000.0)["bounds"],
+                               total_counts,
+                               0.9995)
+        self.assertTrue(0.5 <= p999 < 0.57, p999)
+
+        window.save(_hop_latency_path, 1005.0)
+        saved_window, histograms = load_hop_latency_window(_hop_latency_path)
+        self.assertEqual(histograms, counts)
+        summary = summarize_hop_latency(saved_window["bounds"], histograms)
+        self.assertEqual([(host, hop, count) for (host, hop, count, _) \
+                          in summary],
+                         [("*", "forwarder-writer", 1000, ),
+                          ("*", "origin-forwarder", 1000, ),
+                          ("*", "total", 1000, ),
+                          ("host01", "forwarder-writer", 1000, ),
+                          ("host01", "origin-forwarder", 1000, ),
+                          ("host01", "total", 1000, ), ])
+
+        # the slice is forgotten once the window has passed it
+        self.assertEqual(window.counts(1071.0), dict())
+
+if __name__ == "__main__":
+    unittest.main()
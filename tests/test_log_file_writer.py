@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+test_log_file_writer.py
+"""
+import os
+import os.path
+import shutil
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from old_log_inn.log_file_writer import LogFileWriter
+
+_test_dir = "/tmp/test_log_file_writer"
+_log_filename = "a.log"
+_log_path = os.path.join(_test_dir, _log_filename)
+
+def _read_lines(path):
+    with open(path, "r", encoding="utf-8") as input_file:
+        return input_file.read().splitlines()
+
+class TestLogFileWriter(unittest.TestCase):
+    """
+    test buffered, rotated log files
+    """
+    def setUp(self):
+        self.tearDown()
+        os.mkdir(_test_dir)
+
+    def tearDown(self):
+        if os.path.isdir(_test_dir):
+            shutil.rmtree(_test_dir)
+
+    def _check_rotation(self, background_rotation):
+        # 10 bytes a line: 3 lines to a file, as RotatingFileHandler has it
+        writer = LogFileWriter(_test_dir, 35, 2,
+                               flush_bytes=0,
+                               background_rotation=background_rotation)
+        for index in range(11):
+            writer.write(_log_filename, "line {0:04}".format(index), 100.0)
+        writer.close()
+
+        self.assertEqual(sorted(os.listdir(_test_dir)),
+                         [_log_filename,
+                          "{0}.1".format(_log_filename),
+                          "{0}.2".format(_log_filename), ])
+        self.assertEqual(_read_lines(_log_path), ["line 0009", "line 0010", ])
+        self.assertEqual(_read_lines("{0}.1".format(_log_path)),
+                         ["line 0006", "line 0007", "line 0008", ])
+        self.assertEqual(_read_lines("{0}.2".format(_log_path)),
+                         ["line 0003", "line 0004", "line 0005", ])
+        self.assertEqual(writer.rotation_error_count, 0)
+
+    def test_rotation(self):
+        """
+        test that files rotate and keep their backups like a
+        RotatingFileHandler
+        """
+        self._check_rotation(background_rotation=False)
+        self.tearDown()
+        self.setUp()
+        self._check_rotation(background_rotation=True)
+
+    def test_flush(self):
+        """
+        test that buffered lines are written by size and by time
+        """
+        writer = LogFileWriter(_test_dir, 0, 0,
+                               flush_bytes=30,
+                               flush_interval=1.0,
+                               background_rotation=False)
+        writer.write(_log_filename, "line 0000", 100.0)
+        writer.write(_log_filename, "line 0001", 100.5)
+        self.assertEqual(os.path.getsize(_log_path), 0)
+        self.assertEqual(writer.poll_timeout(5.0, 100.5), 0.5)
+
+        writer.write(_log_filename, "line 0002", 100.5)
+        self.assertEqual(os.path.getsize(_log_path), 30)
+        self.assertEqual(writer.poll_timeout(5.0, 100.5), 5.0)
+
+        writer.write(_log_filename, "line 0003", 101.0)
+        writer.check_for_flush(101.9)
+        self.assertEqual(os.path.getsize(_log_path), 30)
+        writer.check_for_flush(102.0)
+        self.assertEqual(os.path.getsize(_log_path), 40)
+        writer.close()
+
+    def test_existing_file(self):
+        """
+        test that a file we reopen counts the size it already has
+        """
+        with open(_log_path, "w") as output_file:
+            output_file.write("line 0000\nline 0001\n")
+        writer = LogFileWriter(_test_dir, 35, 1, flush_bytes=0,
+                               background_rotation=False)
+        writer.write(_log_filename, "line 0002", 100.0)
+        writer.write(_log_filename, "line 0003", 100.0)
+        writer.close()
+
+        self.assertEqual(_read_lines(_log_path), ["line 0003", ])
+        self.assertEqual(_read_lines("{0}.1".format(_log_path)),
+                         ["line 0000", "line 0001", "line 0002", ])
+
+if __name__ == "__main__":
+    unittest.main()
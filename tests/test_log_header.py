@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+test_log_header.py
+"""
+import json
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+import uuid
+
+from old_log_inn.log_header import header_encoding_json, \
+    header_encoding_binary, \
+    header_encoding_string_table, \
+    header_encoding, \
+    header_body_size, \
+    header_sequence, \
+    header_timestamp, \
+    encode_binary_header, \
+    encode_string_table, \
+    HeaderDecoder, \
+    UnknownStringTableError
+
+class TestLogHeader(unittest.TestCase):
+    """
+    test JSON and binary header encoding
+    """
+    def setUp(self):
+        self._uuid = uuid.uuid4()
+
+    def test_json(self):
+        """
+        JSON headers decode as they always have
+        """
+        header = {"hostname"    : "host01",
+                  "uuid"        : self._uuid.hex,
+                  "sequence"    : 1,
+                  "pid"         : 42,
+                  "timestamp"   : 1357041600.5,
+                  "log_path"    : "aaa/bbb/ccc.log"}
+        raw_header = json.dumps(header).encode("utf-8")
+        self.assertEqual(header_encoding(raw_header), header_encoding_json)
+        self.assertEqual(HeaderDecoder().decode(raw_header), header)
+
+    def test_binary(self):
+        """
+        binary headers decode to the same dict as JSON headers
+        """
+        string_table = encode_string_table(self._uuid.bytes, 
+                                           "host01", 
+                                           "node01", 
+                                           "aaa/bbb/ccc.log")
+        raw_header = encode_binary_header(self._uuid.bytes, 
+                                          42, 
+                                          2 ** 40, 
+                                          1357041600.5)
+        self.assertEqual(header_encoding(string_table), 
+                         header_encoding_string_table)
+        self.assertEqual(header_encoding(raw_header), header_encoding_binary)
+
+        decoder = HeaderDecoder()
+        self.assertRaises(UnknownStringTableError, decoder.decode, raw_header)
+        self.assertEqual(decoder.decode(string_table), None)
+
+        expected = {"hostname"    : "host01",
+                    "nodename"    : "node01",
+                    "uuid"        : self._uuid.hex,
+                    "sequence"    : 2 ** 40,
+                    "pid"         : 42,
+                    "timestamp"   : 1357041600.5,
+                    "log_path"    : "aaa/bbb/ccc.log"}
+        self.assertEqual(decoder.decode(raw_header), expected)
+
+    def test_no_nodename(self):
+        """
+        an empty nodename in the string table means no nodename
+        """
+        string_table = encode_string_table(self._uuid.bytes, 
+                                           "host01", 
+                                           None, 
+                                           "ccc.log")
+        decoder = HeaderDecoder()
+        decoder.decode(string_table)
+        header = decoder.decode(encode_binary_header(self._uuid.bytes, 
+                                                     1, 1, 0.0))
+        self.assertFalse("nodename" in header)
+        self.assertEqual(header["log_path"], "ccc.log")
+
+    def test_body_size(self):
+        """
+        a header may give the size of its body, and decodes as it would
+        without it
+        """
+        string_table = encode_string_table(self._uuid.bytes,
+                                           "host01",
+                                           None,
+                                           "ccc.log")
+        raw_header = encode_binary_header(self._uuid.bytes, 1, 2, 3.0)
+        sized_header = encode_binary_header(self._uuid.bytes, 1, 2, 3.0, 42)
+        json_header = json.dumps({"sequence"    : 2,
+                                  "body_size"   : 42}).encode("utf-8")
+        self.assertEqual(header_body_size(raw_header), None)
+        self.assertEqual(header_body_size(sized_header), 42)
+        self.assertEqual(header_body_size(json_header), 42)
+        self.assertEqual(header_body_size(b'{"sequence": 2}'), None)
+        self.assertEqual(header_body_size(string_table), 0)
+
+        decoder = HeaderDecoder()
+        decoder.decode(string_table)
+        self.assertEqual(decoder.decode(sized_header),
+                         decoder.decode(raw_header))
+        self.assertEqual(header_timestamp(sized_header), 3.0)
+        self.assertEqual(header_sequence(sized_header),
+                         (self._uuid.bytes, 2, ))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+test_log_line_sender.py
+"""
+import threading
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from old_log_inn.log_line_sender import overflow_block, \
+    overflow_drop_oldest, \
+    overflow_drop_newest, \
+    LogLineSender
+
+class _MockPusher(object):
+    """
+    stands in for LogLinePusher, 
+    blocking in push_log_line until it is released
+    """
+    def __init__(self):
+        self.released = threading.Event()
+        self.lines = list()
+        self.closed = False
+
+    def push_log_line(self, log_line, _timestamp):
+        self.released.wait()
+        self.lines.append(log_line)
+
+    def flush_deadline(self):
+        return None
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+class TestLogLineSender(unittest.TestCase):
+    """
+    test the background log line sender
+    """
+    def _fill(self, overflow_policy, line_count, capacity):
+        pusher = _MockPusher()
+        sender = LogLineSender(capacity)
+        sender.add_pusher(pusher)
+
+        # nothing is drained until the thread starts
+        for index in range(line_count):
+            sender.push_log_line(pusher, str(index), 0.0, overflow_policy)
+
+        sender.start()
+        pusher.released.set()
+        sender.close_pusher(pusher)
+        sender.halt()
+        sender.join()
+
+        self.assertTrue(pusher.closed)
+        return sender, pusher
+
+    def test_drop_newest(self):
+        """
+        a full ring discards the lines being added
+        """
+        sender, pusher = self._fill(overflow_drop_newest, 10, 4)
+        self.assertEqual(pusher.lines, ["0", "1", "2", "3", ])
+        self.assertEqual(sender.dropped_newest_count, 6)
+        self.assertEqual(sender.counters()["sent"], 4)
+
+    def test_drop_oldest(self):
+        """
+        a full ring discards its oldest lines
+        """
+        sender, pusher = self._fill(overflow_drop_oldest, 10, 4)
+        self.assertEqual(pusher.lines, ["6", "7", "8", "9", ])
+        self.assertEqual(sender.dropped_oldest_count, 6)
+
+    def test_block(self):
+        """
+        a full ring blocks the caller until there is room
+        """
+        capacity = 4
+        line_count = 20
+        pusher = _MockPusher()
+        sender = LogLineSender(capacity)
+        sender.add_pusher(pusher)
+        sender.start()
+
+        def _push_lines():
+            for index in range(line_count):
+                sender.push_log_line(pusher, str(index), 0.0, overflow_block)
+
+        push_thread = threading.Thread(target=_push_lines)
+        push_thread.start()
+        push_thread.join(timeout=0.5)
+
+        # the sender is stuck in push_log_line, so the caller is blocked
+        self.assertTrue(push_thread.is_alive())
+        
+        pusher.released.set()
+        push_thread.join()
+        sender.close_pusher(pusher)
+        sender.halt()
+        sender.join()
+
+        self.assertEqual(pusher.lines, [str(i) for i in range(line_count)])
+        self.assertTrue(sender.blocked_count > 0)
+        self.assertEqual(sender.dropped_oldest_count, 0)
+        self.assertEqual(sender.dropped_newest_count, 0)
+
+if __name__ == "__main__":
+    unittest.main()
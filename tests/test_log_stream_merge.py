@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+test_log_stream_merge.py
+"""
+import random
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from old_log_inn.log_stream_merge import generate_reordered, \
+    generate_merged_log_records, \
+    header_merge_key
+
+_random = random.Random(42)
+
+def _create_headers(uuid, count):
+    return [{"timestamp"    : 1000.0 + n,
+             "uuid"         : uuid,
+             "sequence"     : n, } for n in range(count)]
+
+def _shuffle_locally(items, distance):
+    """
+    move items out of order, but no more than distance places
+    """
+    items = list(items)
+    for index in range(0, len(items), distance):
+        chunk = items[index:index+distance]
+        _random.shuffle(chunk)
+        items[index:index+distance] = chunk
+    return items
+
+class TestLogStreamMerge(unittest.TestCase):
+    """
+    test the streaming merge of log streams
+    """
+    def test_reordered(self):
+        """
+        test that a reorder window puts nearby records back in order
+        """
+        items = list(range(1000))
+        shuffled = _shuffle_locally(items, 10)
+        self.assertEqual(list(generate_reordered(shuffled,
+                                                 lambda x: x,
+                                                 window=10)),
+                         items)
+
+        # a window too small leaves some out of order
+        self.assertNotEqual(list(generate_reordered(shuffled,
+                                                    lambda x: x,
+                                                    window=2)),
+                            items)
+
+    def test_merge_and_deduplicate(self):
+        """
+        test merging streams that hold some of the same records
+        """
+        headers_a = _create_headers("a", 100)
+        headers_b = _create_headers("b", 100)
+        stream_1 = _shuffle_locally(sorted(headers_a + headers_b[:60],
+                                           key=header_merge_key), 5)
+        stream_2 = _shuffle_locally(headers_b[40:], 5)
+        stream_3 = _shuffle_locally(headers_a[50:], 5)
+
+        merged = list(generate_merged_log_records([stream_1,
+                                                   stream_2,
+                                                   stream_3, ],
+                                                  header_merge_key,
+                                                  window=5))
+        self.assertEqual(merged,
+                         sorted(headers_a + headers_b, key=header_merge_key))
+
+    def test_streaming(self):
+        """
+        test that the first record comes out before we read the whole
+        stream
+        """
+        read_count = [0, ]
+        def _stream():
+            for header in _create_headers("a", 1000):
+                read_count[0] += 1
+                yield header
+
+        merged = generate_merged_log_records([_stream(), ],
+                                             header_merge_key,
+                                             window=10)
+        self.assertEqual(next(merged)["sequence"], 0)
+        self.assertEqual(read_count[0], 11)
+
+if __name__ == "__main__":
+    unittest.main()
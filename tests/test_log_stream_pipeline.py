@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+test_log_stream_pipeline.py
+"""
+import json
+import os
+import os.path
+import shutil
+import zlib
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from old_log_inn.log_batch import pack_batch
+from old_log_inn.log_header import encode_binary_header, encode_string_table
+from old_log_inn.log_stream import LogStreamWriter, \
+    generate_log_stream_from_blocks, \
+    generate_log_stream_from_directory, \
+    load_log_stream_index
+from old_log_inn.log_stream_pipeline import LogStreamPipeline, \
+    _encode_messages
+from old_log_inn.zlib_dictionary import ZlibDecompressor
+
+_test_dir = "/tmp/test_log_stream_pipeline"
+_output_work_dir = os.path.join(_test_dir, "output_work_dir")
+_output_complete_dir = os.path.join(_test_dir, "output_complete_dir")
+_slot_start = 1357042500.0 # 2013-01-01 12:15:00 UTC
+
+def _create_events(count):
+    events = list()
+    for n in range(count):
+        header = {"hostname"    : "host{0:02}".format(n % 3),
+                  "log_path"    : "test.log",
+                  "timestamp"   : _slot_start + n, }
+        events.append((json.dumps(header).encode("utf-8"),
+                       "line {0}".format(n).encode("utf-8"), ))
+    return events
+
+class TestLogStreamPipeline(unittest.TestCase):
+    """
+    test LogStreamPipeline
+    """
+    def setUp(self):
+        self.tearDown()
+        os.mkdir(_test_dir)
+        os.mkdir(_output_work_dir)
+        os.mkdir(_output_complete_dir)
+
+    def tearDown(self):
+        if os.path.isdir(_test_dir):
+            shutil.rmtree(_test_dir)
+
+    def _create_writer(self, index_block_records=None):
+        return LogStreamWriter("logs.",
+                               ".gz",
+                               5,
+                               _output_work_dir,
+                               _output_complete_dir,
+                               index_block_records=index_block_records)
+
+    def test_ordered_blocks(self):
+        """
+        test that blocks compressed in parallel are written in order,
+        as a valid log stream
+        """
+        events = _create_events(200)
+        writer = self._create_writer(index_block_records=7)
+        pipeline = LogStreamPipeline(writer, ZlibDecompressor(), 4)
+        pipeline.start()
+
+        # single messages and batches
+        for offset in range(0, len(events), 20):
+            messages = list()
+            for header, data in events[offset:offset+10]:
+                messages.append([zlib.compress(header), zlib.compress(data)])
+            batch = events[offset+10:offset+20]
+            messages.append(pack_batch([h for h, _ in batch],
+                                       [d for _, d in batch]))
+            pipeline.submit(messages, _slot_start + 1.0)
+
+        pipeline.close()
+        self.assertEqual(pipeline.counters()["written"], len(events))
+        self.assertEqual(pipeline.counters()["discarded"], 0)
+
+        writer.check_for_rollover(_slot_start + 5.0)
+        log_stream = generate_log_stream_from_directory(_output_complete_dir)
+        self.assertEqual(list(log_stream), events)
+
+        index = load_log_stream_index(os.path.join(_output_complete_dir,
+                                                   "logs.20130101121500.gz"))
+        blocks = index["blocks"]
+        self.assertEqual(sum(b["record_count"] for b in blocks), len(events))
+        self.assertTrue(all(b["record_count"] <= 7 for b in blocks))
+        self.assertEqual(blocks[0]["min_timestamp"], _slot_start)
+
+    def test_string_tables(self):
+        """
+        test that every block carries the string table it needs
+        """
+        uuid_bytes = b"0123456789abcdef"
+        string_table = encode_string_table(uuid_bytes, "host01", None,
+                                           "ccc.log")
+        headers = [encode_binary_header(uuid_bytes, 1, n, _slot_start) \
+                   for n in range(3)]
+
+        writer = self._create_writer()
+        pipeline = LogStreamPipeline(writer, ZlibDecompressor(), 1)
+        pipeline.start()
+        pipeline.submit([[zlib.compress(string_table), zlib.compress(b"")],
+                         [zlib.compress(headers[0]), zlib.compress(b"0")]],
+                        _slot_start)
+        pipeline.submit([[zlib.compress(headers[1]), zlib.compress(b"1")],
+                         [zlib.compress(headers[2]), zlib.compress(b"2")]],
+                        _slot_start)
+        pipeline.close()
+
+        writer.check_for_rollover(_slot_start + 5.0)
+        log_stream = generate_log_stream_from_directory(_output_complete_dir)
+        self.assertEqual(list(log_stream),
+                         [(string_table, b""),
+                          (headers[0], b"0"),
+                          (string_table, b""),
+                          (headers[1], b"1"),
+                          (headers[2], b"2"), ])
+
+    def test_string_tables_out_of_order(self):
+        """
+        test that a batch encoded before the batch with the string table
+        it needs gets the table, in a file of its own
+        """
+        uuid_bytes = b"0123456789abcdef"
+        string_table = encode_string_table(uuid_bytes, "host01", None,
+                                           "ccc.log")
+        headers = [encode_binary_header(uuid_bytes, 1, n, _slot_start) \
+                   for n in range(2)]
+        decompressor = ZlibDecompressor()
+        batch_b = _encode_messages(
+            [[zlib.compress(headers[1]), zlib.compress(b"1")]],
+            decompressor, True, None)
+        batch_a = _encode_messages(
+            [[zlib.compress(string_table), zlib.compress(b"")],
+             [zlib.compress(headers[0]), zlib.compress(b"0")]],
+            decompressor, True, None)
+
+        writer = self._create_writer(index_block_records=10)
+        for block in batch_a[0]:
+            writer.append_block(block, _slot_start)
+        # batch b goes to the next file
+        for block in batch_b[0]:
+            writer.append_block(block, _slot_start + 5.0)
+        writer.check_for_rollover(_slot_start + 10.0)
+
+        path = os.path.join(_output_complete_dir, "logs.20130101121505.gz")
+        index = load_log_stream_index(path)
+        (block, ) = index["blocks"]
+        self.assertEqual(block["hostnames"], ["host01"])
+        self.assertEqual(list(generate_log_stream_from_blocks(path, [block])),
+                         [(string_table, b""), (headers[1], b"1"), ])
+
+if __name__ == "__main__":
+    unittest.main()
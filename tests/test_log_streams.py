@@ -3,21 +3,36 @@
 test_log_streams.py
 """
 from datetime import datetime, timedelta
+from gzip import GzipFile, compress as gzip_compress
+from itertools import chain
+import json
 import logging
 import os
 import os.path
 import shutil
+import struct
 import sys
 import time
+import zlib
 try:
     import unittest2 as unittest
 except ImportError:
     import unittest
 
 from old_log_inn.log_stream import _compute_timestamp, \
+    _log_stream_read_units, \
+    LogStreamError, \
     LogStreamWriter, \
+    generate_log_stream_batches_from_file, \
     generate_log_stream_from_file, \
-    generate_log_stream_from_directory
+    generate_log_stream_from_directory, \
+    generate_log_stream_from_directory_parallel, \
+    generate_log_stream_from_indexed_file, \
+    load_log_stream_index, \
+    select_log_stream_index_blocks
+from old_log_inn.log_batch import pack_batch
+from old_log_inn.log_header import encode_binary_header, encode_string_table
+from old_log_inn.zlib_dictionary import ZlibCompressor, ZlibDecompressor
 
 _test_dir = "/tmp/test_log_streams"
 _test_prefix = "logs."
@@ -54,6 +69,12 @@ _time_test_list = [
     (3600, datetime(2013, 1, 1, hour=12, minute=20), "20130101120000", ),
 ]
 
+def _odd_record(header, data):
+    return int(data) % 2 == 1
+
+def _record_data(header, data):
+    return int(data)
+
 class TestLogStreamWriter(unittest.TestCase):
     """
     test LogStreamWriter and LogStreamReader
@@ -157,5 +178,682 @@ class TestLogStreamWriter(unittest.TestCase):
 
         self.assertRaises(StopIteration, next, log_stream)
 
+    def test_version_1_frames(self):
+        """
+        test reading a file written with protocol version 1 frames
+        """
+        events = [(b"aaa", b"111"), (b"bbb", b"222"), ]
+        path = os.path.join(_output_complete_dir, "version1.gz")
+        with GzipFile(filename=path, mode="wb") as output_file:
+            for header, data in events:
+                output_file.write(struct.pack("!BII", 1, len(header), 
+                                              len(data)))
+                output_file.write(header)
+                output_file.write(data)
+
+        self.assertEqual(list(generate_log_stream_from_file(path)), events)
+
+    def test_string_tables(self):
+        """
+        test that the string table of a binary header producer is written
+        once in each file, ahead of its records
+        """
+        uuid_bytes = b"0123456789abcdef"
+        string_table = encode_string_table(uuid_bytes, "host01", None, 
+                                           "ccc.log")
+        headers = [encode_binary_header(uuid_bytes, 1, n, 0.0) \
+                   for n in range(4)]
+
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 5, 
+                                 _output_work_dir, 
+                                 _output_complete_dir)
+
+        writer.write(string_table, b"")
+        writer.write(headers[0], b"111")
+        writer.write(string_table, b"")
+        writer.write(headers[1], b"222")
+        writer._close_current_file()
+
+        log_stream = generate_log_stream_from_directory(_output_complete_dir)
+        expected = [(string_table, b""), 
+                    (headers[0], b"111"), 
+                    (headers[1], b"222"), ]
+        self.assertEqual(list(log_stream), expected)
+
+        # the next file gets the table before the first record 
+        writer.write(headers[2], b"333")
+        writer.write(string_table, b"")
+        writer.write(headers[3], b"444")
+        writer._close_current_file()
+
+        # (in the same time slot, so it is completed under the next name)
+        log_stream = generate_log_stream_from_directory(_output_complete_dir)
+        expected.extend([(string_table, b""),
+                         (headers[2], b"333"),
+                         (headers[3], b"444"), ])
+        self.assertEqual(list(log_stream), expected)
+
+    def test_indexed_file(self):
+        """
+        test writing a file in indexed blocks and reading back only
+        the blocks we want
+        """
+        events = list()
+        for n, hostname in enumerate(["host01", "host01", "host02", 
+                                      "host02", "host01", ]):
+            header = {"hostname"    : hostname,
+                      "log_path"    : "{0}.log".format(hostname),
+                      "timestamp"   : 1000.0 + n, }
+            events.append((json.dumps(header).encode("utf-8"), 
+                           "{0}".format(n).encode("utf-8"), ))
+
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 5, 
+                                 _output_work_dir, 
+                                 _output_complete_dir,
+                                 index_block_records=2)
+        for header, data in events:
+            writer.write(header, data)
+        writer._close_current_file()
+
+        completed_list = sorted(os.listdir(_output_complete_dir))
+        self.assertEqual(len(completed_list), 2, completed_list)
+        path = os.path.join(_output_complete_dir, completed_list[0])
+
+        # the file as a whole reads as before, skipping the index
+        log_stream = generate_log_stream_from_directory(_output_complete_dir)
+        self.assertEqual(list(log_stream), events)
+
+        index = load_log_stream_index(path)
+        blocks = index["blocks"]
+        self.assertEqual([b["record_count"] for b in blocks], [2, 2, 1, ])
+        self.assertEqual([b["hostnames"] for b in blocks], 
+                         [["host01"], ["host02"], ["host01"], ])
+        self.assertEqual(blocks[1]["min_timestamp"], 1002.0)
+        self.assertEqual(blocks[1]["max_timestamp"], 1003.0)
+
+        log_stream = generate_log_stream_from_indexed_file(
+            path, hostname_pred=lambda x: x == "host02")
+        self.assertEqual(list(log_stream), events[2:4])
+
+        log_stream = generate_log_stream_from_indexed_file(
+            path, low_timestamp=1003.5)
+        self.assertEqual(list(log_stream), events[4:])
+
+        log_stream = generate_log_stream_from_indexed_file(
+            path, log_path_pred=lambda x: x == "host03.log")
+        self.assertEqual(list(log_stream), [])
+
+    def test_indexed_string_tables(self):
+        """
+        test that a block of string tables alone gets no index entry,
+        and that we can select from an index that has one
+        """
+        uuid_bytes = b"0123456789abcdef"
+        string_table = encode_string_table(uuid_bytes, "host01", None,
+                                           "ccc.log")
+        header = encode_binary_header(uuid_bytes, 1, 1, 1000.0)
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 5,
+                                 _output_work_dir,
+                                 _output_complete_dir,
+                                 index_block_records=1)
+        writer.write_records([(string_table, b""),
+                              (header, b"x"),
+                              (string_table, b""), ])
+        writer._close_current_file()
+
+        (path, ) = [os.path.join(_output_complete_dir, name) \
+                    for name in os.listdir(_output_complete_dir) \
+                    if not name.endswith(".index")]
+        index = load_log_stream_index(path)
+        (block, ) = index["blocks"]
+        self.assertEqual(block["hostnames"], ["host01"])
+        log_stream = generate_log_stream_from_indexed_file(
+            path, low_timestamp=999.0, high_timestamp=1001.0)
+        self.assertEqual(list(log_stream),
+                         [(string_table, b""), (header, b"x"), ])
+
+        index["blocks"].append({"offset"        : 0,
+                                "size"          : 0,
+                                "record_count"  : 1,
+                                "min_timestamp" : None,
+                                "max_timestamp" : None,
+                                "hostnames"     : [],
+                                "log_paths"     : [],
+                                "unknown"       : False, })
+        self.assertEqual(select_log_stream_index_blocks(index,
+                                                        low_timestamp=999.0,
+                                                        high_timestamp=1001.0),
+                         [block])
+
+    def test_group_commit(self):
+        """
+        test that records reach the work file in groups
+        """
+        events = [(b"aaa", b"111"), (b"bbb", b"222"), (b"ccc", b"333"), ]
+
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 5, 
+                                 _output_work_dir, 
+                                 _output_complete_dir,
+                                 flush_records=2,
+                                 flush_interval=10.0)
+
+        def _committed_size():
+            work_list = os.listdir(_output_work_dir)
+            self.assertEqual(len(work_list), 1, work_list)
+            with open(os.path.join(_output_work_dir, work_list[0]), 
+                      "rb") as input_file:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                return len(decompressor.decompress(input_file.read()))
+
+        frame_size = struct.calcsize("!BBII") + 6
+
+        writer.write(*events[0])
+        self.assertEqual(_committed_size(), 0)
+        writer.write(*events[1])
+        self.assertEqual(_committed_size(), 2 * frame_size)
+
+        writer.write(*events[2])
+        writer.check_for_flush()
+        self.assertEqual(_committed_size(), 2 * frame_size)
+        writer.check_for_flush(time.time() + 10.0)
+        self.assertEqual(_committed_size(), 3 * frame_size)
+
+        writer._close_current_file()
+        log_stream = generate_log_stream_from_directory(_output_complete_dir)
+        self.assertEqual(list(log_stream), events)
+
+    def test_default_flush(self):
+        """
+        test that without group commit we don't flush the compressor,
+        which would cost us compression
+        """
+        events = [(json.dumps({"sequence" : n}).encode("utf-8"),
+                   b"a log line", ) for n in range(100)]
+        file_sizes = list()
+        for flush_records in [None, 1, ]:
+            writer = LogStreamWriter(_test_prefix,
+                                     _test_suffix,
+                                     5,
+                                     _output_work_dir,
+                                     _output_complete_dir,
+                                     flush_records=flush_records)
+            for header, data in events:
+                writer.write(header, data)
+            (work_file_name, ) = os.listdir(_output_work_dir)
+            writer._close_current_file()
+            path = os.path.join(_output_complete_dir, work_file_name)
+            self.assertEqual(list(generate_log_stream_from_file(path)),
+                             events)
+            file_sizes.append(os.path.getsize(path))
+            os.unlink(path)
+        self.assertTrue(2 * file_sizes[0] < file_sizes[1], file_sizes)
+
+    def test_write_records(self):
+        """
+        test writing records in batches, rolling over at the end of 
+        the time slot
+        """
+        granularity = 5
+        events = [(b"aaa", b"111"), (b"bbb", b"222"), (b"ccc", b"333"), ]
+        slot_start = 1357042500.0 # 2013-01-01 12:15:00 UTC
+
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 granularity, 
+                                 _output_work_dir, 
+                                 _output_complete_dir)
+
+        writer.write_records(events[:2], slot_start + 1.0)
+        writer.write_records([], slot_start + 2.0)
+        writer.check_for_rollover(slot_start + granularity - 0.5)
+        self.assertEqual(os.listdir(_output_complete_dir), [])
+
+        writer.write_records(events[2:], slot_start + granularity)
+        self.assertEqual(os.listdir(_output_complete_dir), 
+                         ["logs.20130101121500.gz"])
+        self.assertEqual(os.listdir(_output_work_dir), 
+                         ["logs.20130101121505.gz"])
+
+        writer.check_for_rollover(slot_start + 2 * granularity)
+        log_stream = generate_log_stream_from_directory(_output_complete_dir)
+        self.assertEqual(list(log_stream), events)
+
+    def test_passthrough(self):
+        """
+        test storing messages as they came off the wire, and reading them
+        back with the producers' dictionaries
+        """
+        zdict = b"hostname log_path timestamp"
+        compress = ZlibCompressor(zdict).compress
+        uuid_bytes = b"0123456789abcdef"
+        string_table = encode_string_table(uuid_bytes, "host01", None, 
+                                           "ccc.log")
+        headers = [encode_binary_header(uuid_bytes, 1, n, 0.0) \
+                   for n in range(4)]
+
+        messages = [
+            [compress(b"aaa"), compress(b"111")],
+            pack_batch([b"bbb", b"ccc"], [b"222", b"333"], compress),
+            [compress(string_table), compress(b"")],
+            [compress(headers[0]), compress(b"444")],
+            [compress(string_table), compress(b"")],
+            pack_batch([string_table, headers[1], headers[2]], 
+                       [b"", b"555", b"666"], 
+                       compress),
+            [zlib.compress(headers[3]), zlib.compress(b"777")], ]
+
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 5, 
+                                 _output_work_dir, 
+                                 _output_complete_dir,
+                                 passthrough=True)
+        decompressor = ZlibDecompressor([zdict, ])
+        errors = writer.write_messages(messages, decompressor)
+        self.assertEqual(errors, [])
+
+        # a message we can't decompress is not written
+        errors = writer.write_messages(messages[:1], ZlibDecompressor())
+        self.assertEqual(len(errors), 1)
+        writer._close_current_file()
+
+        log_stream = generate_log_stream_from_directory(
+            _output_complete_dir, decompressor.decompress)
+        self.assertEqual(list(log_stream),
+                         [(b"aaa", b"111"), 
+                          (b"bbb", b"222"), 
+                          (b"ccc", b"333"), 
+                          (string_table, b""), 
+                          (headers[0], b"444"), 
+                          (string_table, b""), 
+                          (headers[1], b"555"), 
+                          (headers[2], b"666"), 
+                          (headers[3], b"777"), ])
+
+    def test_passthrough_body_size(self):
+        """
+        test storing messages whose headers give their body sizes, without
+        decompressing the bodies: a bad body costs only its own record
+        """
+        uuid_bytes = b"0123456789abcdef"
+        string_table = encode_string_table(uuid_bytes, "host01", None,
+                                           "ccc.log")
+        headers = [json.dumps({"sequence" : n, "body_size" : 3}).encode() \
+                   for n in range(3)]
+        binary_headers = [encode_binary_header(uuid_bytes, 1, n, 0.0, 3) \
+                          for n in range(2)]
+        compress = zlib.compress
+
+        messages = [
+            [compress(headers[0]), compress(b"111")],
+            # the header says 3 bytes, but the body is junk
+            [compress(headers[1]), b"junk"],
+            pack_batch([string_table, binary_headers[0], binary_headers[1]],
+                       [b"", b"222", b"333"],
+                       compress),
+            # a body that is not the size its header says
+            [compress(binary_headers[1]), compress(b"4444")],
+            [compress(headers[2]), compress(b"555")],
+            # a bad body whose header doesn't give its size, we find
+            [compress(b"ddd"), b"junk"], ]
+
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 5,
+                                 _output_work_dir,
+                                 _output_complete_dir,
+                                 passthrough=True)
+        decompressor = ZlibDecompressor()
+        errors = writer.write_messages(messages, decompressor)
+        self.assertEqual([message for (message, _) in errors],
+                         messages[-1:])
+        writer._close_current_file()
+
+        (path, ) = [os.path.join(_output_complete_dir, name) \
+                    for name in os.listdir(_output_complete_dir)]
+        expected_records = [(headers[0], b"111"),
+                            (string_table, b""),
+                            (binary_headers[0], b"222"),
+                            (binary_headers[1], b"333"),
+                            (headers[2], b"555"), ]
+
+        bad_frames = list()
+        log_stream = generate_log_stream_from_file(path,
+                                                   bad_frames=bad_frames)
+        self.assertEqual(list(log_stream), expected_records)
+        self.assertEqual([type(e) for e in bad_frames],
+                         [zlib.error, LogStreamError, ])
+
+        bad_frames = list()
+        log_stream = chain.from_iterable(
+            generate_log_stream_batches_from_file(path,
+                                                  bad_frames=bad_frames))
+        self.assertEqual(list(log_stream), expected_records)
+        self.assertEqual(len(bad_frames), 2)
+
+        # we skip bad frames whether we are told of them or not
+        self.assertEqual(list(generate_log_stream_from_directory(
+            _output_complete_dir)), expected_records)
+
+    def test_read_batches(self):
+        """
+        test that the chunked reader reads what the generator reads,
+        whatever the chunk size
+        """
+        zdict = b"hostname log_path timestamp"
+        compress = ZlibCompressor(zdict).compress
+        decompressor = ZlibDecompressor([zdict, ])
+        events = list()
+        messages = list()
+        for n in range(20):
+            header = {"hostname"    : "host{0:02}".format(n % 3),
+                      "log_path"    : "a.log",
+                      "timestamp"   : 1000.0 + n, }
+            event = (json.dumps(header).encode("utf-8"),
+                     "{0}".format(n).encode("utf-8") * n, )
+            events.append(event)
+            messages.append([compress(event[0]), compress(event[1])])
+        messages.append(pack_batch([e[0] for e in events[:5]],
+                                   [e[1] for e in events[:5]],
+                                   compress))
+
+        for passthrough in [False, True, ]:
+            writer = LogStreamWriter(_test_prefix,
+                                     _test_suffix,
+                                     5,
+                                     _output_work_dir,
+                                     _output_complete_dir,
+                                     passthrough=passthrough,
+                                     index_block_records=7)
+            self.assertEqual(writer.write_messages(messages, decompressor),
+                             [])
+            writer._close_current_file()
+            (path, ) = [os.path.join(_output_complete_dir, n) for n \
+                        in os.listdir(_output_complete_dir) \
+                        if n.endswith(_test_suffix)]
+            # gzip files may be padded with zeros
+            with open(path, "ab") as output_file:
+                output_file.write(b"\x00" * 10)
+
+            expected = list(generate_log_stream_from_file(
+                path, decompressor.decompress))
+            self.assertEqual(expected, events + events[:5])
+            blocks = load_log_stream_index(path)["blocks"]
+            for chunk_size in [1, 7, 100, 1024 ** 2, ]:
+                for views in [False, True, ]:
+                    batches = list(generate_log_stream_batches_from_file(
+                        path,
+                        decompress=decompressor.decompress,
+                        chunk_size=chunk_size,
+                        views=views))
+                    records = [(bytes(h), bytes(d), ) for (h, d) \
+                               in sum(batches, [])]
+                    self.assertEqual(records, expected, chunk_size)
+                batches = list(generate_log_stream_batches_from_file(
+                    path,
+                    blocks[1:2],
+                    decompressor.decompress,
+                    chunk_size))
+                self.assertEqual(sum(batches, []), expected[7:14])
+            os.unlink(path)
+
+    def test_read_batches_invalid(self):
+        """
+        test that the chunked reader rejects what the generator rejects
+        """
+        path = os.path.join(_output_complete_dir, "invalid.gz")
+        frames = [struct.pack("!BBII", 2, 1, 3, 3) + b"aaa111",
+                  struct.pack("!BBII", 2, 1, 3, 3) + b"bbb222", ]
+        for tail, error in [(b"", None, ),
+                            (struct.pack("!BB", 2, 1), None, ),
+                            (struct.pack("!BBII", 2, 1, 3, 3) + b"cc",
+                             LogStreamError, ),
+                            (struct.pack("!BBII", 9, 1, 3, 3),
+                             LogStreamError, ),
+                            (struct.pack("!BBII", 2, 99, 3, 3) + b"ccc333",
+                             LogStreamError, ), ]:
+            with GzipFile(filename=path, mode="wb") as output_file:
+                output_file.write(b"".join(frames + [tail, ]))
+            for log_stream in [
+                generate_log_stream_from_file(path),
+                chain.from_iterable(generate_log_stream_batches_from_file(
+                    path, chunk_size=4)), ]:
+                records = list()
+                try:
+                    for record in log_stream:
+                        records.append(record)
+                except LogStreamError:
+                    self.assertEqual(error, LogStreamError, tail)
+                else:
+                    self.assertEqual(error, None, tail)
+                self.assertEqual(records, [(b"aaa", b"111"),
+                                           (b"bbb", b"222"), ])
+
+        # a file cut short in its gzip trailer
+        with open(path, "wb") as output_file:
+            output_file.write(gzip_compress(b"".join(frames))[:-4])
+        log_stream = generate_log_stream_batches_from_file(path)
+        self.assertRaises(EOFError, list, log_stream)
+
+    def test_directory_parallel(self):
+        """
+        test reading a directory in worker processes, in file order
+        or as the units of work are read
+        """
+        granularity = 5
+        slot_start = 1357042500.0 # 2013-01-01 12:15:00 UTC
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 granularity,
+                                 _output_work_dir,
+                                 _output_complete_dir,
+                                 index_block_records=10)
+        events = list()
+        for slot in range(6):
+            records = [(b"header", "{0}".format(n).encode("utf-8"), ) \
+                       for n in range(slot * 100, slot * 100 + 100)]
+            writer.write_records(records, slot_start + slot * granularity)
+            events.extend(records)
+        writer.check_for_rollover(slot_start + 6 * granularity)
+
+        # each file is cut into units of a few blocks
+        (path, ) = [os.path.join(_output_complete_dir, name) \
+                    for name in os.listdir(_output_complete_dir) \
+                    if name.endswith("121500.gz")]
+        block_size = load_log_stream_index(path)["blocks"][0]["size"]
+        units = _log_stream_read_units(path, 3 * block_size)
+        self.assertTrue(3 <= len(units) <= 4, units)
+        self.assertEqual(units[0][0], 0)
+        self.assertEqual(sum(size for (_, size) in units),
+                         os.path.getsize(path))
+
+        self.assertEqual(
+            list(generate_log_stream_from_directory_parallel(
+                _output_complete_dir, workers=2,
+                unit_bytes=3 * block_size,
+                lookahead_bytes=10 * block_size)),
+            list(generate_log_stream_from_directory(_output_complete_dir)))
+        self.assertEqual(
+            sorted(generate_log_stream_from_directory_parallel(
+                _output_complete_dir, workers=2, ordered=False)),
+            sorted(events))
+
+        log_stream = generate_log_stream_from_directory_parallel(
+            _output_complete_dir,
+            record_filter=_odd_record,
+            record_map=_record_data,
+            workers=2)
+        self.assertEqual(list(log_stream), list(range(1, 600, 2)))
+
+        # stopping early is fine
+        log_stream = generate_log_stream_from_directory_parallel(
+            _output_complete_dir, workers=2, lookahead_bytes=1)
+        self.assertEqual(next(log_stream), events[0])
+        log_stream.close()
+
+    def test_recover_work_dir(self):
+        """
+        test salvaging the files a killed writer left in the work dir,
+        and giving a completed file a free name
+        """
+        slot_start = 1357042500.0 # 2013-01-01 12:15:00 UTC
+        events = [("{0:03}".format(n).encode("utf-8"), b"data" * n, ) \
+                  for n in range(50)]
+        killed_writer = LogStreamWriter(_test_prefix,
+                                        _test_suffix,
+                                        5,
+                                        _output_work_dir,
+                                        _output_complete_dir,
+                                        flush_records=1)
+        killed_writer.write_records(events, slot_start)
+        (file_name, ) = os.listdir(_output_work_dir)
+        work_path = os.path.join(_output_work_dir, file_name)
+        # the file is flushed, but has no gzip trailer;
+        # cut it short to tear its last frame as well
+        with open(work_path, "rb") as input_file:
+            data = input_file.read()
+        with open(work_path, "wb") as output_file:
+            output_file.write(data[:-10])
+
+        log_stream = generate_log_stream_from_file(work_path)
+        self.assertRaises((EOFError, LogStreamError, ), list, log_stream)
+        salvaged = list(generate_log_stream_from_file(work_path,
+                                                      tolerant=True))
+        self.assertTrue(0 < len(salvaged) < len(events), len(salvaged))
+        self.assertEqual(salvaged, events[:len(salvaged)])
+
+        # a file left whole, and a salvage cut short
+        whole_name = "{0}20130101121000{1}".format(_test_prefix,
+                                                   _test_suffix)
+        with GzipFile(filename=os.path.join(_output_work_dir, whole_name),
+                      mode="wb") as output_file:
+            output_file.write(struct.pack("!BII", 1, 3, 3) + b"aaa111")
+        with open("{0}.salvage".format(work_path), "wb") as output_file:
+            output_file.write(b"junk")
+
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 5,
+                                 _output_work_dir,
+                                 _output_complete_dir)
+        self.assertEqual(writer.recover_work_dir(),
+                         [(whole_name, whole_name, 1, True, ),
+                          (file_name, file_name, len(salvaged), False, ), ])
+        self.assertEqual(os.listdir(_output_work_dir), [])
+        self.assertEqual(
+            list(generate_log_stream_from_directory(_output_complete_dir)),
+            [(b"aaa", b"111", ), ] + salvaged)
+
+        # the same time slot again
+        writer.write_records(events[:1], slot_start + 1.0)
+        writer.check_for_rollover(slot_start + 5.0)
+        collision_name = file_name.replace(_test_suffix,
+                                           "_01{0}".format(_test_suffix))
+        self.assertEqual(sorted(os.listdir(_output_complete_dir)),
+                         sorted([whole_name, file_name, collision_name, ]))
+        self.assertEqual(list(generate_log_stream_from_file(
+            os.path.join(_output_complete_dir, collision_name))),
+            events[:1])
+
+    def test_clock(self):
+        """
+        test that the writer names and completes its files by the clock
+        it is given
+        """
+        clock_times = [1357042500.0] # 2013-01-01 12:15:00 UTC
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 5,
+                                 _output_work_dir,
+                                 _output_complete_dir,
+                                 clock=lambda: clock_times[0])
+        self.assertEqual(writer.poll_timeout(1.0), 1.0)
+        clock_times[0] += 2.5
+        writer.write(b"aaa", b"111")
+        self.assertEqual(writer.rollover_deadline, 1357042505.0)
+        self.assertEqual(writer.poll_timeout(1.0), 1.0)
+        clock_times[0] += 2.0
+        self.assertEqual(writer.poll_timeout(1.0), 0.5)
+        writer.check_for_rollover()
+        self.assertEqual(os.listdir(_output_complete_dir), [])
+        clock_times[0] += 0.5
+        self.assertEqual(writer.poll_timeout(1.0), 0.0)
+        writer.check_for_rollover()
+        self.assertEqual(os.listdir(_output_complete_dir),
+                         ["logs.20130101121500.gz"])
+        self.assertEqual(writer.rollover_deadline, None)
+
+        # the slot gives the timestamp _compute_timestamp would
+        for granularity, time_value, expected_timestamp in _time_test_list:
+            writer = LogStreamWriter(_test_prefix,
+                                     _test_suffix,
+                                     granularity,
+                                     _output_work_dir,
+                                     _output_complete_dir)
+            current_time = (time_value - datetime(1970, 1, 1)).total_seconds()
+            writer.write_records([(b"aaa", b"111"), ], current_time)
+            self.assertEqual(os.listdir(_output_work_dir),
+                             ["logs.{0}.gz".format(expected_timestamp)])
+            writer._close_current_file()
+
+    def test_segments(self):
+        """
+        test splitting a time slot into numbered segments by records and
+        by bytes, in names that sort in the order they were written
+        """
+        slot_start = 1357042500.0 # 2013-01-01 12:15:00 UTC
+        events = [("{0:03}".format(n).encode("utf-8"), b"data" * n, ) \
+                  for n in range(25)]
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 5,
+                                 _output_work_dir,
+                                 _output_complete_dir,
+                                 max_file_records=10)
+        writer.write_records(events[:15], slot_start)
+        writer.write_records(events[15:], slot_start + 1.0)
+        self.assertEqual(sorted(os.listdir(_output_complete_dir)),
+                         ["logs.20130101121500.0001.gz",
+                          "logs.20130101121500.0002.gz", ])
+        writer.write_records([(b"aaa", b"111"), ], slot_start + 5.0)
+        writer._close_current_file()
+
+        # a restarted writer goes on after the segments it finds
+        writer = LogStreamWriter(_test_prefix,
+                                 _test_suffix,
+                                 5,
+                                 _output_work_dir,
+                                 _output_complete_dir,
+                                 max_file_bytes=1)
+        writer.write_records([(b"bbb", b"222"), (b"ccc", b"333"), ],
+                             slot_start + 2.0)
+        self.assertEqual(os.listdir(_output_work_dir), [])
+        self.assertEqual(sorted(os.listdir(_output_complete_dir)),
+                         ["logs.20130101121500.0001.gz",
+                          "logs.20130101121500.0002.gz",
+                          "logs.20130101121500.0003.gz",
+                          "logs.20130101121500.0004.gz",
+                          "logs.20130101121500.0005.gz",
+                          "logs.20130101121505.0001.gz", ])
+        self.assertEqual(
+            list(generate_log_stream_from_directory(_output_complete_dir)),
+            events + [(b"bbb", b"222"), (b"ccc", b"333"), (b"aaa", b"111"), ])
+
+    def test_invalid_durability(self):
+        """
+        test that we reject an unknown durability
+        """
+        self.assertRaises(ValueError, LogStreamWriter, _test_prefix,
+                          _test_suffix, 5, _output_work_dir, 
+                          _output_complete_dir, durability="sometimes")
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+test_log_topic.py
+"""
+import json
+import re
+import zlib
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from old_log_inn.log_batch import pack_batch, unpack_batch
+from old_log_inn.log_header import HeaderDecoder, \
+    encode_binary_header, \
+    encode_string_table
+from old_log_inn.log_topic import message_topics, subscription_prefix
+
+_uuid_bytes = b"0123456789abcdef"
+
+def _json_header(hostname, log_path, nodename=None):
+    header = {"hostname"    : hostname,
+              "log_path"    : log_path,
+              "timestamp"   : 1357042500.0, }
+    if nodename is not None:
+        header["nodename"] = nodename
+    return json.dumps(header).encode("utf-8")
+
+class TestLogTopic(unittest.TestCase):
+    """
+    test the topics we publish log messages under
+    """
+    def test_message_topic(self):
+        """
+        test the topic of single messages and batches
+        """
+        header_decoder = HeaderDecoder()
+        message = [zlib.compress(_json_header("host01", "/var/log/a.log")),
+                   zlib.compress(b"body"), ]
+        self.assertEqual(message_topics(message,
+                                        zlib.decompress,
+                                        header_decoder),
+                         [(b"host01///var/log/a.log", message, ), ])
+
+        string_table = encode_string_table(_uuid_bytes,
+                                           "host02",
+                                           "node1",
+                                           "b.log")
+        binary_header = encode_binary_header(_uuid_bytes, 1, 1, 1.0)
+        for raw_header in [string_table, binary_header, ]:
+            message = [zlib.compress(raw_header), zlib.compress(b""), ]
+            self.assertEqual(message_topics(message,
+                                            zlib.decompress,
+                                            header_decoder),
+                             [(b"host02/node1/b.log", message, ), ])
+
+        # a batch from one log file is published as it is
+        message = pack_batch([_json_header("host01", "/var/log/a.log"),
+                              _json_header("host01", "/var/log/a.log"), ],
+                             [b"a1", b"a2", ])
+        self.assertEqual(message_topics(message,
+                                        zlib.decompress,
+                                        header_decoder),
+                         [(b"host01///var/log/a.log", message, ), ])
+
+    def test_mixed_batch(self):
+        """
+        test that a batch from more than one host and log file is split,
+        so a subscriber to one host still gets its records
+        """
+        header_decoder = HeaderDecoder()
+        headers = [_json_header("host01", "/var/log/a.log"),
+                   _json_header("host01", "/var/log/b.log"),
+                   _json_header("host02", "/var/log/a.log"),
+                   _json_header("host01", "/var/log/a.log"), ]
+        bodies = [b"a1", b"b1", b"host02 a1", b"a2", ]
+        message = pack_batch(headers, bodies)
+
+        topic_messages = message_topics(message,
+                                        zlib.decompress,
+                                        header_decoder)
+        self.assertEqual([topic for topic, _ in topic_messages],
+                         [b"host01///var/log/a.log",
+                          b"host01///var/log/b.log",
+                          b"host02///var/log/a.log", ])
+
+        prefix = subscription_prefix("host01$")
+        self.assertEqual(prefix, b"host01/")
+        received_bodies = list()
+        for topic, frames in topic_messages:
+            if topic.startswith(prefix):
+                for header, body in unpack_batch(frames[1], frames[2]):
+                    self.assertEqual(json.loads(header.decode("utf-8"))[
+                        "hostname"], "host01")
+                    received_bodies.append(body)
+        self.assertEqual(sorted(received_bodies), [b"a1", b"a2", b"b1", ])
+
+    def test_subscription_prefix(self):
+        """
+        test turning regular expressions into a topic prefix
+        """
+        for regexps, expected_prefix in [
+            ((None, None, None, ), b""),
+            (("host0", None, None, ), b"host0"),
+            (("^host01$", None, "/var/log", ), b"host01/"),
+            (("host01$", "node1$", r"/var/log/a\.log"),
+             b"host01/node1//var/log/a.log"),
+            (("host0*", None, None, ), b"host"),
+            ((r"web\d+", None, None, ), b"web"),
+            (("web|db", None, None, ), b""),
+            (("host/", None, None, ), b"host"), ]:
+            self.assertEqual(subscription_prefix(*regexps),
+                             expected_prefix,
+                             regexps)
+
+    def test_prefix_matches_topics(self):
+        """
+        test that the prefix is a prefix of the topic of every header
+        the regular expressions match
+        """
+        regexps = ("host0$", "node[12]", "/var/log/.*", )
+        prefix = subscription_prefix(*regexps)
+        self.assertEqual(prefix, b"host0/node")
+
+        header_decoder = HeaderDecoder()
+        for hostname in ["host0", "host01", ]:
+            for nodename in ["node1", "node3", "", ]:
+                raw_header = _json_header(hostname,
+                                          "/var/log/a.log",
+                                          nodename or None)
+                message = [zlib.compress(raw_header), b"", ]
+                ((topic, _), ) = message_topics(message,
+                                                zlib.decompress,
+                                                header_decoder)
+                if re.match(regexps[0], hostname) and \
+                    re.match(regexps[1], nodename) and nodename != "":
+                    self.assertTrue(topic.startswith(prefix), topic)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+test_metrics.py
+"""
+import os
+import os.path
+import shutil
+from urllib.request import urlopen
+import zlib
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from old_log_inn.log_stream import LogStreamWriter, encode_log_stream_block
+from old_log_inn.metrics import MetricsError, MetricsRegistry, \
+    MetricsServer, count_open_files
+from old_log_inn.zlib_dictionary import ZlibDecompressor
+
+_output_dir = "/tmp/test_metrics"
+_output_work_dir = os.path.join(_output_dir, "work")
+_output_complete_dir = os.path.join(_output_dir, "complete")
+
+def _parse_samples(text):
+    """
+    return a dict of sample values, keyed by name and labels
+    """
+    samples = dict()
+    for line in text.splitlines():
+        if line.startswith("#"):
+            continue
+        key, value = line.rsplit(" ", 1)
+        samples[key] = float(value)
+    return samples
+
+class TestMetrics(unittest.TestCase):
+    """
+    test counting, rendering and serving metrics
+    """
+    def setUp(self):
+        self.tearDown()
+        os.makedirs(_output_work_dir)
+        os.makedirs(_output_complete_dir)
+
+    def tearDown(self):
+        if os.path.isdir(_output_dir):
+            shutil.rmtree(_output_dir)
+
+    def test_render(self):
+        """
+        test that we render what we counted
+        """
+        registry = MetricsRegistry(prefix="test_")
+        counter = registry.counter("messages_total", "messages",
+                                   {"socket" : "pull"})
+        counter.increment()
+        counter.increment(2)
+        self.assertTrue(registry.counter("messages_total", "messages",
+                                         {"socket" : "pull"}) is counter)
+        registry.gauge("depth", "depth", function=lambda: 7)
+        histogram = registry.histogram("seconds", "seconds",
+                                       buckets=(0.1, 1.0, ))
+        for value in [0.05, 0.1, 0.5, 2.0, ]:
+            histogram.observe(value)
+
+        text = registry.render()
+        self.assertTrue("# TYPE test_messages_total counter" in text)
+        self.assertTrue("# TYPE test_seconds histogram" in text)
+        samples = _parse_samples(text)
+        self.assertEqual(samples['test_messages_total{socket="pull"}'], 3)
+        self.assertEqual(samples["test_depth"], 7)
+        self.assertEqual(samples['test_seconds_bucket{le="0.1"}'], 2)
+        self.assertEqual(samples['test_seconds_bucket{le="1.0"}'], 3)
+        self.assertEqual(samples['test_seconds_bucket{le="+Inf"}'], 4)
+        self.assertEqual(samples["test_seconds_count"], 4)
+        self.assertAlmostEqual(samples["test_seconds_sum"], 2.65)
+
+        self.assertRaises(MetricsError, registry.gauge, "seconds", "seconds")
+        self.assertTrue(count_open_files() > 0)
+
+    def test_server(self):
+        """
+        test fetching the metrics over HTTP
+        """
+        registry = MetricsRegistry()
+        registry.counter("messages_total", "messages").increment(42)
+        server = MetricsServer(registry, "127.0.0.1:0")
+        server.start()
+        try:
+            host, port = server.server_address
+            url = "http://{0}:{1}/metrics".format(host, port)
+            text = urlopen(url).read().decode("utf-8")
+        finally:
+            server.close()
+        self.assertEqual(_parse_samples(text)["old_log_inn_messages_total"],
+                         42)
+
+    def test_log_stream_writer(self):
+        """
+        test that the writer counts records, and times its rollover
+        """
+        registry = MetricsRegistry(prefix="")
+        writer = LogStreamWriter("prefix.",
+                                 ".suffix",
+                                 5,
+                                 _output_work_dir,
+                                 _output_complete_dir,
+                                 metrics=registry)
+        writer.write_records([(b"header", b"data", ), ] * 3, 1000.0)
+        writer.check_for_rollover(1010.0)
+
+        samples = _parse_samples(registry.render())
+        self.assertEqual(samples["records_written_total"], 3)
+        self.assertEqual(samples["raw_bytes_written_total"], 30)
+        self.assertEqual(samples["rollover_seconds_count"], 1)
+        complete_path = os.path.join(_output_complete_dir,
+                                     os.listdir(_output_complete_dir)[0])
+        self.assertEqual(samples["file_bytes_written_total"],
+                         os.path.getsize(complete_path))
+
+    def test_raw_bytes(self):
+        """
+        test that the writer counts raw bytes on every write path
+        """
+        registry = MetricsRegistry(prefix="")
+        writer = LogStreamWriter("prefix.",
+                                 ".suffix",
+                                 5,
+                                 _output_work_dir,
+                                 _output_complete_dir,
+                                 metrics=registry)
+        writer.append_block(encode_log_stream_block(
+            [(b"header", b"data", ), ] * 2, dict()), 1000.0)
+        samples = _parse_samples(registry.render())
+        self.assertEqual(samples["raw_bytes_written_total"], 20)
+
+        # passthrough: the data uncompressed, whether we decompress it
+        # or the header gives its size
+        sized_header = b'{"body_size": 4}'
+        writer.write_messages([[zlib.compress(b"header"),
+                                zlib.compress(b"data")],
+                               [zlib.compress(sized_header),
+                                zlib.compress(b"data")], ],
+                              ZlibDecompressor(),
+                              1000.0)
+        samples = _parse_samples(registry.render())
+        self.assertEqual(samples["raw_bytes_written_total"],
+                         20 + 10 + len(sized_header) + 4)
+        writer.check_for_rollover(1010.0)
+
+if __name__ == "__main__":
+    unittest.main()
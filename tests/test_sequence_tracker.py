@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+test_sequence_tracker.py
+"""
+import json
+import os
+import os.path
+import shutil
+import uuid
+import zlib
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from old_log_inn.log_batch import pack_batch
+from old_log_inn.log_header import encode_binary_header, \
+    encode_string_table, \
+    header_sequence
+from old_log_inn.metrics import MetricsRegistry
+from old_log_inn.sequence_tracker import SequenceTracker
+
+_test_dir = "/tmp/test_sequence_tracker"
+_summary_path = os.path.join(_test_dir, "sequence_summary.json")
+
+def _json_header(uuid_value, sequence):
+    header = {"hostname"    : "host01",
+              "log_path"    : "/var/log/a.log",
+              "uuid"        : uuid_value.hex,
+              "sequence"    : sequence,
+              "timestamp"   : 100.0, }
+    return json.dumps(header).encode("utf-8")
+
+class TestSequenceTracker(unittest.TestCase):
+    """
+    test counting gaps, duplicates and reordering in producer sequences
+    """
+    def setUp(self):
+        self.tearDown()
+        os.mkdir(_test_dir)
+
+    def tearDown(self):
+        if os.path.isdir(_test_dir):
+            shutil.rmtree(_test_dir)
+
+    def test_header_sequence(self):
+        """
+        test reading the uuid and sequence of each kind of header
+        """
+        uuid_value = uuid.uuid4()
+        self.assertEqual(header_sequence(_json_header(uuid_value, 42)),
+                         (uuid_value.bytes, 42, ))
+        # not as our producers write it
+        raw_header = json.dumps({"sequence" : 43,
+                                 "uuid" : uuid_value.hex},
+                                separators=(",", ":")).encode("utf-8")
+        self.assertEqual(header_sequence(raw_header),
+                         (uuid_value.bytes, 43, ))
+        self.assertEqual(header_sequence(
+            encode_binary_header(uuid_value.bytes, 1, 44, 100.0)),
+            (uuid_value.bytes, 44, ))
+        self.assertEqual(header_sequence(
+            encode_string_table(uuid_value.bytes, "host01", None, "a.log")),
+            None)
+
+    def test_gaps(self):
+        """
+        test that gaps are counted, and filled by late arrivals
+        """
+        registry = MetricsRegistry(prefix="")
+        tracker = SequenceTracker(registry)
+        producer = b"p" * 16
+        for sequence in [1, 2, 3, 7, 8, 5, 4, 6, 8, 12, 1, 10, ]:
+            tracker.observe(producer, sequence, 100.0)
+
+        summary = tracker.summary(100.0)
+        self.assertEqual(summary["records"], 12)
+        self.assertEqual(summary["missing"], 6)
+        self.assertEqual(summary["recovered"], 4)
+        self.assertEqual(summary["lost"], 2)
+        self.assertEqual(summary["duplicates"], 2)
+        (producer_summary, ) = summary["producers"]
+        self.assertEqual(producer_summary["highest"], 12)
+        self.assertEqual(producer_summary["open_gaps"], [[9, 10], [11, 12]])
+        self.assertEqual(producer_summary["max_reorder"], 4)
+
+        rendered = registry.render()
+        self.assertTrue("sequence_lost 2" in rendered)
+        self.assertTrue("sequence_reorder_distance_count 4" in rendered)
+
+    def test_bounds(self):
+        """
+        test that we keep a bounded number of gaps and producers
+        """
+        tracker = SequenceTracker(max_producers=2, max_gaps=2,
+                                  idle_seconds=60.0)
+        for sequence in [1, 3, 5, 7, 2, ]:
+            tracker.observe(b"a" * 16, sequence, 100.0)
+        # the gap at 2 was given up
+        self.assertEqual(tracker.duplicates, 1)
+        self.assertEqual(tracker.summary()["producers"][0]["open_gaps"],
+                         [[4, 5], [6, 7]])
+
+        tracker.observe(b"b" * 16, 1, 110.0)
+        tracker.observe(b"c" * 16, 1, 120.0)
+        self.assertEqual(tracker.producer_count, 2)
+        self.assertEqual(tracker.evicted, 1)
+        self.assertEqual(tracker.evict_idle(175.0), 1)
+        self.assertEqual([p["uuid"] for p in tracker.summary()["producers"]],
+                         [uuid.UUID(bytes=b"c" * 16).hex, ])
+
+    def test_messages(self):
+        """
+        test counting the records of messages, single and batched
+        """
+        tracker = SequenceTracker()
+        json_uuid = uuid.uuid4()
+        binary_uuid = uuid.uuid4()
+        messages = [[zlib.compress(_json_header(json_uuid, 1)),
+                     zlib.compress(b"body"), ],
+                    pack_batch([encode_string_table(binary_uuid.bytes,
+                                                    "host02",
+                                                    None,
+                                                    "b.log"),
+                                encode_binary_header(binary_uuid.bytes,
+                                                     2, 1, 100.0),
+                                encode_binary_header(binary_uuid.bytes,
+                                                     2, 3, 100.0), ],
+                               [b"", b"a", b"b", ]),
+                    [zlib.compress(_json_header(json_uuid, 2)),
+                     zlib.compress(b"body"), ],
+                    [b"junk", b"junk", ], ]
+        tracker.observe_messages(messages, zlib.decompress, 100.0)
+        self.assertEqual(tracker.records, 4)
+        self.assertEqual(tracker.missing, 1)
+        self.assertEqual(tracker.errors, 1)
+
+        tracker.save_summary(_summary_path, 100.0)
+        with open(_summary_path) as input_file:
+            summary = json.load(input_file)
+        self.assertEqual(summary["lost"], 1)
+        self.assertEqual(summary["producers"][0]["uuid"], binary_uuid.hex)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+"""
+test_sub_list.py
+"""
+import os
+import os.path
+import shutil
+import threading
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import zmq
+
+from old_log_inn.sub_list import SubListWatcher, SubSocketSet, load_sub_list
+
+_test_dir = "/tmp/test_sub_list"
+_sub_list_path = os.path.join(_test_dir, "sub_list.txt")
+
+def _write_sub_list(addresses):
+    with open(_sub_list_path, "w") as output_file:
+        for address in addresses:
+            output_file.write("{0}\n".format(address))
+
+class TestSubList(unittest.TestCase):
+    """
+    test watching a sub list, and keeping sockets connected to it
+    """
+    def setUp(self):
+        self.tearDown()
+        os.mkdir(_test_dir)
+
+    def tearDown(self):
+        if os.path.isdir(_test_dir):
+            shutil.rmtree(_test_dir)
+
+    def test_watcher(self):
+        """
+        test that we see the file change, or a reload request
+        """
+        _write_sub_list(["tcp://127.0.0.1:5001", ])
+        reload_event = threading.Event()
+        watcher = SubListWatcher(_sub_list_path,
+                                 check_interval=1.0,
+                                 reload_event=reload_event)
+        self.assertEqual(watcher.load(), ["tcp://127.0.0.1:5001", ])
+
+        # no change
+        self.assertEqual(watcher.check(), None)
+
+        # a change we don't look for until the check interval is up
+        _write_sub_list(["tcp://127.0.0.1:5001", "tcp://127.0.0.1:5002", ])
+        current_time = os.stat(_sub_list_path).st_mtime
+        self.assertEqual(watcher.check(current_time - 10.0), None)
+        self.assertEqual(watcher.check(current_time + 10.0),
+                         ["tcp://127.0.0.1:5001", "tcp://127.0.0.1:5002", ])
+        self.assertEqual(watcher.check(current_time + 20.0), None)
+
+        # a reload request, whenever it comes
+        reload_event.set()
+        self.assertEqual(watcher.check(current_time + 20.5),
+                         ["tcp://127.0.0.1:5001", "tcp://127.0.0.1:5002", ])
+        self.assertFalse(reload_event.is_set())
+
+        # blank lines and a missing newline at the end
+        with open(_sub_list_path, "w") as output_file:
+            output_file.write("tcp://127.0.0.1:5001\n\ntcp://127.0.0.1:5003")
+        self.assertEqual(load_sub_list(_sub_list_path),
+                         ["tcp://127.0.0.1:5001", "tcp://127.0.0.1:5003", ])
+
+    def test_rate_limit(self):
+        """
+        test that new addresses are connected no faster than the rate
+        """
+        context = zmq.Context()
+        poller = zmq.Poller()
+        sub_socket_set = SubSocketSet(context, poller, connect_rate=2.0)
+        addresses = ["tcp://127.0.0.1:{0}".format(5000 + n) \
+                     for n in range(5)]
+
+        added, removed = sub_socket_set.update(addresses, 100.0)
+        self.assertEqual((added, removed, ), (addresses, [], ))
+        self.assertEqual(sub_socket_set.pending_count, 3)
+        self.assertEqual(sub_socket_set.poll_timeout(1.0), 0.5)
+
+        self.assertEqual(sub_socket_set.connect_pending(100.25), 0)
+        self.assertEqual(sub_socket_set.connect_pending(100.5), 1)
+        self.assertEqual(sub_socket_set.connect_pending(101.5), 2)
+        self.assertEqual(sub_socket_set.pending_count, 0)
+        self.assertEqual(sub_socket_set.poll_timeout(1.0), 1.0)
+
+        added, removed = sub_socket_set.update(addresses[1:] + \
+                                               ["tcp://127.0.0.1:6000", ],
+                                               110.0)
+        self.assertEqual(added, ["tcp://127.0.0.1:6000", ])
+        self.assertEqual(removed, addresses[:1])
+        self.assertEqual(sub_socket_set.addresses,
+                         sorted(addresses[1:] + \
+                                ["tcp://127.0.0.1:6000", ]))
+
+        sub_socket_set.close()
+        context.term()
+
+    def test_live_update(self):
+        """
+        test that the sockets we keep carry on while we add a new one
+        """
+        context = zmq.Context()
+        node_addresses = ["inproc://test_sub_list.node{0}".format(n) \
+                          for n in range(2)]
+        node_sockets = list()
+        for address in node_addresses:
+            node_socket = context.socket(zmq.PUB)
+            node_socket.bind(address)
+            node_sockets.append(node_socket)
+
+        poller = zmq.Poller()
+        sub_socket_set = SubSocketSet(context, poller, connect_rate=0)
+        sub_socket_set.update(node_addresses[:1])
+        first_sockets = [s for s in poller.sockets]
+
+        sub_socket_set.update(node_addresses)
+        self.assertEqual(len(poller.sockets), 2)
+        self.assertTrue(first_sockets[0] in poller.sockets)
+
+        # send until the subscriptions reach both nodes
+        receiving_sockets = set()
+        while len(receiving_sockets) < 2:
+            for node_socket in node_sockets:
+                node_socket.send_multipart([b"topic", b"message", ])
+            for sub_socket, _ in poller.poll(100):
+                self.assertEqual(sub_socket.recv_multipart(),
+                                 [b"topic", b"message", ])
+                receiving_sockets.add(sub_socket)
+
+        sub_socket_set.close()
+        for node_socket in node_sockets:
+            node_socket.close()
+        context.term()
+
+if __name__ == "__main__":
+    unittest.main()
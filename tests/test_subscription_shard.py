@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+test_subscription_shard.py
+"""
+import threading
+import time
+import zlib
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+import zmq
+
+from old_log_inn.log_batch import pack_batch
+from old_log_inn.subscription_shard import ShardedSubscriber, \
+    SubscriptionShardError, \
+    shard_addresses
+
+_node_addresses = ["inproc://test_subscription_shard.node{0}".format(n) \
+                   for n in range(5)]
+_pub_address = "inproc://test_subscription_shard.pub"
+
+class TestSubscriptionShard(unittest.TestCase):
+    """
+    test relaying the messages of several nodes through shards
+    """
+    def setUp(self):
+        self._context = zmq.Context()
+
+    def tearDown(self):
+        self._context.term()
+
+    def test_shard_addresses(self):
+        """
+        test dealing out addresses to shards
+        """
+        self.assertEqual(shard_addresses(list("abcde"), 2),
+                         [list("ace"), list("bd")])
+        self.assertEqual(shard_addresses(list("a"), 3),
+                         [list("a"), [], [], ])
+
+    def test_update_addresses(self):
+        """
+        test that addresses we keep stay on their shards
+        """
+        halt_event = threading.Event()
+        sharded_subscriber = ShardedSubscriber(self._context,
+                                               _node_addresses[:4],
+                                               ["", ],
+                                               2,
+                                               1000,
+                                               halt_event,
+                                               poll_interval=0.1)
+        sharded_subscriber.start()
+        shard_address_lists = [shard.address_list for shard in \
+                               sharded_subscriber._shards]
+
+        added, removed = \
+            sharded_subscriber.update_addresses(_node_addresses[1:])
+        self.assertEqual(added, _node_addresses[4:])
+        self.assertEqual(removed, _node_addresses[:1])
+        for shard, shard_address_list in zip(sharded_subscriber._shards,
+                                             shard_address_lists):
+            for address in shard_address_list[1:]:
+                self.assertTrue(address in shard.address_list)
+        self.assertEqual([c["addresses"] for c in \
+                          sharded_subscriber.counters()["shards"]],
+                         [2, 2, ])
+
+        halt_event.set()
+        sharded_subscriber.close()
+
+    def test_relay(self):
+        """
+        test that every message comes out unchanged
+        """
+        node_sockets = list()
+        for address in _node_addresses:
+            node_socket = self._context.socket(zmq.PUB)
+            node_socket.bind(address)
+            node_sockets.append(node_socket)
+
+        pub_socket = self._context.socket(zmq.PUB)
+        pub_socket.bind(_pub_address)
+        sub_socket = self._context.socket(zmq.SUB)
+        sub_socket.setsockopt(zmq.SUBSCRIBE, b"")
+        sub_socket.connect(_pub_address)
+
+        halt_event = threading.Event()
+        sharded_subscriber = ShardedSubscriber(self._context,
+                                               _node_addresses,
+                                               ["", ],
+                                               2,
+                                               1000,
+                                               halt_event,
+                                               poll_interval=0.1)
+        sharded_subscriber.start()
+
+        # let the subscriptions reach the nodes
+        time.sleep(0.5)
+
+        expected_messages = list()
+        for sequence in range(20):
+            for index, node_socket in enumerate(node_sockets):
+                topic = "node{0}/".format(index).encode("utf-8")
+                if sequence % 2 == 0:
+                    frames = [zlib.compress(b"header"),
+                              zlib.compress(b"body"), ]
+                else:
+                    frames = pack_batch([b"header", ], [b"body", ])
+                message = [topic, ] + frames
+                node_socket.send_multipart(message)
+                expected_messages.append(message)
+
+        received_messages = list()
+        while len(received_messages) < len(expected_messages):
+            sharded_subscriber.relay(pub_socket, 10)
+            while sub_socket.poll(0):
+                received_messages.append(sub_socket.recv_multipart())
+
+        self.assertEqual(sorted(received_messages), sorted(expected_messages))
+
+        counters = sharded_subscriber.counters()
+        self.assertEqual(counters["published"], len(expected_messages))
+        self.assertEqual(counters["queue_depth"], 0)
+        self.assertEqual([c["addresses"] for c in counters["shards"]],
+                         [3, 2, ])
+        self.assertEqual(sum(c["relayed"] for c in counters["shards"]),
+                         len(expected_messages))
+
+        halt_event.set()
+        sharded_subscriber.close()
+        for socket in node_sockets + [pub_socket, sub_socket, ]:
+            socket.close(linger=0)
+
+    def test_dead_shard(self):
+        """
+        test that a shard that dies halts the subscriber
+        """
+        pub_socket = self._context.socket(zmq.PUB)
+        pub_socket.bind(_pub_address)
+
+        halt_event = threading.Event()
+        sharded_subscriber = ShardedSubscriber(self._context,
+                                               _node_addresses,
+                                               ["", ],
+                                               2,
+                                               1000,
+                                               halt_event,
+                                               poll_interval=0.1,
+                                               connect_rate=0)
+        sharded_subscriber.start()
+        self.assertEqual(sharded_subscriber.relay(pub_socket, 10), 0)
+
+        # the shard dies trying to connect to an address zmq rejects
+        dead_shard = sharded_subscriber._shards[1]
+        dead_shard.set_addresses(["not an address", ])
+        dead_shard.join(5.0)
+        self.assertFalse(dead_shard.is_alive())
+        self.assertTrue(isinstance(dead_shard.error, zmq.ZMQError))
+
+        self.assertRaises(SubscriptionShardError,
+                          sharded_subscriber.relay,
+                          pub_socket,
+                          10)
+        self.assertTrue(halt_event.is_set())
+        sharded_subscriber.close()
+        pub_socket.close(linger=0)
+
+if __name__ == "__main__":
+    unittest.main()
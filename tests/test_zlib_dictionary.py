@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+test_zlib_dictionary.py
+"""
+import json
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+import zlib
+
+from old_log_inn.log_batch import pack_batch, unpack_message
+from old_log_inn.train_zlib_dictionary import train_zlib_dictionary
+from old_log_inn.zlib_dictionary import ZlibDictionaryError, \
+    ZlibCompressor, \
+    ZlibDecompressor, \
+    compressed_dictionary_id, \
+    zlib_dictionary_id
+
+def _make_header(sequence):
+    header = {"hostname"    : "host01",
+              "uuid"        : "0123456789abcdef0123456789abcdef",
+              "sequence"    : sequence,
+              "pid"         : 4242,
+              "timestamp"   : 1357041600.0 + sequence,
+              "log_path"    : "aaa/bbb/ccc.log"}
+    return json.dumps(header).encode("utf-8")
+
+class TestZlibDictionary(unittest.TestCase):
+    """
+    test preset dictionary compression
+    """
+    def setUp(self):
+        samples = [_make_header(n) for n in range(100)]
+        self._zdict = train_zlib_dictionary(samples, 4096, 8)
+
+    def test_round_trip(self):
+        """
+        a header compressed with a dictionary is smaller, records the 
+        dictionary id, and decompresses with the dictionary
+        """
+        header = _make_header(1000)
+        compressor = ZlibCompressor(self._zdict)
+        decompressor = ZlibDecompressor([self._zdict])
+
+        compressed = compressor.compress(header)
+        self.assertTrue(len(compressed) < len(zlib.compress(header)))
+        self.assertEqual(compressed_dictionary_id(compressed),
+                         zlib_dictionary_id(self._zdict))
+        self.assertEqual(decompressor.decompress(compressed), header)
+
+        # streams without a dictionary still decompress
+        self.assertEqual(compressed_dictionary_id(zlib.compress(header)), 
+                         None)
+        self.assertEqual(decompressor.decompress(zlib.compress(header)), 
+                         header)
+
+    def test_unknown_dictionary(self):
+        """
+        a stream that needs a dictionary we do not have is an error
+        """
+        compressed = ZlibCompressor(self._zdict).compress(_make_header(1))
+        decompressor = ZlibDecompressor()
+        self.assertRaises(ZlibDictionaryError, 
+                          decompressor.decompress, 
+                          compressed)
+
+    def test_batch(self):
+        """
+        a batch compressed with a dictionary unpacks with it
+        """
+        headers = [_make_header(n) for n in range(10)]
+        bodies = ["line {0}".format(n).encode("utf-8") for n in range(10)]
+        frames = pack_batch(headers, 
+                            bodies, 
+                            ZlibCompressor(self._zdict).compress)
+        decompressor = ZlibDecompressor([self._zdict])
+        self.assertEqual(unpack_message(frames, decompressor.decompress),
+                         list(zip(headers, bodies)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,6 +16,7 @@ import zlib
 
 import zmq
 
+from old_log_inn.log_batch import is_batch_marker, unpack_batch
 from old_log_inn.zmq_push_log_handler import ZMQPushLogHandler
 
 _test_addresses = ["ipc:///tmp/sockets/test1.socket", 
@@ -67,5 +68,130 @@ class TestZMQPushLogHandler(unittest.TestCase):
         header = json.loads(zlib.decompress(compressed_header))
         body = zlib.decompress(compressed_body)
 
+        logging.root.removeHandler(handler)
+        handler.close()
+        pull_socket.close()
+
+    def test_batch(self):
+        """
+        test gathering log records into a single batch message
+        """
+        os.environ["PYTHON_ZMQ_LOG_HANDLER"] = _test_addresses[0]
+        log_path = "aaa/bbb/ccc.log"
+        batch_size = 3
+
+        handler = ZMQPushLogHandler(log_path, 
+                                    zmq_context=self._zmq_context,
+                                    batch_size=batch_size,
+                                    batch_interval=60.0)
+        logging.root.addHandler(handler)
+        logging.root.setLevel(logging.DEBUG)
+
+        pull_socket = self._zmq_context.socket(zmq.PULL)
+        pull_socket.bind(_test_addresses[0])
+
+        poller = zmq.Poller()
+        poller.register(pull_socket, zmq.POLLIN)
+
+        log = logging.getLogger("test")
+        for index in range(batch_size):
+            log.info("pork {0}".format(index))
+
+        result_list = poller.poll(timeout=_poll_timeout)
+        self.assertEqual(len(result_list), 1)
+
+        marker = pull_socket.recv(zmq.NOBLOCK)
+        self.assertTrue(is_batch_marker(marker))
+        self.assertTrue(pull_socket.rcvmore)        
+        compressed_headers = pull_socket.recv()
+        self.assertTrue(pull_socket.rcvmore)        
+        compressed_bodies = pull_socket.recv()
+        self.assertFalse(pull_socket.rcvmore)        
+
+        records = unpack_batch(compressed_headers, compressed_bodies)
+        self.assertEqual(len(records), batch_size)
+        for index, (raw_header, raw_body) in enumerate(records):
+            header = json.loads(raw_header.decode("utf-8"))
+            self.assertEqual(header["sequence"], index+1)
+            self.assertEqual(header["log_path"], log_path)
+            self.assertEqual(raw_body.decode("utf-8"), 
+                             "pork {0}".format(index))
+
+        logging.root.removeHandler(handler)
+        handler.close()
+        pull_socket.close()
+
+    def test_batch_interval(self):
+        """
+        test that a partial batch is sent batch_interval after its first
+        record, with no more records coming
+        """
+        os.environ["PYTHON_ZMQ_LOG_HANDLER"] = _test_addresses[0]
+        log_path = "aaa/bbb/ccc.log"
+
+        handler = ZMQPushLogHandler(log_path,
+                                    zmq_context=self._zmq_context,
+                                    batch_size=10,
+                                    batch_interval=0.1)
+        self.assertNotEqual(handler.log_line_sender, None)
+        logging.root.addHandler(handler)
+        logging.root.setLevel(logging.DEBUG)
+
+        pull_socket = self._zmq_context.socket(zmq.PULL)
+        pull_socket.bind(_test_addresses[0])
+
+        poller = zmq.Poller()
+        poller.register(pull_socket, zmq.POLLIN)
+
+        log = logging.getLogger("test")
+        log.info("pork")
+
+        result_list = poller.poll(timeout=1000)
+        self.assertEqual(len(result_list), 1)
+        frames = pull_socket.recv_multipart(zmq.NOBLOCK)
+        self.assertTrue(is_batch_marker(frames[0]))
+        records = unpack_batch(frames[1], frames[2])
+        self.assertEqual([body for (_, body) in records], [b"pork", ])
+
+        logging.root.removeHandler(handler)
+        handler.close()
+        pull_socket.close()
+
+    def test_sender_thread(self):
+        """
+        test queueing records for the background sender thread
+        """
+        os.environ["PYTHON_ZMQ_LOG_HANDLER"] = _test_addresses[0]
+        log_path = "aaa/bbb/ccc.log"
+        record_count = 100
+
+        handler = ZMQPushLogHandler(log_path, 
+                                    zmq_context=self._zmq_context,
+                                    sender_thread=True)
+        logging.root.addHandler(handler)
+        logging.root.setLevel(logging.DEBUG)
+
+        pull_socket = self._zmq_context.socket(zmq.PULL)
+        pull_socket.bind(_test_addresses[0])
+
+        log = logging.getLogger("test")
+        for index in range(record_count):
+            log.info("pork {0}".format(index))
+
+        # closing the handler must send everything that was queued
+        logging.root.removeHandler(handler)
+        handler.close()
+
+        for index in range(record_count):
+            compressed_header = pull_socket.recv()
+            self.assertTrue(pull_socket.rcvmore)        
+            compressed_body = pull_socket.recv()
+            header = json.loads(zlib.decompress(compressed_header))
+            self.assertEqual(header["sequence"], index+1)
+            self.assertEqual(zlib.decompress(compressed_body).decode("utf-8"),
+                             "pork {0}".format(index))
+
+        pull_socket.close()
+
 if __name__ == "__main__":
     unittest.main()